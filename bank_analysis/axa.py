@@ -1,14 +1,20 @@
+import io
 import os
-import warnings
+import time
 from abc import ABCMeta
 from collections import namedtuple
 
 import re
 
-from .base import Operation, Bank, Account, Historic, Entity
+from . import instrumentation
+from .base import Operation, Bank, Account, Historic, Entity, LazyAttribute, \
+    TypeTable
+from .records import RecordSplitter
 
 
 class AxaBank(Bank):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__("Axa", "AXABBE22")
 
@@ -18,6 +24,22 @@ class AxaBank(Bank):
 
 class AxaOp(Operation):
     # Always try to be more specific
+    date_format = "%d/%m/%Y"
+
+    # Only used by operations built with `from_record`: each attribute is
+    # decoded from the raw record fields on first access
+    op_date = LazyAttribute(
+        lambda self: self.parse_date(self._fields.operation_date))
+    effective_date = LazyAttribute(
+        lambda self: self.parse_date(self._fields.effective_date))
+    value = LazyAttribute(
+        lambda self: float(self._fields.value.replace(",", ".")))
+    description = LazyAttribute(lambda self: self._fields.details)
+    amount_remaining = LazyAttribute(
+        lambda self: self._fields.amount_remaining)
+    message = LazyAttribute(
+        lambda self: os.linesep.join([self._fields.msg1, self._fields.msg2]))
+
     def __init__(self, account, operation_date, effective_date, value,
                  description, amount_remaining, message=""):
         super().__init__(account, operation_date, effective_date, value,
@@ -25,15 +47,30 @@ class AxaOp(Operation):
         self.amount_remaining = amount_remaining
         self.message = message
 
+    @classmethod
+    def from_record(cls, account, fields):
+        """
+        Build the operation lazily from the raw fields (an `AxaParser.OpStr`)
+        of its record
+        """
+        operation = cls.__new__(cls)
+        operation.account = account
+        operation._fields = fields
+        return operation
+
 
 class NotAccountOp(AxaOp, metaclass=ABCMeta):
     """The other party is not an account"""
+    other_party_name = LazyAttribute(
+        lambda self: Entity.interned(self._fields.machine_name))
+    other_party_place = LazyAttribute(lambda self: self._fields.place)
+
     def __init__(self, account, operation_date, effective_date, value,
                  description, amount_remaining, other_party_name,
                  other_party_place, message=""):
         super().__init__(account, operation_date, effective_date, value,
                          description, amount_remaining, message)
-        self.other_party_name = Entity(other_party_name)
+        self.other_party_name = Entity.interned(other_party_name)
         self.other_party_place = other_party_place
 
     def get_other_party(self):
@@ -49,14 +86,18 @@ class Withdrawal(NotAccountOp):
 
 
 class AccountOp(AxaOp, metaclass=ABCMeta):
+    other_party = LazyAttribute(
+        lambda self: Account.interned(iban=self._fields.other_account,
+                                      name=self._fields.other_name))
+
     def __init__(self, account, operation_date, effective_date, value,
                  description, amount_remaining, other_party_account,
                  other_party_name, message=""):
         super().__init__(account, operation_date, effective_date, value,
                          description, amount_remaining, message)
 
-        self.other_party = Account(iban=other_party_account,
-                                   name=other_party_name)
+        self.other_party = Account.interned(iban=other_party_account,
+                                            name=other_party_name)
 
     def get_other_party(self):
         return self.other_party
@@ -92,15 +133,43 @@ class Fee(PossiblyWithinOperation):
         return self.account.bank
 
 
+def _debit_refinement(type_str):
+    if "visa" in type_str.lower():
+        return VisaDebit
+
+
+AXA_TYPES = TypeTable(default=AxaOp)
+for type_str in ("Achat - Bancontact", "Achat - Maestro",
+                 "Vente glob. - Bancontact"):
+    AXA_TYPES.register(type_str, Payment)
+AXA_TYPES.register("Retrait", Withdrawal, prefix=True)
+AXA_TYPES.register("Virement", Transfer, prefix=True)
+AXA_TYPES.register("Ordre permanent", PermanentOrder)
+AXA_TYPES.register("Domiciliation", Debit, prefix=True,
+                   refine=_debit_refinement)
+AXA_TYPES.register("Encaissement interne", Debit, refine=_debit_refinement)
+AXA_TYPES.register("Contribution", Fee, prefix=True)
+AXA_TYPES.register("Capitalisation", Fee)  # Weird
+
+
 class AxaParser(object):
     OpStr = namedtuple('OpStr', ['id', 'operation_date', 'effective_date',
                                  'writing_date', 'value', 'amount_remaining',
                                  'type', 'other_account', 'other_name',
                                  'machine_name', 'place', 'card_number',
                                  'msg1', 'msg2', 'details'])
+    OpStr.__qualname__ = "AxaParser.OpStr"  # Picklable
+
+    def __init__(self, use_mmap=True, operation_types=None):
+        # Operation factories by type string (see `TypeTable`)
+        self.operation_types = AXA_TYPES if operation_types is None \
+            else operation_types
+        # Split the records on the memory-mapped bytes (see `RecordSplitter`)
+        # rather than line by line on the decoded text
+        self.use_mmap = use_mmap
 
     def _parse_general_header(self, hdl, account_name):
-        bank = AxaBank()
+        bank = AxaBank.interned()
         type = hdl.readline().strip()
         account_str = hdl.readline()
         bic_str = hdl.readline()
@@ -111,84 +180,91 @@ class AxaParser(object):
         iban = account_str[5:].replace(" ", "").strip()
         bic = bic_str[4:].strip()
         if bank.bic != bic:
-            print(len(bank.bic))
-            print(len(bic))
             raise ValueError("BIC of the bank is not correct. "
                              "Expecting {}, found {}".format(bank.bic, bic))
-        return Account(iban, bank, account_name, type=type)
+        return Account.interned(iban, bank, account_name, type=type)
 
     def _parse_operation(self, line, line_number, account):
         op_str = self.__class__.OpStr(*line.split(";"))
-        # Selecting on type
-
-        other_is_account = False
-        other_is_not_account = False
-        if op_str.type == "Achat - Bancontact" or \
-           op_str.type == "Achat - Maestro" or \
-           op_str.type == "Vente glob. - Bancontact":
-            factory = Payment
-            other_is_not_account = True
-        elif op_str.type.startswith("Retrait"):
-            factory = Withdrawal
-            other_is_not_account = True
-        elif op_str.type.startswith("Virement"):
-            factory = Transfer
-            other_is_account = True
-        elif op_str.type == "Ordre permanent":
-            factory = PermanentOrder
-            other_is_account = True
-        elif op_str.type.startswith("Domiciliation") or \
-             op_str.type == "Encaissement interne":
-            if "visa" in op_str.type.lower():
-                factory = VisaDebit
-            else:
-                factory = Debit
-            other_is_account = True
-        elif op_str.type.startswith("Contribution"):
-            factory = Fee
-            other_is_account = True
-        elif op_str.type == "Capitalisation":
-            factory = Fee  # Weird
-            other_is_account = True
-        else:
-            warnings.warn("Unknown operation type '{}' (line {})."
-                          "".format(op_str.type, line_number))
-            factory = AxaOp
-
-        def partial(**kwargs):
-            return factory(account=account,
-                           operation_date=op_str.operation_date,
-                           effective_date=op_str.effective_date,
-                           value=float(op_str.value.replace(",", ".")),
-                           description=op_str.details,
-                           amount_remaining=op_str.amount_remaining,
-                           message=os.linesep.join([op_str.msg1, op_str.msg2]),
-                           **kwargs)
-
-        if other_is_account:
-            return partial(other_party_account=op_str.other_account,
-                           other_party_name=op_str.other_name)
-        elif other_is_not_account:
-            return partial(other_party_name=op_str.machine_name,
-                           other_party_place=op_str.place)
-        else:
-            return partial()
+        factory = self.operation_types.resolve(op_str.type, line_number)
+        return factory.from_record(account, op_str)
 
-    def parse_csv(self, fpath, account_name="n/a", encoding="latin"):
-        ops = []
+    def _iter_records(self, hdl):
+        """Yield `(line_number, record)` for each (multi-line) record"""
         line_start = re.compile(r"^\d\d\d\d(\s)?/(\s)?\d+")
+        header_line = hdl.readline().strip()  # skip csv header
+        curr_lines = []
+        curr_line_number = 0
+        for i, line in enumerate(hdl):
+            if line_start.match(line):
+                if len(curr_lines) > 0:
+                    yield curr_line_number, "".join(curr_lines).strip()
+                curr_lines = [line]
+                curr_line_number = i + 10
+            else:
+                curr_lines.append(line)
+        if len(curr_lines) > 0:
+            yield curr_line_number, "".join(curr_lines).strip()
+
+    def iter_records(self, fpath, account_name="n/a", encoding="latin"):
+        """
+        Yield `(account, line_number, record)` for each raw record of the
+        export `fpath`; see `parse_record`.
+        """
+        if self.use_mmap:
+            with RecordSplitter(fpath) as splitter:
+                with instrumentation.stage("axa.header", 1):
+                    header = io.StringIO(splitter.header(encoding))
+                    account = self._parse_general_header(header, account_name)
+                for line_number, record in splitter.iter_records(encoding):
+                    yield account, line_number, record
+            return
+
         with open(fpath, "r", encoding=encoding) as hdl:
-            account = self._parse_general_header(hdl, account_name)
-            header_line = hdl.readline().strip()  # skip csv header
-            curr_line = ""
-            for i, line in enumerate(hdl):
-                if line_start.match(line):
-                    if len(curr_line) > 0:
-                        ops.append(self._parse_operation(curr_line.strip(),
-                                                         i + 8,
-                                                         account))
-                    curr_line = line
-                else:
-                    curr_line += line
-
-        return Historic(ops)
+            with instrumentation.stage("axa.header", 1):
+                account = self._parse_general_header(hdl, account_name)
+            for line_number, record in self._iter_records(hdl):
+                yield account, line_number, record
+
+    def parse_record(self, record, line_number, account):
+        return self._parse_operation(record, line_number, account)
+
+    def iter_operations(self, fpath, account_name="n/a", encoding="latin"):
+        """
+        Yield the operations of the export `fpath` one by one, as soon as
+        each (possibly multi-line) record is complete.
+        """
+        records = self.iter_records(fpath, account_name, encoding)
+        stats = instrumentation.current()
+        if stats is None:
+            for account, line_number, record in records:
+                yield self._parse_operation(record, line_number, account)
+            return
+
+        # Time the splitting and the dispatch of each record separately (not
+        # what the consumer does in between)
+        clock = time.perf_counter
+        splitting = dispatch = 0.
+        n_records = 0
+        start = clock()
+        try:
+            for account, line_number, record in records:
+                split = clock()
+                operation = self._parse_operation(record, line_number,
+                                                  account)
+                splitting += split - start
+                dispatch += clock() - split
+                n_records += 1
+                yield operation
+                start = clock()
+            splitting += clock() - start
+        finally:
+            stats.add("axa.split_records", splitting, n_records)
+            stats.add("axa.dispatch", dispatch, n_records)
+
+    def parse_csv(self, fpath, account_name="n/a", encoding="latin"):
+        with instrumentation.stage("axa.parse_csv") as timed:
+            historic = Historic(self.iter_operations(fpath, account_name,
+                                                     encoding))
+            timed.rows = len(historic)
+        return historic
@@ -1,16 +1,49 @@
+import warnings
 from abc import ABCMeta
 from datetime import datetime
 
 import copy
-from dateutil.parser import parse as auto_parse_date
+from collections import Counter
+
+import numpy as np
+
+from . import instrumentation
+from .dates import get_date_parser
+
+
+class LazyAttribute(object):
+    """
+    Attribute decoded by `decoder(instance)` on first access only.
+
+    The decoded value is stored in the instance dictionary, which then takes
+    precedence over this (non-data) descriptor: later accesses are plain
+    attribute lookups. Setting the attribute directly (e.g. in `__init__`)
+    bypasses the decoding altogether.
+    """
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = self.decoder(instance)
+        instance.__dict__[self.name] = value
+        return value
 
 
 class Operation(object, metaclass=ABCMeta):
+    # `strptime`-like layout of the dates (None: let dateutil guess)
+    date_format = None
+
     @classmethod
     def parse_date(cls, date):
         if isinstance(date, datetime):
             return date
-        return auto_parse_date(date)
+        return get_date_parser(cls.date_format)(date)
 
     def __init__(self, account, operation_date, effective_date, value,
                  description):
@@ -41,28 +74,118 @@ class Operation(object, metaclass=ABCMeta):
         pass
 
 
+class Registry(object):
+    """
+    Interning table for entities: each distinct entity is only built once
+    and then shared (see `Entity.interned`).
+    """
+    def __init__(self):
+        self._by_args = {}
+        self._by_state = {}
+
+    def canonical(self, entity):
+        """The shared instance equivalent to `entity`"""
+        key = (entity.__class__, entity._state())
+        return self._by_state.setdefault(key, entity)
+
+    def intern(self, cls, *args, **kwargs):
+        key = (cls, args, tuple(sorted(kwargs.items())))
+        entity = self._by_args.get(key)
+        if entity is None:
+            entity = self.canonical(cls(*args, **kwargs))
+            self._by_args[key] = entity
+        return entity
+
+    def __len__(self):
+        return len(self._by_state)
+
+    def clear(self):
+        self._by_args.clear()
+        self._by_state.clear()
+
+
+ENTITIES = Registry()
+
+
+def _unpickle_entity(cls, state):
+    entity = cls.__new__(cls)
+    entity._restore(state)
+    entity._finish()
+    return ENTITIES.canonical(entity)
+
+
 class Entity(object):
+    """
+    Entities are immutable and carry a precomputed equality key and hash.
+    Entities of different kinds (plain entity, bank, account) are never
+    equal.
+
+    Only the state (see `_state`) is pickled: the hash (of strings, salted
+    per process) is computed again and the entity interned on unpickling.
+    """
+    __slots__ = ("_name", "_key", "_hash")
+
     def __init__(self, name):
         self._name = name
+        self._finish()
+
+    def _finish(self):
+        self._key = self._compute_key()
+        # Finer than the key: accounts with the same IBAN but different
+        # names are equal but still told apart by dicts and sets
+        self._hash = hash(repr(self))
+
+    def __reduce__(self):
+        return _unpickle_entity, (self.__class__, self._state())
+
+    def _restore(self, state):
+        self._name, = state
+
+    @classmethod
+    def interned(cls, *args, **kwargs):
+        """Like the constructor, but returning the shared instance"""
+        return ENTITIES.intern(cls, *args, **kwargs)
+
+    def _compute_key(self):
+        return "entity", self._name
+
+    def _state(self):
+        return self._name,
 
     @property
     def name(self):
         return self._name
 
     def __eq__(self, other):
-        return isinstance(other, Entity) and self.name == other.name
+        return self is other or \
+               (isinstance(other, Entity) and self._key == other._key)
 
     def __repr__(self):
         return "{}({})".format(self.__class__.__name__, self.name)
 
     def __hash__(self):
-        return hash(repr(self))
+        return self._hash
 
 
 class Bank(Entity):
+    __slots__ = ("_bic",)
+
     def __init__(self, name, bic):
+        self._bic = bic
         super().__init__(name)
-        self.bic = bic
+
+    @property
+    def bic(self):
+        return self._bic
+
+    def _compute_key(self):
+        return "bank", self._name, self._bic
+
+    def _state(self):
+        return self._name, self._bic
+
+    def _restore(self, state):
+        self._name, self._bic = state
 
     def __repr__(self):
         return "{cls}(name={name}, bic={bic})" \
@@ -70,20 +193,40 @@ class Bank(Entity):
                          name=repr(self.name),
                          bic=repr(self.bic))
 
-    def __eq__(self, other):
-        return isinstance(other, Bank) and other.name == self.name and \
-               self.bic == other.bic
-
-    def __hash__(self):
-        return super().__hash__()
-
 
 class Account(Entity):
+    __slots__ = ("_iban", "_bank", "_type")
+
     def __init__(self, iban, bank=None, name="n/a", type="n/a"):
+        self._iban = iban
+        self._bank = bank
+        self._type = type
         super().__init__(name)
-        self.iban = iban
-        self.bank = bank
-        self.type = type
+
+    @property
+    def iban(self):
+        return self._iban
+
+    @property
+    def normalized_iban(self):
+        return self._key[1]
+
+    @property
+    def bank(self):
+        return self._bank
+
+    @property
+    def type(self):
+        return self._type
+
+    def _compute_key(self):
+        return "account", self._iban.replace(" ", "")
+
+    def _state(self):
+        return self._iban, self._bank, self._name, self._type
+
+    def _restore(self, state):
+        self._iban, self._bank, self._name, self._type = state
 
     @property
     def name(self):
@@ -111,56 +254,562 @@ class Account(Entity):
     def __str__(self):
         return self.account_to_str()
 
-    def __eq__(self, other):
-        return isinstance(other, Account) and \
-               self.iban.replace(" ", "") == other.iban.replace(" ", "")
 
-    def __hash__(self):  # Why is it not inherited ?
-        return super().__hash__()
+class Codebook(object):
+    """Dense integer codes for hashable objects (accounts, parties, types)"""
+    def __init__(self):
+        self._codes = {}
+        self._objects = []
+
+    def encode(self, obj):
+        code = self._codes.get(obj)
+        if code is None:
+            code = len(self._objects)
+            self._codes[obj] = code
+            self._objects.append(obj)
+        return code
+
+    def decode(self, code):
+        return self._objects[code]
+
+    def __len__(self):
+        return len(self._objects)
+
+
+# Codes are shared by every historic so that merging never has to remap them
+ACCOUNT_CODES = Codebook()
+PARTY_CODES = Codebook()
+TYPE_CODES = Codebook()
+
+
+class TypeTable(object):
+    """
+    Maps the operation type strings of a bank's exports to `Operation`
+    factories.
+
+    Exact type strings are looked up in a dict, then the longest registered
+    prefix is searched in a trie; the result is memoized per distinct type
+    string. Strings matching nothing resolve to `default` and are counted in
+    `unknown` (warned once per type).
+
+    Parameters
+    ----------
+    default: callable
+        The factory of unknown types
+    """
+    _END = None  # Trie key of the entry of a node
+
+    def __init__(self, default):
+        self.default = default
+        self._exact = {}
+        self._trie = {}
+        self._memo = {}
+        self.unknown = Counter()
+
+    def register(self, type_str, factory=None, prefix=False, refine=None):
+        """
+        Map `type_str` (or every type starting with it if `prefix`) to
+        `factory`. `refine(type_str)` may return a more specific factory (or
+        None to keep `factory`).
+
+        Without `factory`, return a class decorator registering the class.
+        """
+        if factory is None:
+            def decorator(cls):
+                self.register(type_str, cls, prefix, refine)
+                return cls
+            return decorator
+
+        entry = (factory, refine)
+        if prefix:
+            node = self._trie
+            for char in type_str:
+                node = node.setdefault(char, {})
+            node[self.__class__._END] = entry
+        else:
+            self._exact[type_str] = entry
+        self._memo.clear()
+        return factory
+
+    def _lookup(self, type_str):
+        entry = self._exact.get(type_str)
+        if entry is None:
+            node = self._trie
+            entry = node.get(self.__class__._END)
+            for char in type_str:
+                node = node.get(char)
+                if node is None:
+                    break
+                entry = node.get(self.__class__._END, entry)
+        if entry is None:
+            return None
+        factory, refine = entry
+        if refine is not None:
+            factory = refine(type_str) or factory
+        return factory
+
+    def resolve(self, type_str, line_number=None):
+        """The factory of `type_str`"""
+        factory = self._memo.get(type_str)
+        if factory is None:
+            factory = self._lookup(type_str)
+            if factory is None:
+                warnings.warn("Unknown operation type '{}' (line {})."
+                              "".format(type_str, line_number))
+                factory = self.default
+                self.unknown[type_str] = 0
+            self._memo[type_str] = factory
+        if type_str in self.unknown:
+            self.unknown[type_str] += 1
+            stats = instrumentation.current()
+            if stats is not None:
+                stats.count("unknown operation types", type_str)
+        return factory
+
+    def __contains__(self, type_str):
+        return self._lookup(type_str) is not None
+
+
+def _to_datetime64(dates):
+    return np.array(dates, dtype="datetime64[us]")
+
+
+class Deferred(object):
+    """Operation which is only built (once) when first accessed"""
+    __slots__ = ("factory", "args", "operation")
+
+    def __init__(self, factory, *args):
+        self.factory = factory
+        self.args = args
+        self.operation = None
+
+    def build(self):
+        if self.operation is None:
+            self.operation = self.factory(*self.args)
+            self.args = None
+        return self.operation
+
+
+def _build(operation):
+    if operation.__class__ is Deferred:
+        return operation.build()
+    return operation
+
+
+class DuplicatePolicy(object):
+    """
+    Decide which operations are the same when merging historics.
+
+    Operations are fingerprinted by account (IBAN), operation date, effective
+    date, value, other party and description. The fingerprint can be made
+    looser to catch near duplicates.
+
+    Parameters
+    ----------
+    date_tolerance: int
+        Operation dates up to this number of days apart are considered equal
+    value_decimals: int
+        Number of decimals of the value which are compared
+    ignore_effective_date: bool
+        Whether to leave the effective date out of the fingerprint
+    ignore_description: bool
+        Whether to leave the description out of the fingerprint
+    """
+    def __init__(self, date_tolerance=0, value_decimals=2,
+                 ignore_effective_date=False, ignore_description=False):
+        self.date_tolerance = date_tolerance
+        self.value_decimals = value_decimals
+        self.ignore_effective_date = ignore_effective_date
+        self.ignore_description = ignore_description
+
+    def fingerprints(self, historic):
+        """Return the list of the fingerprints of `historic` (op. date first)"""
+        accounts = {code: ACCOUNT_CODES.decode(code).normalized_iban
+                    for code in np.unique(historic.account_ids).tolist()}
+        columns = [historic.op_dates.astype("datetime64[D]").astype(np.int64)
+                   .tolist(),
+                   [accounts[code] for code in historic.account_ids.tolist()],
+                   np.round(historic.values * 10 ** self.value_decimals)
+                   .astype(np.int64).tolist(),
+                   historic.party_ids.tolist()]
+        if not self.ignore_effective_date:
+            columns.append(historic.effective_dates.astype("datetime64[D]")
+                           .astype(np.int64).tolist())
+        if not self.ignore_description:
+            columns.append([op.description for op in historic])
+        return list(zip(*columns))
+
+    def probes(self, fingerprint):
+        """Fingerprints an operation matching `fingerprint` could have"""
+        yield fingerprint
+        day = fingerprint[0]
+        for delta in range(1, self.date_tolerance + 1):
+            yield (day - delta,) + fingerprint[1:]
+            yield (day + delta,) + fingerprint[1:]
+
+    def index(self, historic):
+        return Counter(self.fingerprints(historic))
+
+    def update(self, index, historic):
+        """
+        Return the mask of the operations of `historic` which are not already
+        in `index` and add them to it.
+
+        An operation occurring several times is only dropped as many times as
+        it was already indexed, so that legitimate repeated operations within
+        one statement are kept.
+        """
+        keep = np.ones(len(historic), dtype=bool)
+        consumed = Counter()
+        kept = []
+        for i, fingerprint in enumerate(self.fingerprints(historic)):
+            for probe in self.probes(fingerprint):
+                if index.get(probe, 0) > consumed[probe]:
+                    consumed[probe] += 1
+                    keep[i] = False
+                    break
+            else:
+                kept.append(fingerprint)
+        index.update(kept)
+        return keep
+
+
+class DateIndex(object):
+    """
+    Sort order of an historic on one of its date columns.
+
+    `order` is the stable permutation sorting the dates (None when the
+    historic is already sorted) and `sorted_dates` the dates in that order.
+    The index can be carried over masks, slices and concatenations without
+    sorting again.
+    """
+    __slots__ = ("order", "sorted_dates")
+
+    def __init__(self, order, sorted_dates):
+        self.order = order
+        self.sorted_dates = sorted_dates
+
+    @classmethod
+    def build(cls, dates):
+        if len(dates) < 2 or bool((dates[:-1] <= dates[1:]).all()):
+            return cls(None, dates)
+        order = np.argsort(dates, kind="stable")
+        return cls(order, dates[order])
+
+    def bounds(self, oldest=None, latest=None):
+        """Range of `sorted_dates` within [oldest, latest]"""
+        lo, hi = 0, len(self.sorted_dates)
+        if oldest is not None:
+            lo = np.searchsorted(self.sorted_dates,
+                                 np.datetime64(oldest, "us"), side="left")
+        if latest is not None:
+            hi = np.searchsorted(self.sorted_dates,
+                                 np.datetime64(latest, "us"), side="right")
+        return int(lo), int(max(lo, hi))
+
+    def take_mask(self, mask):
+        if self.order is None:
+            return DateIndex(None, self.sorted_dates[mask])
+        sorted_mask = mask[self.order]
+        new_positions = np.cumsum(mask) - 1
+        return DateIndex(new_positions[self.order[sorted_mask]],
+                         self.sorted_dates[sorted_mask])
+
+    def take_range(self, start, stop):
+        if self.order is None:
+            return DateIndex(None, self.sorted_dates[start:stop])
+        selected = (start <= self.order) & (self.order < stop)
+        return DateIndex(self.order[selected] - start,
+                         self.sorted_dates[selected])
+
+    def concatenate(self, other, offset):
+        """Index of the concatenation of `offset` rows and `other`'s rows"""
+        if self.order is None and other.order is None and \
+           (len(other.sorted_dates) == 0 or len(self.sorted_dates) == 0 or
+                self.sorted_dates[-1] <= other.sorted_dates[0]):
+            return DateIndex(None, np.concatenate((self.sorted_dates,
+                                                   other.sorted_dates)))
+        n_self, n_other = len(self.sorted_dates), len(other.sorted_dates)
+        own_order = np.arange(n_self) if self.order is None else self.order
+        other_order = np.arange(n_other) if other.order is None \
+            else other.order
+        # Ties keep the rows of self first
+        from_other = np.zeros(n_self + n_other, dtype=bool)
+        from_other[np.searchsorted(self.sorted_dates, other.sorted_dates,
+                                   side="right") + np.arange(n_other)] = True
+        order = np.empty(n_self + n_other, dtype=np.int64)
+        order[~from_other] = own_order
+        order[from_other] = other_order + offset
+        sorted_dates = np.empty(n_self + n_other,
+                                dtype=self.sorted_dates.dtype)
+        sorted_dates[~from_other] = self.sorted_dates
+        sorted_dates[from_other] = other.sorted_dates
+        return DateIndex(order, sorted_dates)
 
 
 class Historic(object):
+    """
+    Columnar sequence of operations.
+
+    Dates, values, account, other party and operation type are kept as numpy
+    arrays so that slicing, clipping and aggregating never go through the
+    `Operation` objects. Those are only handed out on iteration/indexing.
+
+    A `DateIndex` is built on demand for each date column used by `clip` and
+    `period_covered` and maintained through slicing, filtering and merging.
+    """
+    _COLUMNS = ("_operations", "_op_dates", "_effective_dates", "_values",
+                "_account_ids", "_party_ids", "_type_codes")
+    duplicate_policy = DuplicatePolicy()
+    # (policy, Counter of fingerprints), handed over from merge to merge
+    _index = None
+    _DATE_COLUMNS = {"op_date": "_op_dates",
+                     "effective_date": "_effective_dates"}
+
     def __init__(self, operations=None):
         if operations is None:
             operations = []
-        self.operations = [x for x in operations]
+        operations = [x for x in operations]
+        n = len(operations)
+        self._operations = np.empty(n, dtype=object)
+        self._operations[:] = operations
+        # Lazily built operations parse their dates here
+        with instrumentation.stage("historic.dates", n):
+            self._op_dates = _to_datetime64([op.op_date for op in operations])
+            self._effective_dates = _to_datetime64([op.effective_date
+                                                    for op in operations])
+        with instrumentation.stage("historic.columns", n):
+            self._values = np.fromiter((op.value for op in operations),
+                                       dtype=np.float64, count=n)
+            self._account_ids = np.fromiter(
+                (ACCOUNT_CODES.encode(op.account) for op in operations),
+                dtype=np.int32, count=n)
+            self._party_ids = np.fromiter(
+                (PARTY_CODES.encode(op.get_other_party())
+                 for op in operations),
+                dtype=np.int32, count=n)
+            self._type_codes = np.fromiter(
+                (TYPE_CODES.encode(op.__class__) for op in operations),
+                dtype=np.int32, count=n)
+        self._date_indexes = {}
 
-    def __getitem__(self, item):
-        if isinstance(item, slice):
-            new_historic = copy.copy(self)
-            new_historic.operations = new_historic.operations[item]
-            return new_historic
-        return self.operations[item]
-
-    def merge(self, other_historic):
-        # TODO filter out redoundancy
-        new_historic = copy.copy(self)
-        new_historic.operations = copy.copy(self.operations)
-        new_historic.operations.extend(other_historic.operations)
+    @classmethod
+    def from_columns(cls, operations, op_dates, effective_dates, values,
+                     account_ids, party_ids, type_codes):
+        """
+        Build an historic directly from its columns. `operations` may hold
+        `Deferred` placeholders, which are only built when accessed. The ids
+        and codes refer to `ACCOUNT_CODES`, `PARTY_CODES` and `TYPE_CODES`.
+        """
+        historic = cls.__new__(cls)
+        historic._operations = np.empty(len(operations), dtype=object)
+        historic._operations[:] = operations
+        historic._op_dates = np.asarray(op_dates, dtype="datetime64[us]")
+        historic._effective_dates = np.asarray(effective_dates,
+                                               dtype="datetime64[us]")
+        historic._values = np.asarray(values, dtype=np.float64)
+        historic._account_ids = np.asarray(account_ids, dtype=np.int32)
+        historic._party_ids = np.asarray(party_ids, dtype=np.int32)
+        historic._type_codes = np.asarray(type_codes, dtype=np.int32)
+        historic._date_indexes = {}
+        return historic
+
+    @classmethod
+    def concatenate(cls, historics, policy=None):
+        """
+        Chain several historics in a single copy. If a `DuplicatePolicy` is
+        given, operations already present in the previous historics are
+        dropped.
+        """
+        historics = list(historics)
+        if len(historics) == 0:
+            return cls()
+        index = None
+        if policy is not None:
+            with instrumentation.stage("historic.deduplicate",
+                                       sum(len(h) for h in historics[1:])):
+                index = historics[0]._hand_over_index(policy)
+                historics = [historics[0]] + [h[policy.update(index, h)]
+                                              for h in historics[1:]]
+        new_historic = copy.copy(historics[0])
+        for column in cls._COLUMNS:
+            setattr(new_historic, column,
+                    np.concatenate([getattr(h, column) for h in historics]))
+        new_historic._index = None if index is None else (policy, index)
+        new_historic._date_indexes = {}
+        for on, date_index in historics[0]._date_indexes.items():
+            offset = len(historics[0])
+            for historic in historics[1:]:
+                date_index = date_index.concatenate(
+                    historic.date_index(on), offset)
+                offset += len(historic)
+            new_historic._date_indexes[on] = date_index
         return new_historic
 
-    def period_covered(self):
-        oldest = None
-        latest = None
-        for op in self.operations:
-            if oldest is None or op.op_date < oldest:
-                oldest = op.op_date
-            if latest is None or latest < op.op_date:
-                latest = op.op_date
-        return oldest, latest
+    def _hand_over_index(self, policy):
+        # The index moves to the merged historic so that chained merges only
+        # fingerprint the new operations
+        index = self._index
+        self._index = None
+        if index is None or index[0] is not policy:
+            return policy.index(self)
+        return index[1]
 
-    def filter(self, predicate):
-        clone = copy.copy(self)
-        remaining_ops = [op for op in clone.operations if predicate(op)]
-        clone.operations = remaining_ops
-        return clone
+    # ------------------------------------------------------------- Columns #
+    @property
+    def operations(self):
+        return [_build(op) for op in self._operations.tolist()]
+
+    @property
+    def op_dates(self):
+        return self._op_dates
+
+    @property
+    def effective_dates(self):
+        return self._effective_dates
 
-    def clip(self, oldest=None, latest=None):
-        def predicate(operation):
-            return (oldest is None or oldest <= operation.op_date) and \
-                   (latest is None or operation.op_date <= latest)
-        return self.filter(predicate)
+    @property
+    def values(self):
+        return self._values
 
+    @property
+    def account_ids(self):
+        return self._account_ids
 
+    @property
+    def party_ids(self):
+        return self._party_ids
 
+    @property
+    def type_codes(self):
+        return self._type_codes
+
+    def accounts(self):
+        return [ACCOUNT_CODES.decode(code)
+                for code in np.unique(self._account_ids)]
+
+    def date_index(self, on="op_date"):
+        """The `DateIndex` on "op_date" or "effective_date" (built once)"""
+        date_index = self._date_indexes.get(on)
+        if date_index is None:
+            dates = getattr(self, self.__class__._DATE_COLUMNS[on])
+            date_index = DateIndex.build(dates)
+            self._date_indexes[on] = date_index
+        return date_index
+
+    def sort(self, on="op_date"):
+        """Return this historic sorted (stably) on the given date"""
+        order = self.date_index(on).order
+        if order is None:
+            return self[:]
+        new_historic = self._take(order)
+        new_historic._date_indexes[on] = DateIndex(
+            None, getattr(new_historic, self.__class__._DATE_COLUMNS[on]))
+        return new_historic
 
+    # ------------------------------------------------------------ Sequence #
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        for operation in self._operations.tolist():
+            yield _build(operation)
+
+    def _take(self, index):
+        new_historic = copy.copy(self)
+        new_historic._index = None
+        for column in self.__class__._COLUMNS:
+            setattr(new_historic, column, getattr(self, column)[index])
+        new_historic._date_indexes = {}
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                new_historic._date_indexes = {
+                    on: date_index.take_range(start, max(start, stop))
+                    for on, date_index in self._date_indexes.items()}
+        elif isinstance(index, np.ndarray) and index.dtype == bool:
+            new_historic._date_indexes = {
+                on: date_index.take_mask(index)
+                for on, date_index in self._date_indexes.items()}
+        return new_historic
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            operation = _build(self._operations[item])
+            self._operations[item] = operation
+            return operation
+        return self._take(item)
+
+    def merge(self, other_historic, policy=None):
+        """
+        Return a new historic with the operations of `other_historic` which
+        are not already in this one (according to `policy`, by default
+        `duplicate_policy`). Chained merges cost O(k) fingerprints for k new
+        operations.
+        """
+        if policy is None:
+            policy = self.duplicate_policy
+        return self.__class__.concatenate([self, other_historic], policy)
+
+    def period_covered(self, on="op_date"):
+        if len(self) == 0:
+            return None, None
+        sorted_dates = self.date_index(on).sorted_dates
+        return sorted_dates[0].item(), sorted_dates[-1].item()
+
+    def in_out(self):
+        """
+        Return `(money_in, n_in, money_out, n_out)`, where money in are the
+        strictly positive operations and money out all the others.
+        """
+        gains = self._values > 0
+        n_in = int(np.count_nonzero(gains))
+        money_in = float(self._values[gains].sum())
+        money_out = float(self._values[~gains].sum())
+        return money_in, n_in, money_out, len(self) - n_in
+
+    def filter(self, predicate):
+        """
+        Operations for which `predicate` holds. Predicates providing a
+        `mask` (see `predicate.Predicate.mask`) are evaluated on the columns.
+        """
+        with instrumentation.stage("historic.filter", len(self)):
+            stats = instrumentation.current()
+            name = predicate.__class__.__name__
+            mask = None
+            if hasattr(predicate, "mask"):
+                with instrumentation.stage("predicate.mask." + name) as timed:
+                    mask = predicate.mask(self)
+                    if mask is not None:
+                        timed.rows = len(self)
+            vectorized = mask is not None
+            if not vectorized:
+                with instrumentation.stage("predicate.call." + name,
+                                           len(self)):
+                    mask = np.fromiter((bool(predicate(op)) for op in self),
+                                       dtype=bool, count=len(self))
+            if stats is not None:
+                label = getattr(predicate, "label", name)
+                stats.count("filters", "vectorized" if vectorized
+                            else "callable")
+                stats.count("predicate evaluations", label, len(self))
+                stats.count("predicate hits", label,
+                            int(np.count_nonzero(mask)))
+            return self._take(mask)
+
+    def clip(self, oldest=None, latest=None, on="op_date"):
+        """
+        Operations whose date (`on`: "op_date" or "effective_date") lies in
+        [oldest, latest]. On a sorted historic (see `sort`), the result is a
+        view on the same arrays.
+        """
+        date_index = self.date_index(on)
+        lo, hi = date_index.bounds(oldest, latest)
+        if date_index.order is None:
+            return self[lo:hi]
+        rows = np.sort(date_index.order[lo:hi])
+        new_historic = self._take(rows)
+        new_historic._date_indexes[on] = DateIndex(
+            np.searchsorted(rows, date_index.order[lo:hi]),
+            date_index.sorted_dates[lo:hi])
+        return new_historic
@@ -0,0 +1,234 @@
+"""
+Benchmark suite of the parsing, historic and query stages.
+
+A synthetic export (see `synthetic.AxaExportGenerator`) is generated once,
+then each stage is run `repeat` times (after its untimed setup) to measure
+its latency percentiles and throughput, and once more under `tracemalloc`
+for its peak memory. Results are stored as JSON so that runs can be
+compared:
+
+    python -m bank_analysis.benchmark --rows 1000000 --output new.json
+    python -m bank_analysis.benchmark --rows 1000000 --compare old.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+
+from .axa import AxaParser
+from .loader import BulkLoader
+from .predicate import KnownOtherParty, TreePology, ValueRange
+from .query import HierarchicalAnalysis, InOutQuery, SpendingAnalysis
+from .synthetic import AxaExportGenerator
+
+
+class Stage(object):
+    """
+    Parameters
+    ----------
+    name: str
+        Name of the stage
+    run: callable
+        `run(*setup())` is the timed part
+    setup: callable
+        Prepares the arguments of `run` (not timed)
+
+    The operations processed are those of the arguments (historics) or, for
+    stages without arguments, the number returned by `run`.
+    """
+    def __init__(self, name, run, setup=tuple):
+        self.name = name
+        self.run = run
+        self.setup = setup
+
+    def measure(self, repeat=5):
+        latencies = []
+        n_operations = 0
+        for _ in range(repeat):
+            args = self.setup()
+            start = time.perf_counter()
+            result = self.run(*args)
+            latencies.append(time.perf_counter() - start)
+            n_operations = sum(len(arg) for arg in args) if len(args) > 0 \
+                else result
+
+        args = self.setup()
+        tracemalloc.start()
+        try:
+            self.run(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        latencies = np.array(latencies)
+        median = float(np.median(latencies))
+        return OrderedDict([
+            ("n_operations", n_operations),
+            ("repeat", repeat),
+            ("latency_s", OrderedDict(
+                [("min", float(latencies.min())),
+                 ("p50", median),
+                 ("p90", float(np.percentile(latencies, 90))),
+                 ("p99", float(np.percentile(latencies, 99))),
+                 ("mean", float(latencies.mean()))])),
+            ("throughput_ops_per_s",
+             n_operations / median if median > 0 else None),
+            ("peak_memory_bytes", peak)])
+
+
+def _consume(historic):
+    # Build every (deferred) operation
+    return sum(1 for _ in historic)
+
+
+def _decode(operations):
+    # Operations parse their fields lazily: decode those of the columns
+    return sum(1 for operation in operations
+               if operation.op_date is not None
+               and operation.value is not None)
+
+
+def stages(fpath, parser=None):
+    """The benchmarked stages on the export `fpath`"""
+    parser = AxaParser() if parser is None else parser
+
+    def parsed():
+        return parser.parse_csv(fpath, "bench"),
+
+    def with_parties():
+        historic = parser.parse_csv(fpath, "bench")
+        return historic.filter(lambda op: op.get_other_party() is not None),
+
+    def both_halves():
+        historic = parser.parse_csv(fpath, "bench")
+        half = len(historic) // 2
+        # Overlapping halves, as consecutive exports
+        return historic[:half + half // 10], historic[half:]
+
+    oldest, latest = datetime(2016, 1, 1), datetime(2016, 12, 31)
+    shop = KnownOtherParty("DELHAIZE")
+    tree = TreePology("All",
+                      TreePology("Shops", KnownOtherParty("DELHAIZE"),
+                                 KnownOtherParty("COLRUYT")),
+                      KnownOtherParty("SHELL"))
+    spending = SpendingAnalysis(KnownOtherParty("DELHAIZE", "food"),
+                                KnownOtherParty("SHELL", "fuel"))
+
+    return [
+        Stage("parse_csv", lambda: len(parser.parse_csv(fpath, "bench"))),
+        Stage("iter_operations",
+              lambda: _decode(parser.iter_operations(fpath, "bench"))),
+        Stage("bulk_load",
+              lambda: _consume(BulkLoader(parser, n_jobs=1).load([fpath]))),
+        Stage("filter_vectorized",
+              lambda h: h.filter(shop & ValueRange(high=0)), parsed),
+        Stage("filter_callable", lambda h: h.filter(lambda op: shop(op)),
+              parsed),
+        Stage("clip", lambda h: h.clip(oldest, latest), parsed),
+        Stage("merge", lambda a, b: a.merge(b), both_halves),
+        Stage("in_out_query", InOutQuery(), parsed),
+        Stage("spending_analysis", spending, parsed),
+        Stage("hierarchical_analysis",
+              HierarchicalAnalysis(tree, keep_operations=False),
+              with_parties),
+    ]
+
+
+def run(n_rows=100000, repeat=5, seed=0, only=None, directory=None):
+    """
+    Run the suite and return its results (JSON-serializable). The export is
+    generated in `directory` (and kept), or in a temporary directory.
+    """
+    if directory is None:
+        directory = tempfile.mkdtemp()
+        try:
+            return run(n_rows, repeat, seed, only, directory)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    fpath = os.path.join(directory, "axa_{}_{}.csv".format(n_rows, seed))
+    generator = AxaExportGenerator(n_rows, seed=seed)
+    start = time.perf_counter()
+    if not os.path.exists(fpath):
+        generator.write(fpath)
+    generation = time.perf_counter() - start
+
+    results = OrderedDict()
+    for stage in stages(fpath):
+        if only is not None and stage.name not in only:
+            continue
+        results[stage.name] = stage.measure(repeat)
+        print("{:<24} p50 {:8.3f}s  {:>12.0f} ops/s  peak {:8.1f} MiB"
+              "".format(stage.name, results[stage.name]["latency_s"]["p50"],
+                        results[stage.name]["throughput_ops_per_s"] or 0,
+                        results[stage.name]["peak_memory_bytes"] / 2 ** 20),
+              file=sys.stderr)
+
+    return OrderedDict([
+        ("meta", OrderedDict([
+            ("date", datetime.now().isoformat()),
+            ("python", platform.python_version()),
+            ("numpy", np.__version__),
+            ("platform", platform.platform()),
+            ("n_cpus", os.cpu_count()),
+            ("n_rows", n_rows),
+            ("seed", seed),
+            ("file_bytes", os.path.getsize(fpath)),
+            ("generation_s", generation)])),
+        ("stages", results)])
+
+
+def compare(results, reference):
+    """Text table of the median latencies of `results` vs `reference`"""
+    lines = ["{:<24} {:>10} {:>10} {:>8}".format("stage", "ref p50",
+                                                 "p50", "ratio")]
+    for name, stage in results["stages"].items():
+        previous = reference["stages"].get(name)
+        if previous is None:
+            continue
+        old = previous["latency_s"]["p50"]
+        new = stage["latency_s"]["p50"]
+        lines.append("{:<24} {:>9.3f}s {:>9.3f}s {:>7.2f}x"
+                     "".format(name, old, new, new / old if old > 0 else 0))
+    return os.linesep.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100000,
+                        help="Number of operations (up to 10M)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", nargs="*", default=None,
+                        help="Only run these stages")
+    parser.add_argument("--directory", default=None,
+                        help="Where to keep the generated exports")
+    parser.add_argument("--output", default=None, help="JSON results file")
+    parser.add_argument("--compare", default=None,
+                        help="JSON results to compare with")
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter("ignore")
+    results = run(args.rows, args.repeat, args.seed, args.stages,
+                  args.directory)
+    if args.output is not None:
+        with open(args.output, "w") as hdl:
+            json.dump(results, hdl, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as hdl:
+            print(compare(results, json.load(hdl)))
+    elif args.output is None:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
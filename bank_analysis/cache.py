@@ -0,0 +1,265 @@
+"""
+On-disk cache of parsed exports.
+
+Each parsed file (`loader.ParsedFile`) is stored in its own directory in a
+columnar, binary layout: one `.npy` file per numeric column, the raw records
+as a single UTF-8 blob with an offset array, and a small JSON file for the
+per-file tables (account, distinct other parties and operation types, by
+class path and state). Loading a cached file memory-maps the columns
+instead of reparsing it; nothing is unpickled.
+
+Entries are keyed by the file path and content hash (plus the parser,
+account name and encoding). The content is only hashed again when the size
+or modification time of the file changed since it was last hashed. The
+cache is capped in size and evicts the least recently used entries.
+"""
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .base import Entity, Operation, _unpickle_entity
+from .loader import ParsedFile, LoadFailure, parse_file, historic_from_parsed
+
+
+def _class_path(cls):
+    return "{}:{}".format(cls.__module__, cls.__qualname__)
+
+
+def _import_class(path, base):
+    module, _, qualname = path.partition(":")
+    cls = importlib.import_module(module)
+    for name in qualname.split("."):
+        cls = getattr(cls, name)
+    if not isinstance(cls, type) or not issubclass(cls, base):
+        raise ValueError("'{}' is not a {}".format(path, base.__name__))
+    return cls
+
+
+def _encode(obj):
+    """JSON-serializable form of a table entry (entity, class or value)"""
+    if isinstance(obj, Entity):
+        return {"entity": _class_path(obj.__class__),
+                "state": [_encode(x) for x in obj._state()]}
+    if isinstance(obj, type):
+        return {"class": _class_path(obj)}
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    raise TypeError("Cannot store {!r}".format(obj))
+
+
+def _decode(obj):
+    if not isinstance(obj, dict):
+        return obj
+    if "entity" in obj:
+        return _unpickle_entity(_import_class(obj["entity"], Entity),
+                                tuple(_decode(x) for x in obj["state"]))
+    return _import_class(obj["class"], Operation)
+
+
+class RecordTable(object):
+    """Read-only sequence of the records stored in a (mapped) blob"""
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_records(cls, records):
+        encoded = [record.encode("utf-8") for record in records]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in encoded], out=offsets[1:])
+        return cls(b"".join(encoded), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return bytes(self.blob[start:stop]).decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class ParseCache(object):
+    """
+    Parameters
+    ----------
+    directory: str or None
+        Where to store the cache (default: ~/.cache/bank_analysis)
+    max_bytes: int
+        Size above which the least recently used entries are evicted
+    """
+    _COLUMNS = ("line_numbers", "op_dates", "effective_dates", "values",
+                "party_ids", "type_codes")
+
+    def __init__(self, directory=None, max_bytes=1 << 30):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser("~"), ".cache",
+                                     "bank_analysis")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # Absolute path -> [size, mtime, content hash]
+        self._hashes = None
+
+    # ---------------------------------------------------------------- Keys #
+    def _hashes_path(self):
+        return os.path.join(self.directory, "hashes.json")
+
+    def _content_hash(self, fpath):
+        fpath = os.path.abspath(fpath)
+        stat = os.stat(fpath)
+        if self._hashes is None:
+            try:
+                with open(self._hashes_path()) as hdl:
+                    self._hashes = json.load(hdl)
+            except (OSError, ValueError):
+                self._hashes = {}
+        known = self._hashes.get(fpath)
+        if known is not None and known[:2] == [stat.st_size,
+                                               stat.st_mtime_ns]:
+            return known[2]
+
+        digest = hashlib.sha1()
+        with open(fpath, "rb") as hdl:
+            for chunk in iter(lambda: hdl.read(1 << 20), b""):
+                digest.update(chunk)
+        self._hashes[fpath] = [stat.st_size, stat.st_mtime_ns,
+                               digest.hexdigest()]
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "w") as hdl:
+            json.dump(self._hashes, hdl)
+        os.replace(tmp, self._hashes_path())
+        return digest.hexdigest()
+
+    def key(self, parser, fpath, account_name="n/a", encoding="latin"):
+        parts = [os.path.abspath(fpath), self._content_hash(fpath),
+                 "{}.{}".format(parser.__class__.__module__,
+                                parser.__class__.__name__),
+                 account_name, encoding]
+        return hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    # ------------------------------------------------------------- Storage #
+    def get(self, key):
+        """Return the cached `ParsedFile` for `key` (memory-mapped) or None"""
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, "meta.json")) as hdl:
+                meta = json.load(hdl)
+            columns = {name: np.load(os.path.join(entry, name + ".npy"),
+                                     mmap_mode="r")
+                       for name in self.__class__._COLUMNS}
+            offsets = np.load(os.path.join(entry, "offsets.npy"))
+            blob = b""
+            if offsets[-1] > 0:
+                blob = np.memmap(os.path.join(entry, "records.bin"),
+                                 dtype=np.uint8, mode="r")
+            account = _decode(meta["account"])
+            parties = [_decode(party) for party in meta["parties"]]
+            types = [_decode(type) for type in meta["types"]]
+        except (OSError, ValueError, KeyError, TypeError, AttributeError,
+                ImportError):
+            return None
+        os.utime(entry)  # LRU bookkeeping
+        return ParsedFile(meta["fpath"], account, RecordTable(blob, offsets),
+                          parties=parties, types=types, **columns)
+
+    def put(self, key, parsed):
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix=".tmp-")
+        try:
+            for name in self.__class__._COLUMNS:
+                np.save(os.path.join(tmp, name + ".npy"),
+                        getattr(parsed, name))
+            records = parsed.records
+            if not isinstance(records, RecordTable):
+                records = RecordTable.from_records(records)
+            np.save(os.path.join(tmp, "offsets.npy"), records.offsets)
+            with open(os.path.join(tmp, "records.bin"), "wb") as hdl:
+                hdl.write(bytes(records.blob))
+            with open(os.path.join(tmp, "meta.json"), "w") as hdl:
+                # Absolute, so that `invalidate` finds the entries of
+                # files given by relative paths
+                json.dump({"fpath": os.path.abspath(parsed.fpath),
+                           "account": _encode(parsed.account),
+                           "parties": [_encode(party)
+                                       for party in parsed.parties],
+                           "types": [_encode(type)
+                                     for type in parsed.types]}, hdl)
+            entry = self._entry(key)
+            if os.path.exists(entry):
+                shutil.rmtree(entry)
+            os.rename(tmp, entry)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.evict()
+
+    def _entries(self):
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.startswith(".") and os.path.isdir(path):
+                yield path
+
+    def _entry_size(self, entry):
+        return sum(os.path.getsize(os.path.join(entry, name))
+                   for name in os.listdir(entry))
+
+    def size(self):
+        return sum(self._entry_size(entry) for entry in self._entries())
+
+    def evict(self):
+        """Drop the least recently used entries until under `max_bytes`"""
+        entries = sorted((os.path.getmtime(entry), entry, self._entry_size(entry))
+                         for entry in self._entries())
+        total = sum(size for _, _, size in entries)
+        for _, entry, size in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def invalidate(self, fpath=None):
+        """Drop the entries of `fpath` (all entries if None)"""
+        if fpath is not None:
+            fpath = os.path.abspath(fpath)
+        for entry in list(self._entries()):
+            if fpath is not None:
+                try:
+                    with open(os.path.join(entry, "meta.json")) as hdl:
+                        if json.load(hdl)["fpath"] != fpath:
+                            continue
+                except (OSError, ValueError, KeyError):
+                    pass
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def clear(self):
+        self.invalidate()
+
+    # ------------------------------------------------------------- Parsing #
+    def parse(self, parser, fpath, account_name="n/a", encoding="latin"):
+        """Like `loader.parse_file` but going through the cache"""
+        key = self.key(parser, fpath, account_name, encoding)
+        parsed = self.get(key)
+        if parsed is None:
+            parsed = parse_file(parser, os.path.abspath(fpath), account_name,
+                                encoding)
+            if not isinstance(parsed, LoadFailure):
+                self.put(key, parsed)
+        return parsed
+
+    def load(self, parser, fpath, account_name="n/a", encoding="latin"):
+        """Return the `Historic` of `fpath`, reparsing it only if needed"""
+        parsed = self.parse(parser, fpath, account_name, encoding)
+        if isinstance(parsed, LoadFailure):
+            raise ValueError("Could not load '{}':{}{}"
+                             "".format(fpath, os.linesep, parsed.error))
+        return historic_from_parsed(parser, parsed)
@@ -0,0 +1,340 @@
+"""
+Fuzzy clustering of counterparty names.
+
+The same merchant shows up under many slightly different names ("DELHAIZE
+1234 BRUXELLES", "Delhaize Bruxelles", ...). Names are first normalized
+(case, accents, punctuation, numbers), then compared through their sets of
+character n-grams. Comparing every pair is quadratic, so candidate pairs
+are found by MinHash blocking (locality-sensitive hashing): names whose
+signatures agree on a whole band end up in the same bucket. Only those
+candidates are compared (Jaccard similarity of their n-grams) and the
+similar ones are joined into clusters. Each cluster gets a canonical name
+and the result is an `AliasMap`.
+"""
+import json
+import re
+import unicodedata
+import zlib
+
+import numpy as np
+
+from . import instrumentation
+from .base import PARTY_CODES
+
+_NOT_ALNUM = re.compile(r"[^0-9A-Z]+")
+_MASK32 = np.uint64(0xffffffff)
+
+
+def normalize_name(name):
+    """
+    Upper-case `name` without accents, punctuation and purely numeric tokens
+    (store numbers, dates, references)
+    """
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join(char for char in name if not unicodedata.combining(char))
+    tokens = _NOT_ALNUM.sub(" ", name.upper()).split()
+    return " ".join(token for token in tokens if not token.isdigit())
+
+
+def ngrams(text, n=3):
+    """The set of character `n`-grams of `text` (padded with spaces)"""
+    text = " {} ".format(text)
+    if len(text) <= n:
+        return {text}
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def jaccard(a, b):
+    if len(a) == 0 and len(b) == 0:
+        return 1.
+    return len(a & b) / float(len(a | b))
+
+
+def _mix(hashes):
+    # Finalizer of MurmurHash3 (32 bits, on uint64 to avoid overflows)
+    hashes = hashes ^ (hashes >> np.uint64(16))
+    hashes = (hashes * np.uint64(0x85ebca6b)) & _MASK32
+    hashes = hashes ^ (hashes >> np.uint64(13))
+    hashes = (hashes * np.uint64(0xc2b2ae35)) & _MASK32
+    return hashes ^ (hashes >> np.uint64(16))
+
+
+def _components(nodes, neighbours):
+    """Connected components of `nodes` (only going through `nodes`)"""
+    remaining = set(nodes)
+    components = []
+    for node in nodes:
+        if node not in remaining:
+            continue
+        remaining.discard(node)
+        component, stack = [], [node]
+        while len(stack) > 0:
+            current = stack.pop()
+            component.append(current)
+            for neighbour in neighbours[current]:
+                if neighbour in remaining:
+                    remaining.discard(neighbour)
+                    stack.append(neighbour)
+        components.append(component)
+    return components
+
+
+class AliasMap(object):
+    """
+    Map from the names of counterparties to the canonical name of their
+    cluster. Names which are not in the map are their own canonical name.
+    """
+    def __init__(self):
+        self._canonical = {}
+        # Canonical name -> the other names of its cluster
+        self._aliases = {}
+
+    def add(self, alias, canonical):
+        """Merge the cluster of `alias` into the one of `canonical`"""
+        source = self.canonical(alias)
+        target = self.canonical(canonical)
+        if source == target:
+            return
+        moved = [source] + self._aliases.pop(source, [])
+        for name in moved:
+            self._canonical[name] = target
+        self._aliases.setdefault(target, []).extend(moved)
+        self._canonical[target] = target
+
+    def canonical(self, name):
+        return self._canonical.get(name, name)
+
+    def aliases(self, name):
+        """All the names of the cluster of `name`, canonical name first"""
+        canonical = self.canonical(name)
+        return [canonical] + self._aliases.get(canonical, [])
+
+    def clusters(self):
+        """Dict canonical name -> its aliases (clusters of several names)"""
+        return {canonical: list(aliases)
+                for canonical, aliases in self._aliases.items()
+                if len(aliases) > 0}
+
+    def __contains__(self, name):
+        return name in self._canonical
+
+    def __len__(self):
+        """Number of names with a canonical name other than themselves"""
+        return sum(len(aliases) for aliases in self._aliases.values())
+
+    # -------------------------------------------------------- Persistence #
+    def save(self, fpath):
+        """Save as JSON (canonical name -> aliases), which can be edited"""
+        with open(fpath, "w") as hdl:
+            json.dump(self.clusters(), hdl, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, fpath):
+        alias_map = cls()
+        with open(fpath) as hdl:
+            for canonical, aliases in json.load(hdl).items():
+                for alias in aliases:
+                    alias_map.add(alias, canonical)
+        return alias_map
+
+
+class CounterpartyClusterer(object):
+    """
+    Parameters
+    ----------
+    threshold: float
+        Minimal Jaccard similarity of the n-grams of two (normalized) names
+        for them to be joined
+    n: int
+        Length of the character n-grams
+    n_hashes: int
+        Length of the MinHash signatures
+    n_bands: int
+        Number of bands the signatures are cut into (must divide
+        `n_hashes`). With r = n_hashes / n_bands, two names of similarity s
+        are candidates with probability 1 - (1 - s^r)^n_bands
+    max_bucket: int
+        Names of larger buckets (band values shared by many names) are only
+        compared to the first name of the bucket rather than pairwise
+    min_prefix: int or None
+        Names are also blocked on their first word, and two names are
+        similar as well if the words of one of them (at least `min_prefix`
+        characters) start the other one, such as a merchant and the same
+        merchant followed by a place. None to only rely on the n-grams
+    seed: int
+        Seed of the hash functions
+
+    Clusters start as the connected components of the similar pairs, but
+    each name of a cluster must be similar to its canonical name (its most
+    frequent name): the other names are split off and clustered again among
+    themselves. A chain such as "PAYPAL EBAY" - "PAYPAL" - "PAYPAL SPOTIFY"
+    thus only joins its ends if they are similar to each other or if
+    "PAYPAL" is the canonical name.
+    """
+    def __init__(self, threshold=.5, n=3, n_hashes=100, n_bands=25,
+                 max_bucket=50, min_prefix=4, seed=0):
+        if n_hashes % n_bands != 0:
+            raise ValueError("The number of bands ({}) must divide the "
+                             "number of hashes ({})".format(n_bands, n_hashes))
+        self.threshold = threshold
+        self.n = n
+        self.n_hashes = n_hashes
+        self.n_bands = n_bands
+        self.max_bucket = max_bucket
+        self.min_prefix = min_prefix
+        rng = np.random.RandomState(seed)
+        self._seeds = rng.randint(0, 2 ** 32, size=n_hashes,
+                                  dtype=np.int64).astype(np.uint64)
+
+    def signatures(self, ngram_sets):
+        """MinHash signatures (one row per non-empty set of n-grams)"""
+        lengths = np.array([len(ngram_set) for ngram_set in ngram_sets],
+                           dtype=np.int64)
+        signatures = np.zeros((len(ngram_sets), self.n_hashes),
+                              dtype=np.uint32)
+        if len(ngram_sets) == 0:
+            return signatures
+        hashes = np.fromiter((zlib.crc32(ngram.encode("utf-8"))
+                              for ngram_set in ngram_sets
+                              for ngram in ngram_set),
+                             dtype=np.uint64, count=int(lengths.sum()))
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        for i, seed in enumerate(self._seeds):
+            signatures[:, i] = np.minimum.reduceat(_mix(hashes ^ seed),
+                                                   starts)
+        return signatures
+
+    def _add_buckets(self, pairs, keys):
+        # Pairs of the rows sharing a key
+        _, inverse, counts = np.unique(keys, return_inverse=True,
+                                       return_counts=True)
+        shared = np.flatnonzero(counts[inverse] > 1)
+        if len(shared) == 0:
+            return
+        shared = shared[np.argsort(inverse[shared], kind="stable")]
+        cuts = np.flatnonzero(np.diff(inverse[shared])) + 1
+        for bucket in np.split(shared, cuts):
+            bucket = bucket.tolist()
+            if len(bucket) > self.max_bucket:
+                pairs.update((bucket[0], j) for j in bucket[1:])
+                continue
+            for k, i in enumerate(bucket):
+                pairs.update((i, j) for j in bucket[k + 1:])
+
+    def candidate_pairs(self, signatures, first_words=None):
+        """
+        The set of `(i, j)`, i < j, of rows agreeing on some band (or with
+        the same first word)
+        """
+        rows = self.n_hashes // self.n_bands
+        pairs = set()
+        for band in range(self.n_bands):
+            block = np.ascontiguousarray(
+                signatures[:, band * rows:(band + 1) * rows])
+            keys = block.view(np.dtype((np.void, block.itemsize * rows)))
+            self._add_buckets(pairs, keys.ravel())
+        if first_words is not None and len(first_words) > 0:
+            self._add_buckets(pairs, np.array(first_words, dtype=object))
+        return pairs
+
+    def similar(self, form, other_form, ngram_set, other_ngram_set):
+        """Whether two normalized names (and their n-grams) are similar"""
+        if jaccard(ngram_set, other_ngram_set) >= self.threshold:
+            return True
+        if self.min_prefix is None:
+            return False
+        short, long = sorted((form, other_form), key=len)
+        return len(short) >= self.min_prefix and \
+            long.startswith(short + " ")
+
+    def cluster(self, names, weights=None):
+        """
+        Return the `AliasMap` of the clusters of `names` (weighted by
+        `weights`, e.g. their numbers of operations, for the choice of the
+        canonical names)
+        """
+        names = list(names)
+        weights = [1] * len(names) if weights is None else list(weights)
+        # Names with the same normalized form are clustered at once
+        forms = {}
+        for i, name in enumerate(names):
+            form = normalize_name(name)
+            if len(form) > 0:
+                forms.setdefault(form, []).append(i)
+        forms = list(forms.items())
+        ngram_sets = [ngrams(form, self.n) for form, _ in forms]
+
+        with instrumentation.stage("clustering.minhash", len(forms)):
+            signatures = self.signatures(ngram_sets)
+        first_words = None
+        if self.min_prefix is not None:
+            first_words = [form.split(" ", 1)[0] for form, _ in forms]
+        with instrumentation.stage("clustering.blocking", len(forms)):
+            pairs = self.candidate_pairs(signatures, first_words)
+
+        neighbours = [[] for _ in forms]
+        n_joined = 0
+        with instrumentation.stage("clustering.verify", len(pairs)):
+            for i, j in pairs:
+                if self.similar(forms[i][0], forms[j][0], ngram_sets[i],
+                                ngram_sets[j]):
+                    n_joined += 1
+                    neighbours[i].append(j)
+                    neighbours[j].append(i)
+
+        def best(indices):
+            # Most frequent, then shortest name
+            return min(indices, key=lambda i: (-weights[i], len(names[i]),
+                                               names[i]))
+
+        alias_map = AliasMap()
+        n_split = 0
+        pending = _components(range(len(forms)), neighbours)
+        while len(pending) > 0:
+            component = pending.pop()
+            canonical = best([i for k in component for i in forms[k][1]])
+            center = next(k for k in component if canonical in forms[k][1])
+            members, others = [], []
+            for k in component:
+                if k == center or self.similar(
+                        forms[center][0], forms[k][0], ngram_sets[center],
+                        ngram_sets[k]):
+                    members.append(k)
+                else:
+                    others.append(k)
+            if len(others) > 0:
+                n_split += len(others)
+                pending.extend(_components(others, neighbours))
+            for k in members:
+                for i in forms[k][1]:
+                    alias_map.add(names[i], names[canonical])
+
+        stats = instrumentation.current()
+        if stats is not None:
+            stats.count("clustering", "names", len(names))
+            stats.count("clustering", "candidate pairs", len(pairs))
+            stats.count("clustering", "joined pairs", n_joined)
+            stats.count("clustering", "split names", n_split)
+        return alias_map
+
+    def cluster_historic(self, historic):
+        """Clusters of the names of the other parties of `historic`"""
+        codes, counts = np.unique(historic.party_ids, return_counts=True)
+        weights = {}
+        for code, count in zip(codes.tolist(), counts.tolist()):
+            party = PARTY_CODES.decode(code)
+            if party is not None:
+                weights[party.name] = weights.get(party.name, 0) + count
+        return self.cluster(weights.keys(), weights.values())
+
+    def cluster_node(self, node):
+        """
+        Clusters of the names of the entities of an `EntityMatchingNode`,
+        such as the unknown entities of a `HierarchicalAnalysis`
+        """
+        weights = {}
+        for entity, child in node.entity_node_dict.items():
+            if entity is not None:
+                weights[entity.name] = weights.get(entity.name, 0) + \
+                    child.n_operations
+        return self.cluster(weights.keys(), weights.values())
@@ -0,0 +1,121 @@
+"""
+Date parsing with a fixed-layout fast path.
+
+Bank exports use a single, known date layout and repeat the same few
+hundred dates over thousands of rows. A `DateParser` is therefore given the
+`strptime`-like layout of the bank (e.g. "%d/%m/%Y"), slices the fields
+directly out of the string and memoizes the result (in a bounded LRU
+cache). Strings which do not follow the layout are handed to `dateutil`.
+
+As with `strptime`, two-digit years ("%y") from 69 to 99 are in the 1900s
+and the others in the 2000s (see `DateParser.SHORT_YEAR_PIVOT`).
+"""
+from datetime import datetime
+from functools import lru_cache
+
+from dateutil.parser import parse as auto_parse_date
+
+
+class DateParser(object):
+    # directive -> (width, field)
+    DIRECTIVES = {
+        "d": (2, "day"),
+        "m": (2, "month"),
+        "Y": (4, "year"),
+        "y": (2, "year"),
+    }
+    # Two-digit years below are in the 2000s, the others in the 1900s
+    SHORT_YEAR_PIVOT = 69
+
+    def __init__(self, date_format=None, cache_size=4096):
+        self.date_format = date_format
+        self.cache_size = cache_size
+        self.parse = lru_cache(maxsize=cache_size)(self._parse)
+        self._layout = None
+        self._length = 0
+        self._dayfirst = False
+        if date_format is not None:
+            self._compile(date_format)
+
+    def _compile(self, date_format):
+        layout = []  # (start, stop, field or None, literal)
+        position = 0
+        i = 0
+        while i < len(date_format):
+            char = date_format[i]
+            if char == "%" and i + 1 < len(date_format):
+                directive = date_format[i + 1]
+                if directive not in self.__class__.DIRECTIVES:
+                    raise ValueError("Unsupported directive '%{}' in date "
+                                     "format '{}'".format(directive,
+                                                          date_format))
+                width, field = self.__class__.DIRECTIVES[directive]
+                if directive == "y":
+                    field = "short_year"
+                layout.append((position, position + width, field, None))
+                position += width
+                i += 2
+            else:
+                layout.append((position, position + 1, None, char))
+                position += 1
+                i += 1
+        self._layout = layout
+        self._length = position
+        fields = [field for _, _, field, _ in layout]
+        if "day" in fields and "month" in fields:
+            self._dayfirst = fields.index("day") < fields.index("month")
+
+    def _parse_layout(self, date_str):
+        if len(date_str) != self._length:
+            return None
+        values = {"year": 1900, "month": 1, "day": 1}
+        for start, stop, field, literal in self._layout:
+            chunk = date_str[start:stop]
+            if field is None:
+                if chunk != literal:
+                    return None
+            elif not chunk.isdigit():
+                return None
+            elif field == "short_year":
+                year = int(chunk)
+                values["year"] = year + (
+                    2000 if year < self.__class__.SHORT_YEAR_PIVOT else 1900)
+            else:
+                values[field] = int(chunk)
+        try:
+            return datetime(values["year"], values["month"], values["day"])
+        except ValueError:
+            return None
+
+    def _parse(self, date_str):
+        # Memoized as `parse`
+        date = None
+        if self._layout is not None:
+            date = self._parse_layout(date_str.strip())
+        if date is None:
+            # Year-first strings (ISO-like) are never day-first
+            dayfirst = self._dayfirst and not date_str.strip()[:4].isdigit()
+            date = auto_parse_date(date_str, dayfirst=dayfirst)
+        return date
+
+    def __call__(self, date_str):
+        return self.parse(date_str)
+
+    def __reduce__(self):
+        # The cache is not pickled
+        return self.__class__, (self.date_format, self.cache_size)
+
+    def clear_cache(self):
+        self.parse.cache_clear()
+
+
+_parsers = {}
+
+
+def get_date_parser(date_format=None):
+    """Return the (shared, memoizing) parser for the given layout"""
+    parser = _parsers.get(date_format)
+    if parser is None:
+        parser = DateParser(date_format)
+        _parsers[date_format] = parser
+    return parser
@@ -0,0 +1,246 @@
+"""
+Opt-in instrumentation of the parsing, historic and query stages.
+
+Nothing is recorded unless a `profiling` block is active:
+
+    with profiling(memory=True) as stats:
+        historic = AxaParser().parse_csv(fpath)
+        print(HierarchicalAnalysis(tree)(historic))
+    print(stats.to_text())
+
+The `Stats` collect the wall time, number of calls and number of rows of
+each stage (stages may nest, e.g. "records.scan" runs within
+"axa.split_records"), named counters (such as the unknown operation types)
+and, for each leaf of the trees reported by a `HierarchicalAnalysis`, how
+many operations its predicate was actually evaluated on (a compiled tree
+skips those of the wrong other party) and how many it kept. `Historic.filter`
+times its predicates by stage ("predicate.mask.<class>" or
+"predicate.call.<class>") and counts their evaluations and hits. With
+`memory`, the allocation peak of each stage is traced as well (which slows
+everything down).
+
+The `Stats` being recorded are held in a context variable: threads and
+asyncio tasks record in their own block (or not at all). Allocations are
+traced for the whole process, though, so the peaks of concurrent blocks
+include each other's.
+
+When no block is active, `stage` hands out a shared no-op context and the
+per-operation loops are those of the uninstrumented code, so that the cost
+is a few function calls per stage.
+"""
+import json
+import os
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_current = ContextVar("bank_analysis_stats", default=None)
+
+
+def current():
+    """The `Stats` being recorded (in this context), or None"""
+    return _current.get()
+
+
+class _NoStage(object):
+    __slots__ = ()
+    # Setting the rows is a no-op
+    rows = property(lambda self: None, lambda self, rows: None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name, rows=None):
+    """
+    Context timing the stage `name` (if profiling). The number of rows
+    processed can be given or set on the context before leaving it.
+    """
+    stats = _current.get()
+    if stats is None:
+        return _NO_STAGE
+    return stats.stage(name, rows)
+
+
+class StageStats(object):
+    __slots__ = ("calls", "wall_s", "rows", "peak_bytes")
+
+    def __init__(self):
+        self.calls = 0
+        self.wall_s = 0.
+        self.rows = 0
+        self.peak_bytes = None
+
+    def as_dict(self):
+        return OrderedDict([("calls", self.calls), ("wall_s", self.wall_s),
+                            ("rows", self.rows),
+                            ("rows_per_s", self.rows / self.wall_s
+                             if self.wall_s > 0 and self.rows > 0
+                             else None),
+                            ("peak_bytes", self.peak_bytes)])
+
+
+class _Stage(object):
+    def __init__(self, stats, name, rows):
+        self.stats = stats
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        if self.stats.memory:
+            self.stats._enter_memory()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.perf_counter() - self.start
+        peak = self.stats._exit_memory() if self.stats.memory else None
+        self.stats.add(self.name, elapsed, self.rows or 0, peak)
+        return False
+
+
+class Stats(object):
+    """
+    Parameters
+    ----------
+    memory: bool
+        Whether to trace the allocation peak of each stage (`tracemalloc`)
+    """
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.stages = OrderedDict()
+        # Group -> Counter
+        self.counters = OrderedDict()
+        # Path of the leaf (labels from the root) -> [reached, hits]
+        self.leaves = OrderedDict()
+        # [memory when entering, peak so far] of the running stages
+        self._memory_stack = []
+
+    def stage(self, name, rows=None):
+        return _Stage(self, name, rows)
+
+    def add(self, name, wall_s, rows=0, peak_bytes=None, calls=1):
+        """Account for `calls` runs of the stage `name`"""
+        stage_stats = self.stages.get(name)
+        if stage_stats is None:
+            stage_stats = StageStats()
+            self.stages[name] = stage_stats
+        stage_stats.calls += calls
+        stage_stats.wall_s += wall_s
+        stage_stats.rows += rows
+        if peak_bytes is not None:
+            stage_stats.peak_bytes = max(stage_stats.peak_bytes or 0,
+                                         peak_bytes)
+
+    def count(self, group, key, n=1):
+        counter = self.counters.get(group)
+        if counter is None:
+            counter = Counter()
+            self.counters[group] = counter
+        counter[key] += n
+
+    def add_leaf(self, path, reached, hits):
+        counts = self.leaves.setdefault(tuple(path), [0, 0])
+        counts[0] += reached
+        counts[1] += hits
+
+    # ------------------------------------------------------------- Memory #
+    def _enter_memory(self):
+        current_bytes, peak = tracemalloc.get_traced_memory()
+        if len(self._memory_stack) > 0:
+            # The peak is reset for the new stage: save the enclosing one's
+            self._memory_stack[-1][1] = max(self._memory_stack[-1][1], peak)
+        self._memory_stack.append([current_bytes, current_bytes])
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+    def _exit_memory(self):
+        start_bytes, peak = self._memory_stack.pop()
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        if len(self._memory_stack) > 0:
+            self._memory_stack[-1][1] = max(self._memory_stack[-1][1], peak)
+        return max(peak - start_bytes, 0)
+
+    # --------------------------------------------------------------- Dump #
+    def as_dict(self):
+        return OrderedDict([
+            ("stages", OrderedDict((name, stage_stats.as_dict())
+                                   for name, stage_stats
+                                   in self.stages.items())),
+            ("counters", OrderedDict((group, dict(counter))
+                                     for group, counter
+                                     in self.counters.items())),
+            ("leaves", [OrderedDict([("path", list(path)),
+                                     ("reached", reached),
+                                     ("hits", hits)])
+                        for path, (reached, hits)
+                        in self.leaves.items()])])
+
+    def to_json(self, fpath=None, indent=2):
+        """The JSON dump of the stats (also written to `fpath` if given)"""
+        dump = json.dumps(self.as_dict(), indent=indent)
+        if fpath is not None:
+            with open(fpath, "w") as hdl:
+                hdl.write(dump)
+        return dump
+
+    def to_text(self):
+        lines = ["{:<36} {:>6} {:>10} {:>10} {:>12} {:>10}"
+                 "".format("stage", "calls", "wall (s)", "rows", "rows/s",
+                           "peak (MiB)")]
+        for name, stage_stats in self.stages.items():
+            rate = stage_stats.as_dict()["rows_per_s"]
+            lines.append("{:<36} {:>6d} {:>10.4f} {:>10d} {:>12} {:>10}"
+                         "".format(name, stage_stats.calls,
+                                   stage_stats.wall_s, stage_stats.rows,
+                                   "-" if rate is None
+                                   else "{:.0f}".format(rate),
+                                   "-" if stage_stats.peak_bytes is None
+                                   else "{:.1f}".format(
+                                       stage_stats.peak_bytes / 2 ** 20)))
+        for group, counter in self.counters.items():
+            lines.append("")
+            lines.append("{} ({} in total)".format(group,
+                                                   sum(counter.values())))
+            for key, n in counter.most_common():
+                lines.append("  {}: {}".format(key, n))
+        if len(self.leaves) > 0:
+            lines.append("")
+            lines.append("{:<48} {:>12} {:>10}".format("leaf", "reached",
+                                                       "hits"))
+            for path, (reached, hits) in self.leaves.items():
+                lines.append("{:<48} {:>12d} {:>10d}"
+                             "".format(" / ".join(str(label)
+                                                  for label in path),
+                                       reached, hits))
+        return os.linesep.join(lines)
+
+    def __str__(self):
+        return self.to_text()
+
+
+@contextmanager
+def profiling(memory=False):
+    """
+    Record the `Stats` of what runs in the block (in this context). Blocks
+    can nest; the inner one records on its own.
+    """
+    stats = Stats(memory)
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+        if started_tracing:
+            tracemalloc.stop()
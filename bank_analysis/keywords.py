@@ -0,0 +1,88 @@
+"""
+Multi-pattern substring search (Aho-Corasick).
+
+All the patterns are compiled into a single automaton which finds every
+occurrence of any of them in one pass over the text, whatever the number of
+patterns.
+"""
+from collections import deque
+
+
+class Automaton(object):
+    """
+    Parameters
+    ----------
+    patterns: iterable of str
+        The (non-empty) patterns, identified by their position
+    case_sensitive: bool
+        Whether the matching is case sensitive
+    """
+    def __init__(self, patterns, case_sensitive=False):
+        self.case_sensitive = case_sensitive
+        self.patterns = [pattern if case_sensitive else pattern.lower()
+                         for pattern in patterns]
+        if any(len(pattern) == 0 for pattern in self.patterns):
+            raise ValueError("Patterns cannot be empty")
+        # Trie: `_delta[state]` maps a character to the next state
+        self._delta = [{}]
+        self._outputs = [()]
+        for i, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                next_state = self._delta[state].get(char)
+                if next_state is None:
+                    next_state = len(self._delta)
+                    self._delta.append({})
+                    self._outputs.append(())
+                    self._delta[state][char] = next_state
+                state = next_state
+            self._outputs[state] += (i,)
+        self._link()
+
+    def _link(self):
+        # Breadth-first computation of the failure links, folded into the
+        # transitions so that scanning is one dict lookup per character
+        trie = [dict(transitions) for transitions in self._delta]
+        fail = [0] * len(trie)
+        queue = deque(trie[0].values())
+        while queue:
+            state = queue.popleft()
+            self._outputs[state] += self._outputs[fail[state]]
+            for char, next_state in trie[state].items():
+                queue.append(next_state)
+                fail[next_state] = self._delta[fail[state]].get(char, 0) \
+                    if state != 0 else 0
+            if state != 0:
+                # Missing transitions are those of the failure state
+                transitions = dict(self._delta[fail[state]])
+                transitions.update(trie[state])
+                self._delta[state] = transitions
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def iter_matches(self, text):
+        """Yield `(end, pattern)` for each occurrence of a pattern in `text`"""
+        if not self.case_sensitive:
+            text = text.lower()
+        delta = self._delta
+        outputs = self._outputs
+        state = 0
+        for end, char in enumerate(text, 1):
+            state = delta[state].get(char, 0)
+            for pattern in outputs[state]:
+                yield end, pattern
+
+    def matches(self, text):
+        """The sorted positions of the patterns occurring in `text`"""
+        if not self.case_sensitive:
+            text = text.lower()
+        delta = self._delta
+        outputs = self._outputs
+        found = set()
+        state = 0
+        for char in text:
+            state = delta[state].get(char, 0)
+            if outputs[state]:
+                found.update(outputs[state])
+        return sorted(found)
@@ -0,0 +1,195 @@
+"""
+Bulk loading of many exports at once.
+
+Files are parsed in a pool of processes. Each worker sends back a compact,
+columnar view of its file (raw records, dates and values as numpy arrays,
+and small per-file tables of the distinct other parties and operation
+types) rather than pickled operations. The main process turns those into a
+single `Historic`, whose operations are only built when accessed.
+"""
+import glob
+import os
+import traceback
+import warnings
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .axa import AxaParser
+from .base import Codebook, Deferred, Entity, Historic, ACCOUNT_CODES, \
+    PARTY_CODES, TYPE_CODES, ENTITIES
+
+ParsedFile = namedtuple("ParsedFile", ["fpath", "account", "records",
+                                       "line_numbers", "op_dates",
+                                       "effective_dates", "values",
+                                       "party_ids", "parties", "type_codes",
+                                       "types"])
+
+LoadFailure = namedtuple("LoadFailure", ["fpath", "error"])
+
+
+def parse_file(parser, fpath, account_name="n/a", encoding="latin"):
+    """Parse `fpath` into a `ParsedFile` (or a `LoadFailure`)"""
+    try:
+        account = None
+        records = []
+        line_numbers = []
+        op_dates = []
+        effective_dates = []
+        values = []
+        parties = Codebook()
+        party_ids = []
+        types = Codebook()
+        type_codes = []
+        for account, line_number, record in parser.iter_records(fpath,
+                                                                account_name,
+                                                                encoding):
+            operation = parser.parse_record(record, line_number, account)
+            records.append(record)
+            line_numbers.append(line_number)
+            op_dates.append(operation.op_date)
+            effective_dates.append(operation.effective_date)
+            values.append(operation.value)
+            party_ids.append(parties.encode(operation.get_other_party()))
+            type_codes.append(types.encode(operation.__class__))
+
+        return ParsedFile(fpath, account, records,
+                          np.array(line_numbers, dtype=np.int32),
+                          np.array(op_dates, dtype="datetime64[us]"),
+                          np.array(effective_dates, dtype="datetime64[us]"),
+                          np.array(values, dtype=np.float64),
+                          np.array(party_ids, dtype=np.int32),
+                          [parties.decode(i) for i in range(len(parties))],
+                          np.array(type_codes, dtype=np.int32),
+                          [types.decode(i) for i in range(len(types))])
+    except Exception:
+        return LoadFailure(fpath, traceback.format_exc())
+
+
+def _parse_file_star(args):
+    return parse_file(*args)
+
+
+def _parse_stored_record(parser, records, i, line_number, account):
+    return parser.parse_record(records[i], line_number, account)
+
+
+def historic_from_parsed(parser, parsed):
+    """Turn a `ParsedFile` into an `Historic` of deferred operations"""
+    if len(parsed.records) == 0:
+        return Historic()
+    # Entities unpickled from the workers (or the cache) are new copies
+    account = ENTITIES.canonical(parsed.account)
+    parties = [ENTITIES.canonical(party) if isinstance(party, Entity)
+               else party for party in parsed.parties]
+    account_id = ACCOUNT_CODES.encode(account)
+    party_map = np.array([PARTY_CODES.encode(party) for party in parties],
+                         dtype=np.int32)
+    type_map = np.array([TYPE_CODES.encode(type)
+                         for type in parsed.types], dtype=np.int32)
+    operations = [Deferred(_parse_stored_record, parser, parsed.records, i,
+                           line_number, account)
+                  for i, line_number in enumerate(parsed.line_numbers.tolist())]
+    return Historic.from_columns(
+        operations, parsed.op_dates, parsed.effective_dates, parsed.values,
+        np.full(len(operations), account_id, dtype=np.int32),
+        party_map[parsed.party_ids], type_map[parsed.type_codes])
+
+
+class BulkLoader(object):
+    """
+    Load many exports into a single `Historic`.
+
+    Parameters
+    ----------
+    parser:
+        The bank parser (default: `AxaParser()`). It must provide
+        `iter_records` and `parse_record` and be picklable.
+    n_jobs: int or None
+        Number of worker processes (default: the number of cores). With 1,
+        the files are parsed in the current process.
+    encoding: str
+        Encoding of the files
+    duplicate_policy: DuplicatePolicy or None
+        If given, operations found in several (overlapping) files are only
+        kept once. Note that fingerprinting builds the operations.
+    cache: cache.ParseCache or None
+        If given, unchanged files are read back from the cache and only the
+        others are parsed (and then stored).
+
+    Failures of individual files do not stop the others: they are warned
+    about and gathered in `failures` (a list of `LoadFailure`).
+    """
+    def __init__(self, parser=None, n_jobs=None, encoding="latin",
+                 duplicate_policy=None, cache=None):
+        self.parser = AxaParser() if parser is None else parser
+        self.n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+        self.encoding = encoding
+        self.duplicate_policy = duplicate_policy
+        self.cache = cache
+        self.failures = []
+
+    def _account_name(self, account_names, fpath):
+        if account_names is None:
+            return "n/a"
+        if callable(account_names):
+            return account_names(fpath)
+        return account_names.get(fpath, "n/a")
+
+    def _parse_all(self, jobs):
+        if self.n_jobs == 1 or len(jobs) <= 1:
+            return [_parse_file_star(job) for job in jobs]
+        n_workers = min(self.n_jobs, len(jobs))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            return list(executor.map(_parse_file_star, jobs))
+
+    def load(self, fpaths, account_names=None):
+        """
+        Parameters
+        ----------
+        fpaths: str or iterable of str
+            The files to load, or a glob pattern
+        account_names: dict, callable or None
+            The account name of each file, either as a mapping from path or
+            as a function of the path (default: "n/a")
+
+        Return
+        ------
+        historic: Historic
+            The operations of all the files which could be parsed
+        """
+        if isinstance(fpaths, str):
+            fpaths = sorted(glob.glob(fpaths))
+        jobs = [(self.parser, fpath,
+                 self._account_name(account_names, fpath), self.encoding)
+                for fpath in fpaths]
+
+        results = [None] * len(jobs)
+        keys = [None] * len(jobs)
+        if self.cache is not None:
+            for i, job in enumerate(jobs):
+                try:
+                    keys[i] = self.cache.key(*job)
+                    results[i] = self.cache.get(keys[i])
+                except Exception:
+                    # E.g. a missing file: fail it alone
+                    results[i] = LoadFailure(job[1], traceback.format_exc())
+        missing = [i for i, result in enumerate(results) if result is None]
+        parsed = self._parse_all([jobs[i] for i in missing])
+        for i, result in zip(missing, parsed):
+            results[i] = result
+            if self.cache is not None and not isinstance(result, LoadFailure):
+                self.cache.put(keys[i], result)
+
+        self.failures = []
+        historics = []
+        for result in results:
+            if isinstance(result, LoadFailure):
+                warnings.warn("Could not load '{}':{}{}"
+                              "".format(result.fpath, os.linesep,
+                                        result.error))
+                self.failures.append(result)
+            else:
+                historics.append(historic_from_parsed(self.parser, result))
+        return Historic.concatenate(historics, self.duplicate_policy)
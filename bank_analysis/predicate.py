@@ -1,11 +1,34 @@
+import copy
 import os
+import re
+import time
+import weakref
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+
+import numpy as np
 
 from bank_analysis.axa import Payment
-from bank_analysis.base import Account, Entity
+from bank_analysis.base import Account, Entity, PARTY_CODES, TYPE_CODES
+from bank_analysis.keywords import Automaton
+
+
+def party_key(operation):
+    """Hashable key of the other party of `operation` (see `dispatch_keys`)"""
+    other_party = operation.get_other_party()
+    if other_party is None:
+        return None
+    if isinstance(other_party, Account):
+        return "iban", other_party.normalized_iban
+    return "name", other_party.name
 
 
 class Predicate(object, metaclass=ABCMeta):
+    # Whether the operations satisfying the predicate fall under different
+    # labels (see `label_of`); such predicates also provide `label_array`
+    # and `rule` (see `KeywordClassifier`)
+    multi_label = False
+
     def __init__(self, label=None):
         if label is None:
             label = self.__class__.__name__
@@ -17,10 +40,66 @@ class Predicate(object, metaclass=ABCMeta):
             return other_party.name
         return other_party
 
+    def dispatch_keys(self):
+        """
+        The `party_key`s of the operations this predicate can hold for, or
+        None if it must be evaluated on every operation. Used to look the
+        predicate up in a `PredicateIndex`.
+        """
+        return None
+
+    def matching_party(self):
+        """
+        The entity the other party of an operation must be equal to for this
+        predicate to hold, or None if the predicate is not such an equality.
+        Lets stores evaluate the predicate on their party index.
+        """
+        return None
+
+    def matching_parties(self):
+        """
+        Like `matching_party`, for predicates holding if the other party is
+        equal to any of several entities: the tuple of those, or None
+        """
+        party = self.matching_party()
+        return None if party is None else (party,)
+
+    @property
+    def children(self):
+        """The predicates this one is made of (see `And`, `Or`, `Not`)"""
+        return ()
+
+    def mask(self, historic):
+        """
+        Boolean mask of the operations of `historic` for which the predicate
+        holds, computed on its columns, or None if the predicate must be
+        evaluated operation by operation.
+        """
+        parties = self.matching_parties()
+        if parties is None:
+            return None
+        codes = np.unique(historic.party_ids)
+        matching = [code for code in codes.tolist()
+                    if PARTY_CODES.decode(code) in parties]
+        return np.isin(historic.party_ids, matching)
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
     @property
     def label(self):
         return self._label
 
+    def label_of(self, operation):
+        """The label `operation` falls under (given the predicate holds)"""
+        return self.label
+
     def fall_under_label(self, operation):
         """Whether this `Label` instance is a label for operation `operation`"""
         return False
@@ -37,6 +116,15 @@ class EntityPredicate(Predicate):
     def fall_under_label(self, operation):
         return operation.get_other_party() == self.entity
 
+    def dispatch_keys(self):
+        keys = [("name", self.entity.name)]
+        if isinstance(self.entity, Account):
+            keys.append(("iban", self.entity.normalized_iban))
+        return keys
+
+    def matching_party(self):
+        return self.entity
+
 
 class Default(Predicate):
     @property
@@ -46,14 +134,40 @@ class Default(Predicate):
     def fall_under_label(self, operation):
         return True
 
+    def mask(self, historic):
+        return np.ones(len(historic), dtype=bool)
+
 
 class KnownOtherParty(Predicate):
-    def __init__(self, other_party, short_name=None):
+    """
+    With an `clustering.AliasMap`, the predicate also holds for the other
+    names of the cluster of `other_party`.
+    """
+    def __init__(self, other_party, short_name=None, aliases=None):
         super().__init__(other_party if short_name is None else short_name)
-        self.other_party = Entity(other_party)
+        self.other_party = Entity.interned(other_party)
+        names = [other_party] if aliases is None \
+            else aliases.aliases(other_party)
+        self.other_parties = tuple(Entity.interned(name) for name in names)
 
     def fall_under_label(self, operation):
-        return self.from_operation_to_name(operation) == self.other_party
+        name = self.from_operation_to_name(operation)
+        if len(self.other_parties) == 1:
+            return name == self.other_party
+        return name in self.other_parties
+
+    def dispatch_keys(self):
+        return [("name", other_party.name)
+                for other_party in self.other_parties]
+
+    def matching_party(self):
+        # Accounts are compared by name, which never equals an entity
+        if len(self.other_parties) > 1:
+            return None
+        return self.other_party
+
+    def matching_parties(self):
+        return self.other_parties
 
 
 class KnownAccount(Predicate):
@@ -65,23 +179,500 @@ class KnownAccount(Predicate):
         return operation.get_other_party == self.account
 
 
+class And(Predicate):
+    """Holds if all the predicates hold"""
+    def __init__(self, *predicates, label=None):
+        if label is None:
+            label = "({})".format(" & ".join(p.label for p in predicates))
+        super().__init__(label)
+        self.predicates = predicates
+
+    @property
+    def children(self):
+        return self.predicates
+
+    def fall_under_label(self, operation):
+        return all(predicate(operation) for predicate in self.predicates)
+
+    def dispatch_keys(self):
+        # Any operand restricts the candidates
+        for predicate in self.predicates:
+            keys = predicate.dispatch_keys()
+            if keys is not None:
+                return keys
+        return None
+
+    def mask(self, historic):
+        masks = [predicate.mask(historic) for predicate in self.predicates]
+        if any(mask is None for mask in masks):
+            return None
+        return np.logical_and.reduce(masks + [np.ones(len(historic),
+                                                      dtype=bool)])
+
+
+class Or(Predicate):
+    """Holds if any of the predicates holds"""
+    def __init__(self, *predicates, label=None):
+        if label is None:
+            label = "({})".format(" | ".join(p.label for p in predicates))
+        super().__init__(label)
+        self.predicates = predicates
+
+    @property
+    def children(self):
+        return self.predicates
+
+    def fall_under_label(self, operation):
+        return any(predicate(operation) for predicate in self.predicates)
+
+    def dispatch_keys(self):
+        keys = []
+        for predicate in self.predicates:
+            predicate_keys = predicate.dispatch_keys()
+            if predicate_keys is None:
+                return None
+            keys.extend(predicate_keys)
+        return keys
+
+    def mask(self, historic):
+        masks = [predicate.mask(historic) for predicate in self.predicates]
+        if any(mask is None for mask in masks):
+            return None
+        return np.logical_or.reduce(masks + [np.zeros(len(historic),
+                                                      dtype=bool)])
+
+
+class Not(Predicate):
+    def __init__(self, predicate, label=None):
+        super().__init__("~{}".format(predicate.label) if label is None
+                         else label)
+        self.predicate = predicate
+
+    @property
+    def children(self):
+        return self.predicate,
+
+    def fall_under_label(self, operation):
+        return not self.predicate(operation)
+
+    def mask(self, historic):
+        mask = self.predicate.mask(historic)
+        return None if mask is None else ~mask
+
+
+class ValueRange(Predicate):
+    """Value within [low, high] (None: unbounded)"""
+    def __init__(self, low=None, high=None, label=None):
+        super().__init__(label)
+        self.low = low
+        self.high = high
+
+    def fall_under_label(self, operation):
+        return (self.low is None or self.low <= operation.value) and \
+               (self.high is None or operation.value <= self.high)
+
+    def mask(self, historic):
+        mask = np.ones(len(historic), dtype=bool)
+        if self.low is not None:
+            mask &= self.low <= historic.values
+        if self.high is not None:
+            mask &= historic.values <= self.high
+        return mask
+
+
+class DateRange(Predicate):
+    """Date (`on`: "op_date" or "effective_date") within [oldest, latest]"""
+    def __init__(self, oldest=None, latest=None, on="op_date", label=None):
+        super().__init__(label)
+        self.oldest = oldest
+        self.latest = latest
+        self.on = on
+
+    def fall_under_label(self, operation):
+        date = getattr(operation, self.on)
+        return (self.oldest is None or self.oldest <= date) and \
+               (self.latest is None or date <= self.latest)
+
+    def mask(self, historic):
+        dates = historic.op_dates if self.on == "op_date" \
+            else historic.effective_dates
+        mask = np.ones(len(historic), dtype=bool)
+        if self.oldest is not None:
+            mask &= np.datetime64(self.oldest, "us") <= dates
+        if self.latest is not None:
+            mask &= dates <= np.datetime64(self.latest, "us")
+        return mask
+
+
+class OperationType(Predicate):
+    """The operation is an instance of one of the given classes"""
+    def __init__(self, *types, label=None):
+        if label is None:
+            label = "/".join(type.__name__ for type in types)
+        super().__init__(label)
+        self.types = types
+
+    def fall_under_label(self, operation):
+        return isinstance(operation, self.types)
+
+    def mask(self, historic):
+        codes = np.unique(historic.type_codes)
+        matching = [code for code in codes.tolist()
+                    if issubclass(TYPE_CODES.decode(code), self.types)]
+        return np.isin(historic.type_codes, matching)
+
+
+class DescriptionPredicate(Predicate, metaclass=ABCMeta):
+    """
+    Predicate on the description of the operation. Descriptions are not a
+    column of the historic: the mask builds the operations, but each
+    distinct description is only tested once.
+    """
+    @abstractmethod
+    def match(self, description):
+        pass
+
+    def fall_under_label(self, operation):
+        return self.match(operation.description)
+
+    def mask(self, historic):
+        matches = {}
+        mask = np.zeros(len(historic), dtype=bool)
+        for i, operation in enumerate(historic):
+            description = operation.description
+            match = matches.get(description)
+            if match is None:
+                match = bool(self.match(description))
+                matches[description] = match
+            mask[i] = match
+        return mask
+
+
+class DescriptionMatch(DescriptionPredicate):
+    """The description contains a match of the regular expression"""
+    def __init__(self, pattern, flags=0, label=None):
+        super().__init__(pattern if label is None else label)
+        self.regex = re.compile(pattern, flags)
+
+    def match(self, description):
+        return self.regex.search(description) is not None
+
+
+class Keywords(DescriptionPredicate):
+    """The description contains any of the keywords"""
+    def __init__(self, *keywords, case_sensitive=False, label=None):
+        super().__init__("/".join(keywords) if label is None else label)
+        self.case_sensitive = case_sensitive
+        if not case_sensitive:
+            keywords = [keyword.lower() for keyword in keywords]
+        self.keywords = tuple(keywords)
+
+    def match(self, description):
+        if not self.case_sensitive:
+            description = description.lower()
+        return any(keyword in description for keyword in self.keywords)
+
+
+class KeywordClassifier(Predicate):
+    """
+    Labels the operations by the keywords found in their texts.
+
+    All the keywords of all the rules are searched at once by a single
+    `keywords.Automaton`, so that each text is scanned once whatever the
+    number of rules; results are memoized for the `memo_size` most recent
+    distinct texts (repeated descriptions are frequent). The predicate
+    holds for the operations matching any rule, and the label of an
+    operation is the one of the first (in order) rule it matches.
+
+    Parameters
+    ----------
+    rules: dict or iterable of (label, keywords) pairs
+        The ordered rules; `keywords` is an iterable of str
+    fields: tuple of str
+        The attributes of the operations holding the texts (missing ones
+        are ignored)
+    case_sensitive: bool
+        Whether the keywords are case sensitive
+    label: str
+        The label of the classifier itself
+    memo_size: int
+        Number of distinct texts whose rules are memoized
+    """
+    multi_label = True
+
+    def __init__(self, rules, fields=("description", "message"),
+                 case_sensitive=False, label="Keywords", memo_size=4096):
+        super().__init__(label)
+        if isinstance(rules, dict):
+            rules = rules.items()
+        self.labels = []
+        patterns = []
+        self._rule_of_pattern = []
+        for label, keywords in rules:
+            for keyword in keywords:
+                patterns.append(keyword)
+                self._rule_of_pattern.append(len(self.labels))
+            self.labels.append(label)
+        self.fields = tuple(fields)
+        self.automaton = Automaton(patterns, case_sensitive)
+        self.memo_size = memo_size
+        self._memo = OrderedDict()
+        # (weak reference to the historic, its label array) of the last
+        # `label_array`, shared by the masks of the rules
+        self._labels = (None, None)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_labels"] = (None, None)  # Weak references do not pickle
+        return state
+
+    def _text(self, operation):
+        return "\n".join(getattr(operation, field, None) or ""
+                          for field in self.fields)
+
+    def _rules(self, text):
+        rules = self._memo.get(text)
+        if rules is not None:
+            self._memo.move_to_end(text)
+            return rules
+        rules = tuple(sorted({self._rule_of_pattern[pattern] for pattern
+                              in self.automaton.matches(text)}))
+        self._memo[text] = rules
+        if len(self._memo) > self.memo_size:
+            self._memo.popitem(last=False)
+        return rules
+
+    def labels_of(self, operation):
+        """All the labels `operation` matches, in rule order"""
+        return [self.labels[rule]
+                for rule in self._rules(self._text(operation))]
+
+    def label_of(self, operation):
+        """The label of the first rule `operation` matches (or None)"""
+        rules = self._rules(self._text(operation))
+        return self.labels[rules[0]] if len(rules) > 0 else None
+
+    def fall_under_label(self, operation):
+        return len(self._rules(self._text(operation))) > 0
+
+    def label_array(self, historic):
+        """
+        Object array of the `label_of` of each operation of `historic` (the
+        one of the last historic is kept for the masks of the rules)
+        """
+        reference, labels = self._labels
+        if reference is not None and reference() is historic:
+            return labels
+        labels = np.empty(len(historic), dtype=object)
+        labels[:] = [self.label_of(operation) for operation in historic]
+        try:
+            self._labels = (weakref.ref(historic), labels)
+        except TypeError:  # E.g. a list of operations
+            self._labels = (None, None)
+        return labels
+
+    def mask(self, historic):
+        return np.fromiter((label is not None
+                            for label in self.label_array(historic)),
+                           dtype=bool, count=len(historic))
+
+    def rule(self, label):
+        """The predicate holding for the operations labelled `label`"""
+        return KeywordRule(self, label)
+
+
+class KeywordRule(Predicate):
+    """Operations the `KeywordClassifier` labels `label`"""
+    def __init__(self, classifier, label):
+        super().__init__(label)
+        self.classifier = classifier
+
+    def fall_under_label(self, operation):
+        return self.classifier.label_of(operation) == self.label
+
+    def mask(self, historic):
+        return self.classifier.label_array(historic) == self.label
+
+
+class CountingPredicate(Predicate):
+    """
+    Wrapper counting the evaluations (and hits) of `predicate` and timing
+    them, operation by operation or on masks. See
+    `TreePology.count_evaluations`.
+    """
+    def __init__(self, predicate):
+        super().__init__(predicate.label)
+        self.predicate = predicate
+        self.multi_label = predicate.multi_label
+        self.evaluations = 0
+        self.hits = 0
+        self.wall_s = 0.
+
+    def __getattr__(self, name):
+        # Specific methods (e.g. `rule` of a `KeywordClassifier`)
+        if name == "predicate":
+            raise AttributeError(name)
+        return getattr(self.predicate, name)
+
+    def dispatch_keys(self):
+        return self.predicate.dispatch_keys()
+
+    def matching_party(self):
+        return self.predicate.matching_party()
+
+    def matching_parties(self):
+        return self.predicate.matching_parties()
+
+    @property
+    def children(self):
+        return self.predicate.children
+
+    def label_of(self, operation):
+        return self.predicate.label_of(operation)
+
+    def mask(self, historic):
+        start = time.perf_counter()
+        mask = self.predicate.mask(historic)
+        if mask is not None:
+            self.wall_s += time.perf_counter() - start
+            self.evaluations += len(historic)
+            self.hits += int(np.count_nonzero(mask))
+        return mask
+
+    def fall_under_label(self, operation):
+        return self(operation)
+
+    def __call__(self, operation):
+        start = time.perf_counter()
+        holds = self.predicate(operation)
+        self.wall_s += time.perf_counter() - start
+        self.evaluations += 1
+        if holds:
+            self.hits += 1
+        return holds
+
+
+class PredicateIndex(object):
+    """
+    First-match lookup over an ordered sequence of predicates.
+
+    Predicates with `dispatch_keys` are found through a hash map on the
+    `party_key` of the operation, the others (any callable) are evaluated in
+    order. Candidates are merged by position, so the result is the same as
+    evaluating every predicate in order, at the cost of a dict lookup plus
+    the non-dispatchable predicates placed before the match.
+    """
+    def __init__(self, predicates):
+        self.predicates = list(predicates)
+        self._table = {}
+        self._scanned = []
+        for i, predicate in enumerate(self.predicates):
+            keys = None
+            if isinstance(predicate, Predicate):
+                keys = predicate.dispatch_keys()
+            if keys is None:
+                self._scanned.append(i)
+            else:
+                for key in set(keys):
+                    self._table.setdefault(key, []).append(i)
+
+    def first_match(self, operation):
+        """Index of the first predicate holding for `operation` (or -1)"""
+        candidates = self._table.get(party_key(operation), ())
+        scanned = self._scanned
+        predicates = self.predicates
+        i = j = 0
+        while i < len(candidates) or j < len(scanned):
+            if j >= len(scanned) or \
+               (i < len(candidates) and candidates[i] < scanned[j]):
+                position = candidates[i]
+                i += 1
+            else:
+                position = scanned[j]
+                j += 1
+            if predicates[position](operation):
+                return position
+        return -1
+
+
 # ============================================================================ #
+class Aggregate(object):
+    """
+    Money in, money out and number of operations. Aggregates of disjoint
+    sets of operations combine with `merge` (associative and commutative).
+    """
+    __slots__ = ("money_in", "money_out", "n_operations")
+
+    def __init__(self, money_in=0, money_out=0, n_operations=0):
+        self.money_in = money_in
+        self.money_out = money_out
+        self.n_operations = n_operations
+
+    def add(self, value):
+        if value > 0:
+            self.money_in += value
+        else:
+            self.money_out += value
+        self.n_operations += 1
+
+    def merge(self, other):
+        """Add `other` to this aggregate (in place) and return it"""
+        self.money_in += other.money_in
+        self.money_out += other.money_out
+        self.n_operations += other.n_operations
+        return self
+
+
 class TreePologyNode(object, metaclass=ABCMeta):
+    """
+    Nodes define how operations are classified and aggregate those added
+    to them. `fresh` gives an empty node with the same definition (to
+    aggregate without touching the original, possibly without keeping the
+    operations) and `merge` combines nodes of the same definition.
+    """
     def __init__(self):
-        self.money_in = 0
-        self.money_out = 0
-        self.n_operations = 0
+        self.aggregate = Aggregate()
+
+    @property
+    def money_in(self):
+        return self.aggregate.money_in
+
+    @property
+    def money_out(self):
+        return self.aggregate.money_out
+
+    @property
+    def n_operations(self):
+        return self.aggregate.n_operations
 
     @property
     def label(self):
         return "n/a"
 
     def _do_add_op(self, operation):
-        if operation.value > 0:
-            self.money_in += operation.value
-        else:
-            self.money_out += operation.value
-        self.n_operations += 1
+        self.aggregate.add(operation.value)
+
+    def fresh(self, keep_operations=None):
+        """
+        An empty node with the same definition, whose leaves keep their
+        operations according to `keep_operations` (None: as this node's)
+        """
+        node = copy.copy(self)
+        node.aggregate = Aggregate()
+        return node
+
+    def _keeps(self, keep_operations):
+        if keep_operations is None:
+            return getattr(self, "keep_operations", True)
+        return keep_operations
+
+    def merge(self, other):
+        """
+        Add the aggregates of `other`, a node of the same definition, to this
+        one (in place) and return it
+        """
+        self.aggregate.merge(other.aggregate)
+        return self
 
     @abstractmethod
     def add_operation(self, operation):
@@ -95,10 +686,27 @@ class TreePologyNode(object, metaclass=ABCMeta):
                          self.money_in + self.money_out, self.n_operations)
 
 
+def _merge_nodes(nodes, other_nodes):
+    # Nodes created on the fly, by key, in order of first occurrence
+    for key, other_node in other_nodes.items():
+        node = nodes.get(key)
+        if node is None:
+            nodes[key] = other_node.fresh().merge(other_node)
+        else:
+            node.merge(other_node)
+
+
 class EntityMatchingNode(TreePologyNode):
-    def __init__(self, label="Total"):
+    """
+    Group the operations by other party. With a `clustering.AliasMap`, the
+    parties of a same cluster are grouped under an entity named after the
+    canonical name of the cluster.
+    """
+    def __init__(self, label="Total", keep_operations=True, aliases=None):
         super().__init__()
         self._label = label
+        self.keep_operations = keep_operations
+        self.aliases = aliases
         self.entity_node_dict = {}
 
     def add_operation(self, operation):
@@ -108,11 +716,27 @@ class EntityMatchingNode(TreePologyNode):
             print(operation)
         entity_node = self.entity_node_dict.get(entity)
         if entity_node is None:
-            entity_node = TreePologyLeaf(EntityPredicate(entity))
-            self.entity_node_dict[entity] = entity_node
-        entity_node.add_operation(operation)
+            if self.aliases is not None and entity is not None and \
+               entity.name in self.aliases:
+                entity = Entity.interned(self.aliases.canonical(entity.name))
+            entity_node = self.entity_node_dict.get(entity)
+            if entity_node is None:
+                entity_node = TreePologyLeaf(EntityPredicate(entity),
+                                             self.keep_operations)
+                self.entity_node_dict[entity] = entity_node
+        # The node of the entity (or of its cluster) holds by construction
+        entity_node._accept(operation)
         return True
 
+    def fresh(self, keep_operations=None):
+        return self.__class__(self._label, self._keeps(keep_operations),
+                              self.aliases)
+
+    def merge(self, other):
+        super().merge(other)
+        _merge_nodes(self.entity_node_dict, other.entity_node_dict)
+        return self
+
     def __len__(self):
         return len(self.entity_node_dict)
 
@@ -129,31 +753,96 @@ class EntityMatchingNode(TreePologyNode):
         return os.linesep.join(s)
 
 
+class LabelingNode(TreePologyNode):
+    """
+    Node of a multi-label predicate (such as a `KeywordClassifier`): each
+    of its labels gets its own leaf, created on the first operation.
+    """
+    def __init__(self, predicate, keep_operations=True):
+        super().__init__()
+        self.predicate = predicate
+        self.keep_operations = keep_operations
+        self.label_node_dict = {}
+
+    @property
+    def label(self):
+        return self.predicate.label
+
+    def add_operation(self, operation):
+        if not self.predicate(operation):
+            return False
+        self._do_add_op(operation)
+        label = self.predicate.label_of(operation)
+        label_node = self.label_node_dict.get(label)
+        if label_node is None:
+            label_node = TreePologyLeaf(self.predicate.rule(label),
+                                        self.keep_operations)
+            self.label_node_dict[label] = label_node
+        label_node._accept(operation)
+        return True
+
+    def fresh(self, keep_operations=None):
+        return self.__class__(self.predicate, self._keeps(keep_operations))
+
+    def merge(self, other):
+        super().merge(other)
+        _merge_nodes(self.label_node_dict, other.label_node_dict)
+        return self
+
+    def tree_view(self, depth=0, max_depth=1000, prefix=""):
+        s = [super().tree_view(depth, max_depth, prefix)]
+        for child in self.label_node_dict.values():
+            tmp = child.tree_view(depth + 1, max_depth, prefix=prefix + " " * 2)
+            if len(tmp) > 0:
+                s.append(tmp)
+        return os.linesep.join(s)
+
+
 class TreePologyLeaf(TreePologyNode):
-    def __init__(self, predicate):
+    def __init__(self, predicate, keep_operations=True):
         super().__init__()
         self.predicate = predicate
+        self.keep_operations = keep_operations
         self.operations = []
 
     @property
     def label(self):
         return self.predicate.label
 
+    def _accept(self, operation):
+        self._do_add_op(operation)
+        if self.keep_operations:
+            self.operations.append(operation)
+
     def add_operation(self, operation):
         if self.predicate(operation):
-            self._do_add_op(operation)
-            self.operations.append(operation)
+            self._accept(operation)
             return True
         return False
 
+    def fresh(self, keep_operations=None):
+        return self.__class__(self.predicate, self._keeps(keep_operations))
+
+    def merge(self, other):
+        super().merge(other)
+        self.operations.extend(other.operations)
+        return self
+
 
 class TreePology(TreePologyNode):
     def __init__(self, label, *trees):
         super().__init__()
-        self.children = [TreePologyLeaf(x) if isinstance(x, Predicate) else x
-                         for x in trees]
+        self.children = [self._node(x) for x in trees]
         self._label = label
 
+    @staticmethod
+    def _node(tree):
+        if not isinstance(tree, Predicate):
+            return tree
+        if tree.multi_label:
+            return LabelingNode(tree)
+        return TreePologyLeaf(tree)
+
     @property
     def label(self):
         return self._label
@@ -165,6 +854,53 @@ class TreePology(TreePologyNode):
                 return True
         return False
 
+    def fresh(self, keep_operations=None):
+        return self.__class__(self._label,
+                              *[child.fresh(keep_operations)
+                                for child in self.children])
+
+    def merge(self, other):
+        super().merge(other)
+        for child, other_child in zip(self.children, other.children):
+            child.merge(other_child)
+        return self
+
+    def count_evaluations(self):
+        """
+        Wrap the predicates of the nodes below this one into
+        `CountingPredicate`s (before compiling the tree) and return it
+        """
+        for child in self.children:
+            if isinstance(child, TreePology):
+                child.count_evaluations()
+            elif isinstance(getattr(child, "predicate", None), Predicate) \
+                    and not isinstance(child.predicate, CountingPredicate):
+                child.predicate = CountingPredicate(child.predicate)
+        return self
+
+    def leaf_counts(self, path=()):
+        """
+        Yield `(path, counting predicate)` for each node below this one
+        whose evaluations are counted (see `count_evaluations`). With the
+        first-match rule, a node is only evaluated on the operations none of
+        its previous siblings kept, and a compiled tree only on those of
+        the right other party for the predicates stating it.
+        """
+        path = path + (self.label,)
+        for child in self.children:
+            if isinstance(child, TreePology):
+                yield from child.leaf_counts(path)
+            elif isinstance(getattr(child, "predicate", None),
+                            CountingPredicate):
+                yield path + (child.label,), child.predicate
+
+    def compile(self):
+        """
+        Return a `CompiledTreePology` classifying the operations into this
+        tree through a `PredicateIndex`. Compile again if the tree changes.
+        """
+        return CompiledTreePology(self)
+
     def tree_view(self, depth=0, max_depth=1000, prefix=""):
         s = [super().tree_view(depth, max_depth, prefix)]
         for child in self.children:
@@ -173,3 +909,42 @@ class TreePology(TreePologyNode):
                 s.append(tmp)
         return os.linesep.join(s)
 
+
+
+class CompiledTreePology(object):
+    """
+    Flattened view of a `TreePology` with the same first-match semantics as
+    `TreePology.add_operation`, but looking leaves up by other party.
+    """
+    def __init__(self, tree):
+        self.tree = tree
+        self._terminals = []  # (leaf or opaque node, ancestors)
+        self._flatten(tree, [tree])
+        self._index = PredicateIndex([
+            terminal.predicate if isinstance(terminal, TreePologyLeaf)
+            else terminal.add_operation
+            for terminal, _ in self._terminals])
+
+    def _flatten(self, tree, ancestors):
+        for child in tree.children:
+            if isinstance(child, TreePology):
+                self._flatten(child, ancestors + [child])
+            else:
+                self._terminals.append((child, ancestors))
+
+    def classify(self, operation):
+        """The leaf (or opaque node) `operation` falls under (or None)"""
+        position = self._index.first_match(operation)
+        return None if position < 0 else self._terminals[position][0]
+
+    def add_operation(self, operation):
+        position = self._index.first_match(operation)
+        if position < 0:
+            return False
+        terminal, ancestors = self._terminals[position]
+        if isinstance(terminal, TreePologyLeaf):
+            terminal._accept(operation)
+        # Otherwise, the node has already accounted for it while matching
+        for node in ancestors:
+            node._do_add_op(operation)
+        return True
@@ -10,11 +10,53 @@ How much is sent to account x
 etc.
 """
 import os
+import pickle
 from abc import ABCMeta, abstractmethod
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
-from bank_analysis.predicate import Default, TreePologyLeaf, EntityMatchingNode
-from .base import Account
+import numpy as np
+
+from bank_analysis.predicate import Default, TreePologyLeaf, \
+    EntityMatchingNode, PredicateIndex
+from . import instrumentation
+from .base import Account, Historic, ACCOUNT_CODES
+from .store import StoreView
+
+
+class Summary(object):
+    """Period covered and accounts involved in a bunch of operations"""
+    def __init__(self, oldest=None, latest=None, accounts=None):
+        self.oldest = oldest
+        self.latest = latest
+        self.accounts = set() if accounts is None else set(accounts)
+
+    @classmethod
+    def of_historic(cls, historic):
+        oldest, latest = historic.period_covered()
+        return cls(oldest, latest, historic.accounts())
+
+    def add(self, operation):
+        if self.oldest is None or operation.op_date < self.oldest:
+            self.oldest = operation.op_date
+        if self.latest is None or self.latest < operation.op_date:
+            self.latest = operation.op_date
+        self.accounts.add(operation.account)
+
+    def merge(self, other):
+        """Add the operations summarized by `other` (in place)"""
+        if other.oldest is not None and \
+           (self.oldest is None or other.oldest < self.oldest):
+            self.oldest = other.oldest
+        if other.latest is not None and \
+           (self.latest is None or self.latest < other.latest):
+            self.latest = other.latest
+        self.accounts.update(other.accounts)
+        return self
+
+    def account_names(self):
+        return {account.account_to_str(type=False)
+                for account in self.accounts}
 
 
 class Query(object, metaclass=ABCMeta):
@@ -26,18 +68,281 @@ class Query(object, metaclass=ABCMeta):
         return self.query(historic)
 
 
-class InOutQuery(Query):
+class AccumulatingQuery(Query):
+    """
+    Query built by accumulating the operations one at a time into a state.
+
+    `query` accepts an `Historic`, a `store.StoreView` or any iterable of
+    operations (such as `AxaParser.iter_operations`), which is then consumed
+    in a single pass without being stored. Several such queries can share
+    that pass through a `QueryBatch`.
+    """
+    # Whether `update` only cares about the losses (value <= 0)
+    losses_only = False
+
+    @abstractmethod
+    def start(self):
+        """Return a fresh accumulation state"""
+        pass
+
+    @abstractmethod
+    def update(self, state, operation):
+        pass
+
+    @abstractmethod
+    def report(self, state, summary):
+        pass
+
+    def merge(self, state, other_state):
+        """
+        Return the state of the operations of `state` and `other_state`
+        (accumulated on disjoint sets of operations); may reuse `state`
+        """
+        raise NotImplementedError("{} states cannot be merged"
+                                  "".format(self.__class__.__name__))
+
+    def portable(self, state):
+        """`state` in a form which can be sent to another process"""
+        return state
+
+    def accumulate_columns(self, historic):
+        """
+        Return the complete state for `historic` computed from its columns,
+        or None if the operations must go through `update`.
+        """
+        return None
+
+    def accumulate_store(self, view):
+        """
+        Return the complete state for the `store.StoreView` `view` computed
+        in SQL, or None if the view must be materialized.
+        """
+        return None
+
     def query(self, historic):
-        accounts = set()
-        oldest, latest = historic.period_covered()
-        total = defaultdict(float)
-        number_of_ops = defaultdict(int)
-        for operation in historic:
-            accounts.add(operation.account.account_to_str(type=False))
-            key = "in" if operation.value > 0 else "out"
-            total[key] += operation.value
-            number_of_ops[key] += 1
+        return QueryBatch(self).query(historic)[0]
+
+
+class QueryBatch(Query):
+    """
+    Run several `AccumulatingQuery`s in a single pass over the operations.
+
+    The period, the accounts and the gains/losses split are computed once
+    for all the queries; the result is the list of their reports.
+    """
+    def __init__(self, *queries):
+        self.queries = list(queries)
+
+    def query(self, historic):
+        states, summary = self.accumulate(historic)
+        return [query.report(state, summary)
+                for query, state in zip(self.queries, states)]
+
+    def accumulate(self, historic):
+        """Return the states of the queries and the `Summary` of `historic`"""
+        with instrumentation.stage("query.accumulate") as timed:
+            if isinstance(historic, (Historic, StoreView)):
+                timed.rows = len(historic)
+            return self._accumulate_states(historic)
+
+    def _accumulate_states(self, historic):
+        states = [None] * len(self.queries)
+        if isinstance(historic, StoreView):
+            # Run what can be in SQL, the rest on the materialized operations
+            summary = Summary.of_historic(historic)
+            states = []
+            for query in self.queries:
+                with instrumentation.stage("query.store." +
+                                           query.__class__.__name__):
+                    states.append(query.accumulate_store(historic))
+            if all(state is not None for state in states):
+                return states, summary
+            historic = historic.historic()
+        elif isinstance(historic, Historic):
+            summary = Summary.of_historic(historic)
+        else:
+            summary = Summary()
+        is_historic = isinstance(historic, Historic)
+        on_all = []
+        on_losses = []
+        for i, query in enumerate(self.queries):
+            if states[i] is None and is_historic:
+                with instrumentation.stage("query.columns." +
+                                           query.__class__.__name__,
+                                           len(historic)):
+                    states[i] = query.accumulate_columns(historic)
+            if states[i] is not None:
+                continue
+            states[i] = query.start()
+            if query.losses_only:
+                on_losses.append((query, states[i]))
+            else:
+                on_all.append((query, states[i]))
+
+        with instrumentation.stage("query.dispatch") as timed:
+            if is_historic:
+                timed.rows = len(historic)
+                if len(on_all) > 0:
+                    gains = (historic.values > 0).tolist()
+                    self._dispatch(zip(historic, gains), on_all, on_losses)
+                elif len(on_losses) > 0:
+                    losses = historic[historic.values <= 0]
+                    self._dispatch(((op, False) for op in losses), [],
+                                   on_losses)
+            else:
+                def tagged(operations):
+                    for operation in operations:
+                        summary.add(operation)
+                        yield operation, operation.value > 0
+                self._dispatch(tagged(historic), on_all, on_losses)
+        return states, summary
+
+    def _dispatch(self, tagged_operations, on_all, on_losses):
+        for operation, is_gain in tagged_operations:
+            for query, state in on_all:
+                query.update(state, operation)
+            if not is_gain:
+                for query, state in on_losses:
+                    query.update(state, operation)
+
+
+class IncrementalAnalysis(object):
+    """
+    Keep the states of several `AccumulatingQuery`s from one run to the
+    next, so that appending a statement only costs its new operations.
 
+    For each account, a high-water mark is kept: the last operation day
+    seen and the fingerprints (see `DuplicatePolicy`) of the operations of
+    that day. On `update`, the operations before the mark are considered
+    already accounted for (e.g. the overlap of consecutive exports), those
+    of the mark day are checked against its fingerprints and the others
+    are new. Operations back-dated before the mark are thus missed.
+
+    The analysis is picklable; see `save` and `load`.
+
+    Parameters
+    ----------
+    queries: AccumulatingQuery
+        The queries, which must support `merge`
+    duplicate_policy: DuplicatePolicy or None
+        How operations of the mark day are fingerprinted (default:
+        `Historic.duplicate_policy`)
+    """
+    def __init__(self, *queries, duplicate_policy=None):
+        self.queries = list(queries)
+        self.duplicate_policy = Historic.duplicate_policy \
+            if duplicate_policy is None else duplicate_policy
+        self.states = None
+        self.summary = Summary()
+        # Normalized IBAN -> (last day, Counter of its fingerprints)
+        self.high_water_marks = {}
+
+    def _new_operations(self, historic):
+        """Mask of the operations of `historic` beyond the high-water marks"""
+        days = historic.op_dates.astype("datetime64[D]")
+        keep = np.zeros(len(historic), dtype=bool)
+        for code in np.unique(historic.account_ids).tolist():
+            in_account = historic.account_ids == code
+            iban = ACCOUNT_CODES.decode(code).normalized_iban
+            mark = self.high_water_marks.get(iban)
+            if mark is None:
+                keep |= in_account
+                continue
+            day, fingerprints = mark
+            keep |= in_account & (days > day)
+            on_mark = np.flatnonzero(in_account & (days == day))
+            if len(on_mark) > 0:
+                # Fingerprints already seen are consumed once each
+                seen = fingerprints.copy()
+                for i, fingerprint in zip(on_mark.tolist(),
+                                          self.duplicate_policy.fingerprints(
+                                              historic[on_mark])):
+                    if seen[fingerprint] > 0:
+                        seen[fingerprint] -= 1
+                    else:
+                        keep[i] = True
+        return keep
+
+    def _raise_marks(self, delta):
+        days = delta.op_dates.astype("datetime64[D]")
+        for code in np.unique(delta.account_ids).tolist():
+            in_account = delta.account_ids == code
+            iban = ACCOUNT_CODES.decode(code).normalized_iban
+            last_day = days[in_account].max()
+            on_last_day = in_account & (days == last_day)
+            fingerprints = Counter(self.duplicate_policy.fingerprints(
+                delta[on_last_day]))
+            mark = self.high_water_marks.get(iban)
+            if mark is not None and mark[0] == last_day:
+                fingerprints.update(mark[1])
+            elif mark is not None and mark[0] > last_day:
+                continue
+            self.high_water_marks[iban] = (last_day, fingerprints)
+
+    def update(self, historic):
+        """
+        Account for the operations of `historic` (an `Historic`) which are
+        new and return how many there were
+        """
+        delta = historic[self._new_operations(historic)]
+        if len(delta) == 0:
+            return 0
+        states, summary = QueryBatch(*self.queries).accumulate(delta)
+        states = [query.portable(state)
+                  for query, state in zip(self.queries, states)]
+        if self.states is None:
+            self.states = states
+        else:
+            self.states = [query.merge(state, new_state)
+                           for query, state, new_state
+                           in zip(self.queries, self.states, states)]
+        self.summary.merge(summary)
+        self._raise_marks(delta)
+        return len(delta)
+
+    def reports(self):
+        states = self.states
+        if states is None:
+            states = [query.start() for query in self.queries]
+        return [query.report(state, self.summary)
+                for query, state in zip(self.queries, states)]
+
+    def save(self, fpath):
+        with open(fpath, "wb") as hdl:
+            pickle.dump(self, hdl)
+
+    @classmethod
+    def load(cls, fpath):
+        with open(fpath, "rb") as hdl:
+            return pickle.load(hdl)
+
+
+class InOutQuery(AccumulatingQuery):
+    def start(self):
+        return {"total": defaultdict(float), "n_ops": defaultdict(int)}
+
+    def update(self, state, operation):
+        key = "in" if operation.value > 0 else "out"
+        state["total"][key] += operation.value
+        state["n_ops"][key] += 1
+
+    def accumulate_columns(self, historic):
+        money_in, n_in, money_out, n_out = historic.in_out()
+        return {"total": {"in": money_in, "out": money_out},
+                "n_ops": {"in": n_in, "out": n_out}}
+
+    def accumulate_store(self, view):
+        return self.accumulate_columns(view)
+
+    def merge(self, state, other_state):
+        for key in ("total", "n_ops"):
+            for direction, value in other_state[key].items():
+                state[key][direction] = state[key].get(direction, 0) + value
+        return state
+
+    def report(self, state, summary):
+        total = state["total"]
+        number_of_ops = state["n_ops"]
         return """
 ============
 In/Out query
@@ -49,12 +354,14 @@ in:    {:.2f} ({} operations)
 out:  {:.2f} ({} operations)
 -----------------------
 total: {:.2f}
-""".format(oldest, latest, ", ".join(accounts), total["in"],
-           number_of_ops["in"], total["out"],
+""".format(summary.oldest, summary.latest, ", ".join(summary.account_names()),
+           total["in"], number_of_ops["in"], total["out"],
            number_of_ops["out"], total["in"]+total["out"])
 
 
-class SpendingAnalysis(Query):
+class SpendingAnalysis(AccumulatingQuery):
+    losses_only = True
+
     def __init__(self, *labels):
         self.labels = list(labels) + [Default()]
 
@@ -65,23 +372,90 @@ class SpendingAnalysis(Query):
                  "".format(key, value, n_ops[key], os.linesep)
         return s.strip()
 
-    def query(self, historic):
-        accounts = set()
-        oldest, latest = historic.period_covered()
+    def start(self):
         # TODO manage automatically this
-        total = defaultdict(float)
-        n_ops = defaultdict(int)
+        return {"total": defaultdict(float), "n_ops": defaultdict(int),
+                "accounts": set(), "label_index": PredicateIndex(self.labels)}
 
-        for operation in historic:
-            if operation.value > 0:
+    def accumulate_columns(self, historic):
+        masks = []
+        label_arrays = {}
+        for i, predicate in enumerate(self.labels):
+            if predicate.multi_label:
+                label_arrays[i] = predicate.label_array(historic)
+                masks.append(np.fromiter((label is not None
+                                          for label in label_arrays[i]),
+                                         dtype=bool, count=len(historic)))
+            else:
+                masks.append(predicate.mask(historic))
+        if any(mask is None for mask in masks):
+            return None
+        state = self.start()
+        remaining = historic.values <= 0
+        state["accounts"].update(
+            ACCOUNT_CODES.decode(code)
+            for code in np.unique(historic.account_ids[remaining]).tolist())
+        firsts = []
+        for i, (predicate, mask) in enumerate(zip(self.labels, masks)):
+            # First match: each loss only falls under its first label
+            mask = mask & remaining
+            remaining &= ~mask
+            if not mask.any():
                 continue
-            accounts.add(operation.account.account_to_str(type=False))
+            if predicate.multi_label:
+                labels = label_arrays[i]
+                for label in set(labels[mask].tolist()):
+                    label_mask = mask & (labels == label)
+                    firsts.append((int(np.argmax(label_mask)), label,
+                                   label_mask))
+            else:
+                firsts.append((int(np.argmax(mask)), predicate.label, mask))
+        for _, label, mask in sorted(firsts, key=lambda x: x[0]):
+            state["total"][label] += float(historic.values[mask].sum())
+            state["n_ops"][label] += int(np.count_nonzero(mask))
+        return state
+
+    def accumulate_store(self, view):
+        spending = view.spending(self.labels)
+        if spending is None:
+            return None
+        totals, accounts = spending
+        state = self.start()
+        for position, total, n_ops in totals:
+            label = self.labels[position].label
+            state["total"][label] += total
+            state["n_ops"][label] += n_ops
+        state["accounts"].update(accounts)
+        return state
+
+    def portable(self, state):
+        # The label index is rebuilt on need
+        state.pop("label_index", None)
+        return state
+
+    def merge(self, state, other_state):
+        for label, total in other_state["total"].items():
+            state["total"][label] += total
+            state["n_ops"][label] += other_state["n_ops"][label]
+        state["accounts"].update(other_state["accounts"])
+        return state
 
-            for label in self.labels:
-                if label(operation):
-                    total[label.label] += operation.value
-                    n_ops[label.label] += 1
-                    break
+    def update(self, state, operation):
+        if operation.value > 0:
+            return
+        state["accounts"].add(operation.account)
+        label_index = state.get("label_index")
+        if label_index is None:
+            label_index = PredicateIndex(self.labels)
+            state["label_index"] = label_index
+        position = label_index.first_match(operation)
+        if position >= 0:
+            label = self.labels[position].label_of(operation)
+            state["total"][label] += operation.value
+            state["n_ops"][label] += 1
+
+    def report(self, state, summary):
+        accounts = Summary(accounts=state["accounts"]).account_names()
         return """
 =================
 Spending analysis
@@ -92,32 +466,114 @@ Accounts: {}
 {}
 -----------------------------
 total: {:.2f}
-""".format(oldest, latest, ", ".join(accounts),
-           self._detail(total, n_ops),
-           sum(total.values()))
+""".format(summary.oldest, summary.latest, ", ".join(accounts),
+           self._detail(state["total"], state["n_ops"]),
+           sum(state["total"].values()))
+
+
+def _accumulate(query, operations):
+    state = query.start()
+    for operation in operations:
+        query.update(state, operation)
+    return query.portable(state)
+
 
+class HierarchicalAnalysis(AccumulatingQuery):
+    """
+    Classify the operations into a copy of `treepology` (which is never
+    modified), the others by other party.
 
-class HierarchicalAnalysis(Query):
-    def __init__(self, treepology, max_depth=1000, give_unknown=False):
+    With `n_jobs` > 1, historics are split into shards (`shard_by`: "time"
+    for ranges of operation dates, "account" for one shard per account)
+    classified in a pool of processes, and the partial trees are merged.
+    Operations must then be picklable, and those kept in the leaves are
+    copies.
+
+    The unknown entities can be grouped by cluster of names through an
+    `aliases` map (see `clustering.CounterpartyClusterer`).
+    """
+    def __init__(self, treepology, max_depth=1000, give_unknown=False,
+                 keep_operations=True, compile=True, n_jobs=1,
+                 shard_by="time", aliases=None):
         self.tree = treepology
         self.max_depth = max_depth
         self.give_unknown = give_unknown
+        # Set to False to keep a bounded memory on operation streams
+        self.keep_operations = keep_operations
+        self.compile = compile
+        self.n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+        self.shard_by = shard_by
+        self.aliases = aliases
 
-    def query(self, historic):
-        accounts = set()
-        oldest, latest = historic.period_covered()
+    def start(self):
+        tree = self.tree.fresh(self.keep_operations)
+        if instrumentation.current() is not None:
+            tree.count_evaluations()
+        classifier = tree.compile() if self.compile else tree
+        return tree, classifier, \
+            EntityMatchingNode(keep_operations=self.keep_operations,
+                               aliases=self.aliases)
+
+    def update(self, state, operation):
+        _, classifier, unknown = state
+        if not classifier.add_operation(operation):
+            unknown.add_operation(operation)
+
+    def portable(self, state):
+        # The classifier is rebuilt on need
+        tree, _, unknown = state
+        return tree, None, unknown
+
+    def merge(self, state, other_state):
+        tree, classifier, unknown = state
+        tree.merge(other_state[0])
+        unknown.merge(other_state[2])
+        return tree, classifier, unknown
+
+    def _shards(self, historic):
+        if self.shard_by == "account":
+            return [historic[historic.account_ids == code]
+                    for code in np.unique(historic.account_ids).tolist()]
+        if self.shard_by == "time":
+            historic = historic.sort()
+            bounds = np.linspace(0, len(historic), self.n_jobs + 1)
+            bounds = bounds.astype(int).tolist()
+            return [historic[start:stop]
+                    for start, stop in zip(bounds[:-1], bounds[1:])
+                    if stop > start]
+        raise ValueError("Unknown sharding '{}'".format(self.shard_by))
+
+    def accumulate_columns(self, historic):
+        if self.n_jobs <= 1 or len(historic) < 2:
+            return None
+        shards = self._shards(historic)
+        with ProcessPoolExecutor(max_workers=min(self.n_jobs,
+                                                 len(shards))) as executor:
+            states = list(executor.map(_accumulate, [self] * len(shards),
+                                       shards))
+        state = self.start()
+        for other_state in states:
+            state = self.merge(state, other_state)
+        return state
 
-        unknown = EntityMatchingNode()
-        for operation in historic:
-            if not self.tree.add_operation(operation):
-                unknown.add_operation(operation)
-            accounts.add(operation.account.account_to_str(type=False))
+    def report(self, state, summary):
+        tree, _, unknown = state
         unknown_str = ""
         if self.give_unknown:
             unknown_str = ", ".join([repr(o) for o in unknown])
             unknown_str += os.linesep
 
-        tree_str = self.tree.tree_view(max_depth=self.max_depth)
+        stats = instrumentation.current()
+        if stats is not None:
+            for path, predicate in tree.leaf_counts():
+                stats.add_leaf(path, predicate.evaluations, predicate.hits)
+                stats.add("predicate." +
+                          predicate.predicate.__class__.__name__,
+                          predicate.wall_s, predicate.evaluations,
+                          calls=predicate.evaluations)
+        with instrumentation.stage("query.tree_view"):
+            tree_str = tree.tree_view(max_depth=self.max_depth)
+            unknown_tree_str = unknown.tree_view(max_depth=self.max_depth)
         return """
 =======
 Typlogy
@@ -132,7 +588,6 @@ Known entities
 {:d} unknown entitie(s)
 -----------------------------
 {}
-""".format(oldest, latest, ", ".join(accounts),
-           self.tree.tree_view(max_depth=self.max_depth),
-           len(unknown),
-           unknown.tree_view(max_depth=self.max_depth))
+""".format(summary.oldest, summary.latest,
+           ", ".join(summary.account_names()),
+           tree_str, len(unknown), unknown_tree_str)
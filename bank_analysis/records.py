@@ -0,0 +1,180 @@
+"""
+Byte-level splitting of exports into (multi-line) records.
+
+The file is memory-mapped and the record boundaries are found on the raw
+bytes with numpy (newline positions, then a vectorized check of the
+beginning of each line), instead of decoding the file and matching a
+regular expression on every line. The bytes are scanned in fixed-size
+chunks, so that the temporaries do not grow with the file. Records are
+handed out as offsets or raw bytes; only the records actually consumed are
+decoded.
+"""
+import codecs
+import mmap
+
+import numpy as np
+
+from . import instrumentation
+
+# What `\s` matches on latin-1 text, without the line ends
+_SPACES = np.frombuffer(b" \t\x0b\x0c\x1c\x1d\x1e\x1f\x85\xa0", dtype=np.uint8)
+
+
+def axa_record_starts(data, line_starts):
+    r"""
+    Mask of the lines starting an AXA record, that is matching
+    `\d\d\d\d\s?/\s?\d` (e.g. "2017 / 123")
+    """
+    n = len(data)
+
+    def at(positions):
+        return data[np.minimum(positions, n - 1)], positions < n
+
+    def digit(positions):
+        values, valid = at(positions)
+        return valid & (values >= ord("0")) & (values <= ord("9"))
+
+    def space(positions):
+        values, valid = at(positions)
+        return valid & np.isin(values, _SPACES)
+
+    def char(positions, c):
+        values, valid = at(positions)
+        return valid & (values == ord(c))
+
+    if n == 0:
+        return np.zeros(len(line_starts), dtype=bool)
+    mask = digit(line_starts)
+    for i in range(1, 4):
+        mask &= digit(line_starts + i)
+    slash = line_starts + 4
+    slash += space(slash)
+    mask &= char(slash, "/")
+    number = slash + 1
+    number += space(number)
+    return mask & digit(number)
+
+
+class RecordSplitter(object):
+    """
+    Parameters
+    ----------
+    fpath: str
+        The export
+    n_header_lines: int
+        Number of lines before the first record (general header and csv
+        header)
+    record_starts: callable
+        `record_starts(data, line_starts)` returns the mask of the lines (given
+        by their offsets in the uint8 array `data`) which start a record
+
+    Use as a context manager (or call `close`) to release the mapping.
+    """
+    # Bytes scanned at once for newlines
+    chunk_size = 1 << 24
+
+    def __init__(self, fpath, n_header_lines=9, record_starts=axa_record_starts):
+        self.fpath = fpath
+        self.record_starts = record_starts
+        self._hdl = open(fpath, "rb")
+        self._data = b""
+        if self._hdl.seek(0, 2) > 0:
+            self._data = mmap.mmap(self._hdl.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        self.body_start = 0
+        for _ in range(n_header_lines):
+            end = self._data.find(b"\n", self.body_start)
+            self.body_start = len(self._data) if end < 0 else end + 1
+        self.first_line_number = n_header_lines + 1
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = b""
+        self._hdl.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def header(self, encoding="latin"):
+        """The decoded header lines"""
+        return _decode(self._data[:self.body_start], encoding)
+
+    def _scan(self):
+        with instrumentation.stage("records.scan") as timed:
+            offsets, body_newlines = self._find_records()
+            timed.rows = len(offsets) - 1
+        return offsets, body_newlines
+
+    def _find_records(self):
+        data = np.frombuffer(self._data, dtype=np.uint8)
+        body_newlines = []
+        starts = []
+        chunk = None
+        for begin in range(self.body_start, len(data), self.chunk_size):
+            chunk = data[begin:begin + self.chunk_size]
+            newlines = np.flatnonzero(chunk == ord("\n")) + begin
+            line_starts = newlines + 1
+            if begin == self.body_start:
+                line_starts = np.concatenate(([begin], line_starts))
+            line_starts = line_starts[line_starts < len(data)]
+            # The beginning of a line may lie in the next chunk: the check
+            # reads the whole (mapped) data
+            starts.append(line_starts[self.record_starts(data,
+                                                         line_starts)])
+            body_newlines.append(newlines)
+        del data, chunk  # Do not keep the buffer exported
+
+        body_newlines = np.concatenate(body_newlines).astype(np.int64) \
+            if len(body_newlines) > 0 else np.zeros(0, dtype=np.int64)
+        if len(starts) == 0:
+            offsets = np.array([self.body_start], dtype=np.int64)
+        else:
+            starts = np.concatenate(starts)
+            if len(starts) == 0 or starts[0] != self.body_start:
+                starts = np.concatenate(([self.body_start], starts))
+            offsets = np.append(starts, len(self._data)).astype(np.int64)
+        return offsets, body_newlines
+
+    def offsets(self):
+        """
+        The record boundaries as an array of n_records + 1 offsets (text
+        between the header and the first record also makes a record)
+        """
+        return self._scan()[0]
+
+    def iter_spans(self):
+        """Yield the `(start, stop)` byte offsets of each record"""
+        offsets = self.offsets().tolist()
+        return zip(offsets[:-1], offsets[1:])
+
+    def view(self, start, stop):
+        """
+        The raw bytes of a record (a copy, so that the mapping can be closed
+        whatever the caller keeps)
+        """
+        return self._data[start:stop]
+
+    def iter_records(self, encoding="latin"):
+        """Yield `(line_number, record)` with the decoded, stripped records"""
+        offsets, newlines = self._scan()
+        line_numbers = self.first_line_number + \
+            np.searchsorted(newlines, offsets[:-1])
+        # The canonical name hits the fast decoding paths of CPython
+        encoding = codecs.lookup(encoding).name
+        data = self._data
+        offsets = offsets.tolist()
+        for line_number, start, stop in zip(line_numbers.tolist(),
+                                            offsets[:-1], offsets[1:]):
+            yield line_number, _decode(data[start:stop], encoding).strip()
+
+
+def _decode(raw, encoding):
+    text = raw.decode(encoding)
+    if "\r" in text:
+        # Same newline translation as files opened in text mode
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
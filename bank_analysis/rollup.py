@@ -0,0 +1,274 @@
+"""
+Time-bucketed rollup of historics.
+
+A `RollupCube` holds, for each (time bucket, account, other party, type)
+cell, the money in, money out and numbers of operations in and out. It is
+built in one vectorized group-by pass over the columns of an `Historic`,
+answers range queries by adding up its cells, can be updated with new
+operations (or merged with another cube) and saved to disk.
+"""
+import os
+import pickle
+
+import numpy as np
+
+from .base import Historic, ACCOUNT_CODES, PARTY_CODES, TYPE_CODES
+from .query import AccumulatingQuery
+
+_MEASURES = ("money_in", "n_in", "money_out", "n_out")
+DIMENSIONS = ("bucket", "account", "party", "type")
+
+
+def bucket_starts(dates, bucket="month"):
+    """
+    The first day (datetime64[D]) of the bucket of each date. Weeks start on
+    Monday.
+    """
+    days = np.asarray(dates).astype("datetime64[D]")
+    if bucket == "day":
+        return days
+    if bucket == "week":
+        # 1970-01-01 is a Thursday
+        elapsed = days.astype(np.int64) + 3
+        return (elapsed // 7 * 7 - 3).astype("datetime64[D]")
+    if bucket == "month":
+        return days.astype("datetime64[M]").astype("datetime64[D]")
+    if bucket == "year":
+        return days.astype("datetime64[Y]").astype("datetime64[D]")
+    raise ValueError("Unknown bucket '{}'".format(bucket))
+
+
+class _Dimension(object):
+    """Local, persistable codes of the members of a dimension"""
+    def __init__(self):
+        self.members = []
+        self._codes = {}
+
+    def encode(self, member):
+        code = self._codes.get(member)
+        if code is None:
+            code = len(self.members)
+            self._codes[member] = code
+            self.members.append(member)
+        return code
+
+    def codes(self, members):
+        return [self._codes[member] for member in members
+                if member in self._codes]
+
+    def translate(self, global_codes, codebook):
+        """Local codes of the members with the given `codebook` codes"""
+        unique, inverse = np.unique(global_codes, return_inverse=True)
+        table = np.array([self.encode(codebook.decode(code))
+                          for code in unique.tolist()], dtype=np.int64)
+        return table[inverse] if len(table) > 0 \
+            else np.zeros(0, dtype=np.int64)
+
+
+class RollupCube(object):
+    """
+    Parameters
+    ----------
+    bucket: str
+        The time buckets: "day", "week", "month" or "year"
+    on: str
+        The date the operations are bucketed on ("op_date" or
+        "effective_date")
+
+    Range queries work at the granularity of the buckets: a bucket is
+    included as a whole as soon as its first day is in the range.
+    """
+    def __init__(self, bucket="month", on="op_date"):
+        bucket_starts(np.zeros(0, dtype="datetime64[D]"), bucket)  # Check
+        self.bucket = bucket
+        self.on = on
+        self.dimensions = {name: _Dimension() for name in DIMENSIONS[1:]}
+        self.cells = {name: np.zeros(0, dtype=np.int64)
+                      for name in DIMENSIONS}
+        self.cells["bucket"] = self.cells["bucket"].astype("datetime64[D]")
+        for measure in _MEASURES:
+            self.cells[measure] = np.zeros(0, dtype=np.float64
+                                           if measure.startswith("money")
+                                           else np.int64)
+
+    @classmethod
+    def of_historic(cls, historic, bucket="month", on="op_date"):
+        cube = cls(bucket, on)
+        cube.add(historic)
+        return cube
+
+    def __len__(self):
+        """Number of non-empty cells"""
+        return len(self.cells["bucket"])
+
+    # ------------------------------------------------------------- Update #
+    def _regroup(self, cells):
+        # Group-by through a single mixed-radix key
+        buckets = cells["bucket"].astype(np.int64)
+        first = buckets.min() if len(buckets) > 0 else 0
+        key = buckets - first
+        for name in DIMENSIONS[1:]:
+            key = key * (len(self.dimensions[name].members) + 1) + cells[name]
+        unique, index, inverse = np.unique(key, return_index=True,
+                                           return_inverse=True)
+        grouped = {name: cells[name][index] for name in DIMENSIONS}
+        for measure in _MEASURES:
+            sums = np.bincount(inverse, weights=cells[measure],
+                               minlength=len(unique))
+            grouped[measure] = sums.astype(cells[measure].dtype)
+        self.cells = grouped
+
+    def add(self, historic):
+        """Add the operations of `historic` (not already in the cube)"""
+        if len(historic) == 0:
+            return self
+        dates = historic.op_dates if self.on == "op_date" \
+            else historic.effective_dates
+        values = historic.values
+        gains = values > 0
+        new_cells = {
+            "bucket": bucket_starts(dates, self.bucket),
+            "account": self.dimensions["account"].translate(
+                historic.account_ids, ACCOUNT_CODES),
+            "party": self.dimensions["party"].translate(
+                historic.party_ids, PARTY_CODES),
+            "type": self.dimensions["type"].translate(
+                historic.type_codes, TYPE_CODES),
+            "money_in": np.where(gains, values, 0.),
+            "n_in": gains.astype(np.int64),
+            "money_out": np.where(gains, 0., values),
+            "n_out": (~gains).astype(np.int64)}
+        self._regroup({name: np.concatenate((self.cells[name],
+                                             new_cells[name]))
+                       for name in self.cells})
+        return self
+
+    def merge(self, other):
+        """Add the cells of `other` (same bucketing) to this cube"""
+        if (other.bucket, other.on) != (self.bucket, self.on):
+            raise ValueError("Cannot merge cubes of different bucketing")
+        cells = dict(other.cells)
+        for name in DIMENSIONS[1:]:
+            table = np.array([self.dimensions[name].encode(member)
+                              for member in other.dimensions[name].members],
+                             dtype=np.int64)
+            if len(table) > 0:
+                cells[name] = table[other.cells[name]]
+        self._regroup({name: np.concatenate((self.cells[name], cells[name]))
+                       for name in self.cells})
+        return self
+
+    # -------------------------------------------------------------- Query #
+    def _select(self, oldest=None, latest=None, accounts=None, parties=None,
+                types=None):
+        mask = np.ones(len(self), dtype=bool)
+        if oldest is not None:
+            mask &= self.cells["bucket"] >= bucket_starts(
+                np.datetime64(oldest, "us"), self.bucket)
+        if latest is not None:
+            mask &= self.cells["bucket"] <= bucket_starts(
+                np.datetime64(latest, "us"), self.bucket)
+        for name, members in (("account", accounts), ("party", parties),
+                              ("type", types)):
+            if members is not None:
+                mask &= np.isin(self.cells[name],
+                                self.dimensions[name].codes(members))
+        return mask
+
+    def totals(self, oldest=None, latest=None, accounts=None, parties=None,
+               types=None):
+        """
+        `(money_in, n_in, money_out, n_out)` (as `Historic.in_out`) of the
+        operations in the buckets of [oldest, latest], restricted to the
+        given accounts, other parties and operation types (all if None)
+        """
+        mask = self._select(oldest, latest, accounts, parties, types)
+        return tuple(self.cells[measure][mask].sum().item()
+                     for measure in _MEASURES)
+
+    def group_by(self, dimension, oldest=None, latest=None, accounts=None,
+                 parties=None, types=None):
+        """
+        Dict of the `totals` per member of `dimension` ("bucket",
+        "account", "party" or "type"), e.g. monthly totals of one party
+        """
+        mask = self._select(oldest, latest, accounts, parties, types)
+        keys = self.cells[dimension][mask]
+        unique, inverse = np.unique(keys, return_inverse=True)
+        sums = [np.bincount(inverse, weights=self.cells[measure][mask],
+                            minlength=len(unique)) for measure in _MEASURES]
+        if dimension == "bucket":
+            members = unique.tolist()
+        else:
+            members = [self.dimensions[dimension].members[code]
+                       for code in unique.tolist()]
+        return {member: (sums[0][i].item(), int(sums[1][i]),
+                         sums[2][i].item(), int(sums[3][i]))
+                for i, member in enumerate(members)}
+
+    # -------------------------------------------------------- Persistence #
+    def save(self, fpath):
+        with open(fpath, "wb") as hdl:
+            pickle.dump(self, hdl)
+
+    @classmethod
+    def load(cls, fpath):
+        with open(fpath, "rb") as hdl:
+            return pickle.load(hdl)
+
+
+class RollupQuery(AccumulatingQuery):
+    """
+    Build a `RollupCube` (the state); the report gives the totals per
+    bucket. Can be kept up to date through an `IncrementalAnalysis`.
+
+    Streamed operations are rolled up in batches of `batch_size`, so that
+    at most that many are held at once.
+    """
+    def __init__(self, bucket="month", on="op_date", batch_size=65536):
+        self.bucket = bucket
+        self.on = on
+        self.batch_size = batch_size
+
+    def start(self):
+        return RollupCube(self.bucket, self.on), []
+
+    def update(self, state, operation):
+        state[1].append(operation)
+        if len(state[1]) >= self.batch_size:
+            self._flush(state)
+
+    def _flush(self, state):
+        cube, pending = state
+        if len(pending) > 0:
+            cube.add(Historic(pending))
+            del pending[:]
+        return cube
+
+    def accumulate_columns(self, historic):
+        return RollupCube.of_historic(historic, self.bucket, self.on), []
+
+    def merge(self, state, other_state):
+        return self._flush(state).merge(self._flush(other_state)), []
+
+    def portable(self, state):
+        return self._flush(state), []
+
+    def report(self, state, summary):
+        cube = self._flush(state)
+        lines = ["{}: {:.2f} ({} operations) / {:.2f} ({} operations)"
+                 "".format(bucket, money_in, n_in, money_out, n_out)
+                 for bucket, (money_in, n_in, money_out, n_out)
+                 in cube.group_by("bucket").items()]
+        return """
+======
+Rollup
+======
+Period: {} - {}
+Accounts: {}
+
+{} in / out
+-----------------------------
+{}
+""".format(summary.oldest, summary.latest, ", ".join(summary.account_names()),
+           self.bucket, os.linesep.join(lines))
@@ -0,0 +1,398 @@
+"""
+Long-running analysis server over a Unix socket.
+
+The exports are loaded and indexed (sorted by date) once, then kept in
+memory to answer queries from any number of local clients:
+
+    python -m bank_analysis.server serve --socket /tmp/bank.sock \\
+        "exports/*.csv"
+    python -m bank_analysis.server ask --socket /tmp/bank.sock \\
+        '{"query": "spending", "labels": [{"party": "DELHAIZE"}]}'
+
+The protocol is one JSON object per line in both directions. A request has
+a "query" ("status", "reload", "in_out", "spending", "hierarchical",
+"clip" or "filter"), optionally restricted to a period ("oldest",
+"latest", ISO dates, "on") and to the operations satisfying a "filter"
+(see `predicate_from_spec`). The response is `{"ok": true, "version": ...,
+"cached": ..., "result": ...}` or `{"ok": false, "error": ...}`.
+
+Results are cached per request and version of the data. The files (or glob
+patterns) are polled and reloaded when they change, which bumps the
+version. The files which could not be loaded are listed in the "failures"
+of the status.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import socket
+import stat
+import sys
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from .base import Historic, Operation
+from .loader import BulkLoader
+from .predicate import And, DateRange, DescriptionMatch, KnownOtherParty, \
+    Keywords, Not, OperationType, Or, TreePology, ValueRange
+from .query import HierarchicalAnalysis, InOutQuery, QueryBatch, \
+    SpendingAnalysis
+
+
+def _operation_types():
+    types = {}
+    pending = [Operation]
+    while pending:
+        cls = pending.pop()
+        types[cls.__name__] = cls
+        pending.extend(cls.__subclasses__())
+    return types
+
+
+def _date(value):
+    return None if value is None else datetime.fromisoformat(value)
+
+
+def predicate_from_spec(spec):
+    """
+    Build a predicate from its JSON description, one of (each with an
+    optional "label"):
+
+    - {"party": name}: `KnownOtherParty`
+    - {"values": [low, high]}: `ValueRange` (null for unbounded)
+    - {"dates": [oldest, latest], "on": "op_date"}: `DateRange`
+    - {"types": [class name, ...]}: `OperationType`
+    - {"keywords": [keyword, ...]}: `Keywords`
+    - {"description": regex}: `DescriptionMatch`
+    - {"and": [spec, ...]}, {"or": [spec, ...]}, {"not": spec}
+    """
+    label = spec.get("label")
+    if "party" in spec:
+        return KnownOtherParty(spec["party"], label)
+    if "values" in spec:
+        low, high = spec["values"]
+        return ValueRange(low, high, label=label)
+    if "dates" in spec:
+        oldest, latest = spec["dates"]
+        return DateRange(_date(oldest), _date(latest),
+                         spec.get("on", "op_date"), label=label)
+    if "types" in spec:
+        types = _operation_types()
+        unknown = [name for name in spec["types"] if name not in types]
+        if len(unknown) > 0:
+            raise ValueError("Unknown operation types: {}"
+                             "".format(", ".join(unknown)))
+        return OperationType(*[types[name] for name in spec["types"]],
+                             label=label)
+    if "keywords" in spec:
+        return Keywords(*spec["keywords"], label=label)
+    if "description" in spec:
+        return DescriptionMatch(spec["description"], label=label)
+    if "and" in spec:
+        return And(*[predicate_from_spec(s) for s in spec["and"]],
+                   label=label)
+    if "or" in spec:
+        return Or(*[predicate_from_spec(s) for s in spec["or"]], label=label)
+    if "not" in spec:
+        return Not(predicate_from_spec(spec["not"]), label=label)
+    raise ValueError("Unknown predicate: {}".format(json.dumps(spec)))
+
+
+def tree_from_spec(spec):
+    """
+    Build a `TreePology` from {"label": ..., "children": [...]}, whose
+    children are trees or predicates (see `predicate_from_spec`)
+    """
+    if "children" not in spec:
+        return predicate_from_spec(spec)
+    return TreePology(spec.get("label", "All"),
+                      *[tree_from_spec(child) for child in spec["children"]])
+
+
+def _operation_row(operation):
+    party = operation.get_other_party()
+    return OrderedDict([
+        ("date", operation.op_date.isoformat()),
+        ("value", operation.value),
+        ("party", None if party is None else party.name),
+        ("type", operation.__class__.__name__),
+        ("description", operation.description)])
+
+
+class AnalysisServer(object):
+    """
+    Parameters
+    ----------
+    fpaths: list of str
+        The exports to serve (paths or glob patterns)
+    socket_path: str
+        Path of the Unix socket. A stale socket there is replaced, any other
+        file makes `serve` fail.
+    loader: loader.BulkLoader or None
+        How the files are loaded (default: in this process, dropping the
+        operations found in several files)
+    poll_interval: float
+        Seconds between two checks of the files
+    cache_size: int
+        Number of results kept
+
+    Queries (and loads) run one at a time in a worker thread, so that the
+    event loop keeps serving cached results and accepting clients
+    meanwhile. The historic, its version and the cache are only swapped on
+    the loop: each query runs on the historic (and is labelled with the
+    version) current when it arrived. Identical requests arriving while
+    one is computed share its result.
+    """
+    def __init__(self, fpaths, socket_path, loader=None, poll_interval=2.,
+                 cache_size=256):
+        self.fpaths = list(fpaths)
+        self.socket_path = socket_path
+        self.loader = BulkLoader(n_jobs=1,
+                                 duplicate_policy=Historic.duplicate_policy) \
+            if loader is None else loader
+        self.poll_interval = poll_interval
+        self.cache_size = cache_size
+        self.historic = Historic()
+        self.version = 0
+        self.files = {}  # path -> (mtime, size) when loaded
+        self.failures = []  # loader.LoadFailure of the last load
+        self._cache = OrderedDict()  # (version, request) -> result
+        self._running = {}  # (version, request) -> future
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    # --------------------------------------------------------------- Data #
+    def _current_files(self):
+        files = {}
+        for pattern in self.fpaths:
+            for fpath in sorted(glob.glob(pattern)):
+                stat = os.stat(fpath)
+                files[fpath] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def _read(self):
+        # In the worker thread: nothing shared is modified
+        files = self._current_files()
+        historic = self.loader.load(list(files)).sort()
+        return historic, files, list(self.loader.failures)
+
+    async def reload(self):
+        """(Re)load the files; return the new version"""
+        loop = asyncio.get_running_loop()
+        historic, files, failures = await loop.run_in_executor(
+            self._executor, self._read)
+        self.historic = historic
+        self.files = files
+        self.failures = failures
+        self.version += 1
+        self._cache.clear()
+        return self.version
+
+    def changed(self):
+        return self._current_files() != self.files
+
+    # ------------------------------------------------------------ Queries #
+    def status(self):
+        oldest, latest = self.historic.period_covered()
+        return OrderedDict([
+            ("version", self.version),
+            ("files", sorted(self.files)),
+            ("failures", [OrderedDict([("file", failure.fpath),
+                                       ("error", failure.error.strip()
+                                        .splitlines()[-1])])
+                          for failure in self.failures]),
+            ("n_operations", len(self.historic)),
+            ("period", [None if oldest is None else oldest.isoformat(),
+                        None if latest is None else latest.isoformat()]),
+            ("cached_results", len(self._cache))])
+
+    @staticmethod
+    def _select(historic, request):
+        if request.get("oldest") is not None or \
+           request.get("latest") is not None:
+            historic = historic.clip(_date(request.get("oldest")),
+                                     _date(request.get("latest")),
+                                     request.get("on", "op_date"))
+        if request.get("filter") is not None:
+            historic = historic.filter(predicate_from_spec(request["filter"]))
+        return historic
+
+    def execute(self, request, historic):
+        """The (JSON-serializable) result of `request` on `historic`"""
+        query = request.get("query")
+        historic = self._select(historic, request)
+        if query in ("clip", "filter"):
+            oldest, latest = historic.period_covered()
+            limit = request.get("limit", 100)
+            return OrderedDict([
+                ("n_operations", len(historic)),
+                ("in_out", historic.in_out()),
+                ("period", [None if oldest is None else oldest.isoformat(),
+                            None if latest is None else latest.isoformat()]),
+                ("operations", [_operation_row(operation) for operation
+                                in historic[:limit]])])
+        if query == "in_out":
+            analysis = InOutQuery()
+        elif query == "spending":
+            analysis = SpendingAnalysis(*[predicate_from_spec(spec) for spec
+                                          in request.get("labels", [])])
+        elif query == "hierarchical":
+            analysis = HierarchicalAnalysis(
+                tree_from_spec(request["tree"]),
+                max_depth=request.get("max_depth", 1000),
+                keep_operations=False)
+        else:
+            raise ValueError("Unknown query '{}'".format(query))
+        states, summary = QueryBatch(analysis).accumulate(historic)
+        result = OrderedDict([("report", analysis.report(states[0],
+                                                         summary))])
+        if query != "hierarchical":
+            result["total"] = dict(states[0]["total"])
+            result["n_operations"] = dict(states[0]["n_ops"])
+        return result
+
+    async def _answer(self, request):
+        """
+        Return `(result, cached, version)`, `version` being the one of the
+        data the result was computed on
+        """
+        if request.get("query") == "status":
+            return self.status(), False, self.version
+        if request.get("query") == "reload":
+            version = await self.reload()
+            return {"version": version}, False, version
+
+        key = (self.version, json.dumps(request, sort_keys=True))
+        result = self._cache.get(key)
+        if result is not None:
+            self._cache.move_to_end(key)
+            return result, True, key[0]
+        future = self._running.get(key)
+        if future is not None:
+            return await asyncio.shield(future), True, key[0]
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, self.execute, request,
+                                      self.historic)
+        self._running[key] = future
+        try:
+            result = await future
+        finally:
+            self._running.pop(key, None)
+        if key[0] == self.version:
+            self._cache[key] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result, False, key[0]
+
+    # ------------------------------------------------------------- Server #
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                    if not isinstance(request, dict):
+                        raise ValueError("Requests must be JSON objects")
+                    result, cached, version = await self._answer(request)
+                    response = OrderedDict([("ok", True),
+                                            ("version", version),
+                                            ("cached", cached),
+                                            ("result", result)])
+                except Exception as error:
+                    response = {"ok": False, "error": "{}: {}".format(
+                        error.__class__.__name__, error)}
+                writer.write(json.dumps(response, default=str).encode("utf-8")
+                             + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def watch(self):
+        """Reload the files whenever they change"""
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                if self.changed():
+                    await self.reload()
+            except Exception:
+                # E.g. a file being written: keep the data, retry later
+                traceback.print_exc()
+
+    def _remove_socket(self):
+        # Only a stale socket is replaced, never another kind of file
+        if not os.path.exists(self.socket_path):
+            return
+        if not stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+            raise FileExistsError("'{}' exists and is not a socket"
+                                  "".format(self.socket_path))
+        os.remove(self.socket_path)
+
+    async def serve(self):
+        self._remove_socket()
+        await self.reload()
+        server = await asyncio.start_unix_server(self.handle,
+                                                 path=self.socket_path)
+        watcher = asyncio.ensure_future(self.watch())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+            self._remove_socket()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._executor.shutdown(wait=False)
+
+
+def ask(socket_path, request, timeout=None):
+    """Send `request` (a dict) to the server and return its response"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as hdl:
+            return json.loads(hdl.readline().decode("utf-8"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command")
+    serve = commands.add_parser("serve", help="Run the server")
+    serve.add_argument("fpaths", nargs="+", help="Exports (or glob patterns)")
+    serve.add_argument("--socket", default="bank_analysis.sock")
+    serve.add_argument("--poll", type=float, default=2.,
+                       help="Seconds between checks of the files")
+    serve.add_argument("--cache-size", type=int, default=256)
+    client = commands.add_parser("ask", help="Send a request")
+    client.add_argument("request", help="The request (JSON)")
+    client.add_argument("--socket", default="bank_analysis.sock")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        AnalysisServer(args.fpaths, args.socket, poll_interval=args.poll,
+                       cache_size=args.cache_size).run()
+    elif args.command == "ask":
+        response = ask(args.socket, json.loads(args.request))
+        if response.get("ok") and "report" in response["result"]:
+            print(response["result"]["report"])
+        else:
+            print(json.dumps(response, indent=2))
+        return 0 if response.get("ok") else 1
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
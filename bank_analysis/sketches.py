@@ -0,0 +1,458 @@
+"""
+Streaming queries with bounded memory.
+
+Unlike `HierarchicalAnalysis`, whose nodes grow with the number of distinct
+counterparties (and keep their operations), these queries summarize the
+operations into fixed-size, mergeable sketches:
+
+- `TopCounterparties`: the K counterparties receiving the most money, with
+  a space-saving summary refined by a count-min sketch;
+- `DistinctCounterparties`: the approximate number of distinct
+  counterparties, with a HyperLogLog;
+- `ValueQuantiles`: approximate quantiles of the values of the operations,
+  with a (merging) t-digest.
+
+Like any `AccumulatingQuery`, they consume an `Historic` (through its
+columns) or an iterator of operations, and their states can be merged (see
+`IncrementalAnalysis` and the sharding of `HierarchicalAnalysis`).
+"""
+import hashlib
+import heapq
+import itertools
+import math
+import os
+
+import numpy as np
+
+from .base import PARTY_CODES
+from .query import AccumulatingQuery
+
+
+def hash64(obj):
+    """Stable (across processes) 64-bit hash of `repr(obj)`"""
+    digest = hashlib.blake2b(repr(obj).encode("utf-8"), digest_size=8)
+    return int.from_bytes(digest.digest(), "little")
+
+
+def _party_outflows(historic):
+    # (party, outflow) of the losses of `historic`, summed per party
+    losses = historic.values <= 0
+    codes, inverse = np.unique(historic.party_ids[losses], return_inverse=True)
+    outflows = np.bincount(inverse, weights=-historic.values[losses],
+                           minlength=len(codes))
+    return [(PARTY_CODES.decode(code), outflow)
+            for code, outflow in zip(codes.tolist(), outflows.tolist())]
+
+
+class SpaceSaving(object):
+    """
+    Heavy hitters (weighted space-saving): at most `capacity` keys are
+    counted. A new key replaces the one with the smallest count, whose
+    count it inherits as error, so that counts are overestimated by at
+    most their `error`.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}  # key -> [count, error]
+        # (count, tie breaker, key), where the counts may be outdated
+        self._heap = []
+        self._ties = itertools.count()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_ties"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._ties = itertools.count()
+        self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        self._heap = [(entry[0], next(self._ties), key)
+                      for key, entry in self.counts.items()]
+        heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            count, _, key = heapq.heappop(self._heap)
+            entry = self.counts[key]
+            if entry[0] == count:
+                return key, entry
+            # Outdated: the count has grown since
+            heapq.heappush(self._heap, (entry[0], next(self._ties), key))
+
+    def min_count(self):
+        """Count of any key not kept (0 until the summary is full)"""
+        if len(self.counts) < self.capacity:
+            return 0.
+        key, entry = self._pop_min()
+        heapq.heappush(self._heap, (entry[0], next(self._ties), key))
+        return entry[0]
+
+    def add(self, key, weight=1.):
+        entry = self.counts.get(key)
+        if entry is not None:
+            entry[0] += weight
+            return
+        error = 0.
+        if len(self.counts) >= self.capacity:
+            evicted, (error, _) = self._pop_min()
+            del self.counts[evicted]
+        entry = [error + weight, error]
+        self.counts[key] = entry
+        heapq.heappush(self._heap, (entry[0], next(self._ties), key))
+
+    def merge(self, other):
+        """Add the counts of `other` (in place) and return this summary"""
+        own_min, other_min = self.min_count(), other.min_count()
+        merged = {}
+        for key in set(self.counts) | set(other.counts):
+            count, error = self.counts.get(key, (own_min, own_min))
+            other_count, other_error = other.counts.get(key, (other_min,
+                                                              other_min))
+            merged[key] = [count + other_count, error + other_error]
+        kept = heapq.nlargest(self.capacity, merged.items(),
+                              key=lambda item: item[1][0])
+        self.counts = dict(kept)
+        self._rebuild_heap()
+        return self
+
+    def top(self, k):
+        """The `(key, count, error)` of the `k` largest counts"""
+        return [(key, count, error) for key, (count, error)
+                in heapq.nlargest(k, self.counts.items(),
+                                  key=lambda item: item[1][0])]
+
+
+class CountMinSketch(object):
+    """
+    `depth` rows of `width` counters; the estimate of a key (the minimum
+    of its counters) overestimates its total by at most 2 / width of the
+    total weight with probability 1 - 2^-depth.
+    """
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.float64)
+        # Keys added one by one are hashed in the table in batches
+        self._pending = [], []
+
+    def _flush(self):
+        hashes, weights = self._pending
+        if len(hashes) > 0:
+            self._pending = [], []
+            self.add_hashes(hashes, weights)
+
+    def _columns(self, hashes):
+        # Double hashing: h1 + i * h2
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        low = hashes & np.uint64(0xffffffff)
+        high = (hashes >> np.uint64(32)) | np.uint64(1)
+        rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        return ((low[None, :] + rows * high[None, :]) %
+                np.uint64(self.width)).astype(np.int64)
+
+    def add_hashes(self, hashes, weights):
+        columns = self._columns(hashes)
+        weights = np.asarray(weights, dtype=np.float64)
+        for row in range(self.depth):
+            np.add.at(self.table[row], columns[row], weights)
+
+    def add(self, key, weight=1.):
+        self._pending[0].append(hash64(key))
+        self._pending[1].append(weight)
+        if len(self._pending[0]) >= 4096:
+            self._flush()
+
+    def estimates(self, hashes):
+        self._flush()
+        columns = self._columns(hashes)
+        return self.table[np.arange(self.depth)[:, None], columns].min(axis=0)
+
+    def estimate(self, key):
+        return float(self.estimates([hash64(key)])[0])
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("Cannot merge sketches of different sizes")
+        self._flush()
+        other._flush()
+        self.table += other.table
+        return self
+
+
+class HyperLogLog(object):
+    """
+    Approximate number of distinct keys with 2^`precision` registers
+    (relative standard error of about 1.04 / sqrt(2^precision))
+    """
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError("Precision must be between 4 and 16")
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+
+    def add_hash(self, hashed):
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rest = hashed & ((1 << bits) - 1)
+        rank = bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def add(self, key):
+        self.add_hash(hash64(key))
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches of different precisions")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(2. ** -self.registers.astype(np.float64))
+        empty = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and empty > 0:
+            # Small cardinalities: linear counting
+            return m * math.log(m / float(empty))
+        return float(raw)
+
+    def __len__(self):
+        return int(round(self.estimate()))
+
+
+class TDigest(object):
+    """
+    Merging t-digest: values are buffered, then merged into at most about
+    `compression` centroids, smaller towards the extreme quantiles (arcsine
+    scale function), so that tail quantiles stay accurate.
+    """
+    def __init__(self, compression=100, buffer_size=None):
+        self.compression = compression
+        self.buffer_size = 10 * compression if buffer_size is None \
+            else buffer_size
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.min = math.inf
+        self.max = -math.inf
+        self._buffer = []
+
+    def add(self, value):
+        self._buffer.append(value)
+        if len(self._buffer) >= self.buffer_size:
+            self._compress()
+
+    def add_array(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self._compress(values, np.ones(len(values)))
+
+    def merge(self, other):
+        other._compress()
+        self._compress(other.means, other.weights)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def _compress(self, means=None, weights=None):
+        buffered = np.asarray(self._buffer, dtype=np.float64)
+        self._buffer = []
+        parts = [(self.means, self.weights), (buffered, np.ones(len(buffered)))]
+        if means is not None:
+            parts.append((np.asarray(means, dtype=np.float64),
+                          np.asarray(weights, dtype=np.float64)))
+        means = np.concatenate([part[0] for part in parts])
+        weights = np.concatenate([part[1] for part in parts])
+        if len(means) == 0:
+            return
+        self.min = min(self.min, float(means.min()))
+        self.max = max(self.max, float(means.max()))
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+        # Centroid of each point: the unit interval of the scale function
+        # its quantile falls in
+        cumulative = np.cumsum(weights)
+        quantiles = (cumulative - weights / 2) / cumulative[-1]
+        scale = self.compression / math.pi * np.arcsin(2 * quantiles - 1)
+        _, groups = np.unique(np.floor(scale), return_inverse=True)
+        self.weights = np.bincount(groups, weights)
+        self.means = np.bincount(groups, weights * means) / self.weights
+
+    def __len__(self):
+        """Number of values added"""
+        self._compress()
+        return int(self.weights.sum())
+
+    def quantile(self, q):
+        """Approximate quantile(s) `q` (in [0, 1]) of the values"""
+        self._compress()
+        if len(self.means) == 0:
+            return np.nan if np.ndim(q) == 0 else np.full(np.shape(q), np.nan)
+        centers = np.cumsum(self.weights) - self.weights / 2
+        targets = np.asarray(q, dtype=np.float64) * self.weights.sum()
+        # Interpolate between the centroids, and to the extremes in the tails
+        xs = np.concatenate(([0.], centers, [self.weights.sum()]))
+        ys = np.concatenate(([self.min], self.means, [self.max]))
+        return np.interp(targets, xs, ys)
+
+
+# ============================================================================ #
+class TopCounterparties(AccumulatingQuery):
+    """
+    The `k` counterparties receiving the most money (the sum of the losses
+    sent to them). A space-saving summary of `capacity` counterparties
+    finds the candidates; their totals are the smaller of the summary and
+    count-min estimates (both upper bounds).
+    """
+    losses_only = True
+
+    def __init__(self, k=10, capacity=None, width=2048, depth=4):
+        self.k = k
+        self.capacity = 10 * k if capacity is None else capacity
+        self.width = width
+        self.depth = depth
+
+    def start(self):
+        return SpaceSaving(self.capacity), CountMinSketch(self.width,
+                                                          self.depth)
+
+    def update(self, state, operation):
+        party = operation.get_other_party()
+        if party is None:
+            return
+        summary, sketch = state
+        summary.add(party, -operation.value)
+        sketch.add(party, -operation.value)
+
+    def accumulate_columns(self, historic):
+        state = self.start()
+        outflows = [(party, outflow) for party, outflow
+                    in _party_outflows(historic) if party is not None]
+        summary, sketch = state
+        # The totals are exact: keep the largest ones (without evictions,
+        # which would hand the counts of early parties to later ones)
+        for party, outflow in heapq.nlargest(self.capacity, outflows,
+                                             key=lambda item: item[1]):
+            summary.add(party, outflow)
+        sketch.add_hashes([hash64(party) for party, _ in outflows],
+                          [outflow for _, outflow in outflows])
+        return state
+
+    def merge(self, state, other_state):
+        return state[0].merge(other_state[0]), state[1].merge(other_state[1])
+
+    def top(self, state):
+        """
+        `(party, outflow, maximal overestimation)` of the top `k`: the true
+        outflow lies in [outflow - overestimation, outflow]
+        """
+        summary, sketch = state
+        candidates = summary.top(self.capacity)
+        if len(candidates) == 0:
+            return []
+        estimates = sketch.estimates([hash64(party)
+                                      for party, _, _ in candidates])
+        refined = []
+        for (party, count, error), estimate in zip(candidates,
+                                                   estimates.tolist()):
+            outflow = min(count, estimate)
+            refined.append((party, outflow, max(outflow - (count - error),
+                                                0.)))
+        return heapq.nlargest(self.k, refined, key=lambda item: item[1])
+
+    def report(self, state, summary):
+        lines = ["{}: {:.2f} (+/- {:.2f})".format(party.name, outflow, error)
+                 for party, outflow, error in self.top(state)]
+        return """
+==================
+Top counterparties
+==================
+Period: {} - {}
+Accounts: {}
+
+{} largest outflows
+-----------------------------
+{}
+""".format(summary.oldest, summary.latest, ", ".join(summary.account_names()),
+           self.k, os.linesep.join(lines))
+
+
+class DistinctCounterparties(AccumulatingQuery):
+    """Approximate number of distinct counterparties (HyperLogLog)"""
+    def __init__(self, precision=12):
+        self.precision = precision
+
+    def start(self):
+        return HyperLogLog(self.precision)
+
+    def update(self, state, operation):
+        party = operation.get_other_party()
+        if party is not None:
+            state.add(party)
+
+    def accumulate_columns(self, historic):
+        state = self.start()
+        for code in np.unique(historic.party_ids).tolist():
+            party = PARTY_CODES.decode(code)
+            if party is not None:
+                state.add(party)
+        return state
+
+    def merge(self, state, other_state):
+        return state.merge(other_state)
+
+    def report(self, state, summary):
+        return """
+=======================
+Distinct counterparties
+=======================
+Period: {} - {}
+Accounts: {}
+
+About {} distinct counterparties
+""".format(summary.oldest, summary.latest, ", ".join(summary.account_names()),
+           len(state))
+
+
+class ValueQuantiles(AccumulatingQuery):
+    """Approximate quantiles of the values of the operations (t-digest)"""
+    def __init__(self, quantiles=(.01, .1, .25, .5, .75, .9, .99),
+                 compression=100):
+        self.quantiles = quantiles
+        self.compression = compression
+
+    def start(self):
+        return TDigest(self.compression)
+
+    def update(self, state, operation):
+        state.add(operation.value)
+
+    def accumulate_columns(self, historic):
+        state = self.start()
+        state.add_array(historic.values)
+        return state
+
+    def merge(self, state, other_state):
+        return state.merge(other_state)
+
+    def report(self, state, summary):
+        values = state.quantile(self.quantiles)
+        lines = ["{:>5.1f}%: {:.2f}".format(100 * q, value)
+                 for q, value in zip(self.quantiles, np.atleast_1d(values))]
+        return """
+===============
+Value quantiles
+===============
+Period: {} - {}
+Accounts: {}
+
+{} operations
+-----------------------------
+{}
+""".format(summary.oldest, summary.latest, ", ".join(summary.account_names()),
+           len(state), os.linesep.join(lines))
@@ -0,0 +1,547 @@
+"""
+Persistent store of operations in a local SQLite database.
+
+Exports are ingested once (see `OperationStore.ingest`) and the whole,
+possibly multi-year and multi-account, history is then queried through a
+`StoreView`. Views behave like an `Historic` for the operations which can be
+pushed down to SQL (clipping on a date, filtering on the other party,
+in/out totals and spending per label) and are materialized into an
+`Historic` for everything else.
+
+Operations are stored with their raw record, so that they can be rebuilt by
+the parser, next to their indexed columns: dates (as microseconds since the
+epoch), value, account, other party and type. Accounts, other parties,
+banks and types are stored once in their own tables, as plain columns (no
+pickles, so that opening a store never runs code from it).
+"""
+import glob
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+from .axa import AxaParser
+from .base import Account, Bank, Deferred, Entity, Historic, Operation, \
+    ACCOUNT_CODES, PARTY_CODES, TYPE_CODES
+from .loader import LoadFailure, parse_file, historic_from_parsed
+from .predicate import Default, Predicate
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    sha1 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS banks (
+    id INTEGER PRIMARY KEY,
+    repr TEXT UNIQUE NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    bic TEXT
+);
+CREATE TABLE IF NOT EXISTS accounts (
+    id INTEGER PRIMARY KEY,
+    repr TEXT UNIQUE NOT NULL,
+    key TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    iban TEXT,
+    bic TEXT,
+    account_type TEXT,
+    bank_id INTEGER REFERENCES banks(id)
+);
+CREATE TABLE IF NOT EXISTS parties (
+    id INTEGER PRIMARY KEY,
+    repr TEXT UNIQUE NOT NULL,
+    key TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    iban TEXT,
+    bic TEXT,
+    account_type TEXT,
+    bank_id INTEGER REFERENCES banks(id)
+);
+CREATE TABLE IF NOT EXISTS types (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS operations (
+    id INTEGER PRIMARY KEY,
+    source_id INTEGER NOT NULL REFERENCES sources(id),
+    account_id INTEGER NOT NULL REFERENCES accounts(id),
+    op_date INTEGER NOT NULL,
+    effective_date INTEGER NOT NULL,
+    value REAL NOT NULL,
+    party_id INTEGER REFERENCES parties(id),
+    type_id INTEGER NOT NULL REFERENCES types(id),
+    line_number INTEGER NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS parties_key ON parties(key);
+CREATE INDEX IF NOT EXISTS accounts_key ON accounts(key);
+CREATE INDEX IF NOT EXISTS operations_op_date ON operations(op_date);
+CREATE INDEX IF NOT EXISTS operations_effective_date
+    ON operations(effective_date);
+CREATE INDEX IF NOT EXISTS operations_account ON operations(account_id);
+CREATE INDEX IF NOT EXISTS operations_party ON operations(party_id);
+CREATE INDEX IF NOT EXISTS operations_type ON operations(type_id);
+CREATE INDEX IF NOT EXISTS operations_source ON operations(source_id);
+"""
+
+_DATE_COLUMNS = {"op_date": "o.op_date",
+                 "effective_date": "o.effective_date"}
+
+
+def _entity_key(entity):
+    # Entities are equal iff their keys are (see `Entity`)
+    return repr(entity._key)
+
+
+def _subclasses(cls):
+    # Name -> class of `cls` and its (loaded) subclasses
+    classes = {}
+    pending = [cls]
+    while pending:
+        cls = pending.pop()
+        classes["{}.{}".format(cls.__module__, cls.__qualname__)] = cls
+        pending.extend(cls.__subclasses__())
+    return classes
+
+
+def _entity_columns(entity):
+    # (kind, name, iban, bic, account_type) of an entity; accounts also
+    # refer to their bank
+    kind = "{}.{}".format(entity.__class__.__module__,
+                          entity.__class__.__qualname__)
+    if isinstance(entity, Account):
+        return kind, entity._name, entity.iban, None, entity.type
+    if isinstance(entity, Bank):
+        return kind, entity._name, None, entity.bic, None
+    return kind, entity._name, None, None, None
+
+
+def _entity_from_columns(kind, name, iban, bic, account_type, bank=None):
+    cls = _subclasses(Entity).get(kind)
+    if cls is None:
+        raise ValueError("Unknown kind of entity '{}'".format(kind))
+    if issubclass(cls, Account):
+        return cls.interned(iban, bank, name, account_type)
+    if issubclass(cls, Bank) and cls is not Bank:
+        # Specific banks (such as `AxaBank`) know their name and BIC
+        return cls.interned()
+    if issubclass(cls, Bank):
+        return cls.interned(name, bic)
+    return cls.interned(name)
+
+
+def _to_microseconds(date):
+    return int(np.datetime64(date, "us").astype(np.int64))
+
+
+def _from_microseconds(microseconds):
+    return np.datetime64(microseconds, "us").item()
+
+
+def _file_hash(fpath):
+    digest = hashlib.sha1()
+    with open(fpath, "rb") as hdl:
+        for chunk in iter(lambda: hdl.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class OperationStore(object):
+    """
+    Parameters
+    ----------
+    path: str
+        The SQLite database (":memory:" for a transient store)
+    parser:
+        The bank parser (default: `AxaParser()`), used both to ingest the
+        exports and to rebuild the operations from their records
+    duplicate_policy: DuplicatePolicy or None
+        If given, ingested operations already in the store (e.g. from an
+        overlapping export) are dropped
+
+    Use as a context manager (or call `close`) to release the database.
+    """
+    def __init__(self, path, parser=None, duplicate_policy=None):
+        self.path = path
+        self.parser = AxaParser() if parser is None else parser
+        self.duplicate_policy = duplicate_policy
+        self.connection = sqlite3.connect(path)
+        # Safe with WAL and much faster on bulk ingestion
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._check_schema()
+        self.connection.executescript(_SCHEMA)
+        # Store ids -> shared entities/types and their codes
+        self._accounts = {}
+        self._parties = {}
+        self._types = {}
+
+    def _check_schema(self):
+        columns = [row[1] for row in self.connection.execute(
+            "PRAGMA table_info(accounts)")]
+        if "entity" in columns:
+            raise ValueError("'{}' stores pickled entities (older version): "
+                             "ingest the exports into a new store"
+                             "".format(self.path))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # ---------------------------------------------------------- Ingestion #
+    def _id_of(self, table, repr_str, columns):
+        cursor = self.connection.execute(
+            "SELECT id FROM {} WHERE repr = ?".format(table), (repr_str,))
+        row = cursor.fetchone()
+        if row is not None:
+            return row[0]
+        names = ["repr"] + list(columns)
+        return self.connection.execute(
+            "INSERT INTO {} ({}) VALUES ({})".format(
+                table, ", ".join(names), ", ".join("?" * len(names))),
+            [repr_str] + list(columns.values())).lastrowid
+
+    def _bank_id(self, bank):
+        if bank is None:
+            return None
+        kind, name, _, bic, _ = _entity_columns(bank)
+        return self._id_of("banks", repr(bank),
+                           {"kind": kind, "name": name, "bic": bic})
+
+    def _entity_id(self, table, entity):
+        if entity is None:
+            return None
+        kind, name, iban, bic, account_type = _entity_columns(entity)
+        bank = entity.bank if isinstance(entity, Account) else None
+        return self._id_of(table, repr(entity), {
+            "key": _entity_key(entity), "kind": kind, "name": name,
+            "iban": iban, "bic": bic, "account_type": account_type,
+            "bank_id": self._bank_id(bank)})
+
+    def _type_id(self, type):
+        name = "{}.{}".format(type.__module__, type.__qualname__)
+        row = self.connection.execute("SELECT id FROM types WHERE name = ?",
+                                      (name,)).fetchone()
+        if row is not None:
+            return row[0]
+        return self.connection.execute(
+            "INSERT INTO types (name) VALUES (?)", (name,)).lastrowid
+
+    def _duplicates(self, parsed):
+        """Mask of the operations of `parsed` to keep"""
+        keep = np.ones(len(parsed.records), dtype=bool)
+        if self.duplicate_policy is None or len(keep) == 0:
+            return keep
+        # Only the operations of the same account around the same period
+        # can be duplicates
+        tolerance = np.timedelta64(self.duplicate_policy.date_tolerance + 1,
+                                   "D")
+        existing = self.view().accounts_in([parsed.account]).clip(
+            parsed.op_dates.min() - tolerance,
+            parsed.op_dates.max() + tolerance).historic()
+        if len(existing) == 0:
+            return keep
+        index = self.duplicate_policy.index(existing)
+        return self.duplicate_policy.update(
+            index, historic_from_parsed(self.parser, parsed))
+
+    def ingest(self, fpath, account_name="n/a", encoding="latin"):
+        """
+        Add the operations of the export `fpath` to the store and return
+        how many were added. Ingesting an unchanged file again does nothing;
+        the operations of a file which changed since are replaced.
+        """
+        path = os.path.abspath(fpath)
+        sha1 = _file_hash(path)
+        row = self.connection.execute(
+            "SELECT id, sha1 FROM sources WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[1] == sha1:
+            return 0
+        parsed = parse_file(self.parser, path, account_name, encoding)
+        if isinstance(parsed, LoadFailure):
+            raise ValueError("Could not load '{}':{}{}"
+                             "".format(fpath, os.linesep, parsed.error))
+
+        with self.connection:
+            if row is not None:
+                self.connection.execute(
+                    "DELETE FROM operations WHERE source_id = ?", (row[0],))
+                self.connection.execute(
+                    "UPDATE sources SET sha1 = ? WHERE id = ?",
+                    (sha1, row[0]))
+                source_id = row[0]
+            else:
+                source_id = self.connection.execute(
+                    "INSERT INTO sources (path, sha1) VALUES (?, ?)",
+                    (path, sha1)).lastrowid
+            if len(parsed.records) == 0:
+                return 0
+            keep = self._duplicates(parsed)
+
+            account_id = self._entity_id("accounts", parsed.account)
+            party_ids = [self._entity_id("parties", party)
+                         for party in parsed.parties]
+            type_ids = [self._type_id(type) for type in parsed.types]
+            rows = zip(
+                parsed.op_dates.astype(np.int64).tolist(),
+                parsed.effective_dates.astype(np.int64).tolist(),
+                parsed.values.tolist(),
+                [party_ids[i] for i in parsed.party_ids.tolist()],
+                [type_ids[i] for i in parsed.type_codes.tolist()],
+                parsed.line_numbers.tolist(),
+                parsed.records,
+                keep.tolist())
+            self.connection.executemany(
+                "INSERT INTO operations (source_id, account_id, op_date, "
+                "effective_date, value, party_id, type_id, line_number, "
+                "record) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((source_id, account_id) + row[:-1]
+                 for row in rows if row[-1]))
+        return int(np.count_nonzero(keep))
+
+    def ingest_all(self, fpaths, account_names=None, encoding="latin"):
+        """
+        Ingest several exports (a glob pattern or an iterable of paths);
+        `account_names` is as for `BulkLoader.load`. Return the number of
+        operations added.
+        """
+        if isinstance(fpaths, str):
+            fpaths = sorted(glob.glob(fpaths))
+        n_added = 0
+        for fpath in fpaths:
+            account_name = "n/a"
+            if callable(account_names):
+                account_name = account_names(fpath)
+            elif account_names is not None:
+                account_name = account_names.get(fpath, "n/a")
+            n_added += self.ingest(fpath, account_name, encoding)
+        return n_added
+
+    # ------------------------------------------------------------ Decoding #
+    def _decode(self, table, cache, codebook, store_id):
+        code = cache.get(store_id)
+        if code is None:
+            entity = None
+            if store_id is not None:
+                kind, name, iban, bic, account_type, bank_id = \
+                    self.connection.execute(
+                        "SELECT kind, name, iban, bic, account_type, bank_id "
+                        "FROM {} WHERE id = ?".format(table),
+                        (store_id,)).fetchone()
+                bank = None
+                if bank_id is not None:
+                    bank = _entity_from_columns(*self.connection.execute(
+                        "SELECT kind, name, NULL, bic, NULL FROM banks "
+                        "WHERE id = ?", (bank_id,)).fetchone())
+                entity = _entity_from_columns(kind, name, iban, bic,
+                                              account_type, bank)
+            code = codebook.encode(entity)
+            cache[store_id] = code
+        return code
+
+    def account_code(self, store_id):
+        return self._decode("accounts", self._accounts, ACCOUNT_CODES,
+                            store_id)
+
+    def party_code(self, store_id):
+        return self._decode("parties", self._parties, PARTY_CODES, store_id)
+
+    def type_code(self, store_id):
+        code = self._types.get(store_id)
+        if code is None:
+            name, = self.connection.execute(
+                "SELECT name FROM types WHERE id = ?", (store_id,)).fetchone()
+            type = _subclasses(Operation).get(name)
+            if type is None:
+                raise ValueError("Unknown operation type '{}'".format(name))
+            code = TYPE_CODES.encode(type)
+            self._types[store_id] = code
+        return code
+
+    def view(self):
+        """A `StoreView` of all the stored operations"""
+        return StoreView(self)
+
+    def __len__(self):
+        return len(self.view())
+
+
+class StoreView(object):
+    """
+    Lazy selection of the operations of an `OperationStore`.
+
+    `clip`, `filter` (with predicates stating the other party, such as
+    `EntityPredicate` and `KnownOtherParty`), `in_out`, `period_covered`,
+    `accounts` and `spending` run as SQL on the indexes of the store.
+    `historic` materializes the selection (in ingestion order) and `filter`
+    falls back to it for the other predicates.
+    """
+    def __init__(self, store, conditions=(), parameters=()):
+        self.store = store
+        self.conditions = tuple(conditions)
+        self.parameters = tuple(parameters)
+
+    def _where(self):
+        if len(self.conditions) == 0:
+            return ""
+        return " WHERE " + " AND ".join(self.conditions)
+
+    def _execute(self, sql, suffix=""):
+        return self.store.connection.execute(
+            sql + self._where() + suffix, self.parameters)
+
+    def _restrict(self, condition, *parameters):
+        return self.__class__(self.store, self.conditions + (condition,),
+                              self.parameters + parameters)
+
+    # ---------------------------------------------------------- Selection #
+    def clip(self, oldest=None, latest=None, on="op_date"):
+        """Operations whose date (`on`) lies in [oldest, latest]"""
+        column = _DATE_COLUMNS[on]
+        view = self
+        if oldest is not None:
+            view = view._restrict("{} >= ?".format(column),
+                                  _to_microseconds(oldest))
+        if latest is not None:
+            view = view._restrict("{} <= ?".format(column),
+                                  _to_microseconds(latest))
+        return view
+
+    def accounts_in(self, accounts):
+        """Operations of the given accounts"""
+        keys = [_entity_key(account) for account in accounts]
+        return self._restrict(
+            "o.account_id IN (SELECT id FROM accounts WHERE key IN ({}))"
+            "".format(", ".join("?" * len(keys))), *keys)
+
+    @staticmethod
+    def _party_condition(predicate):
+        """SQL condition (and parameter) equivalent to `predicate` or None"""
+        if isinstance(predicate, Default):
+            return "1", ()
+        if not isinstance(predicate, Predicate):
+            return None
+        parties = predicate.matching_parties()
+        if parties is None:
+            return None
+        return "o.party_id IN (SELECT id FROM parties WHERE key IN ({}))" \
+               "".format(", ".join("?" * len(parties))), \
+               tuple(_entity_key(party) for party in parties)
+
+    def filter(self, predicate):
+        """
+        A view restricted to the operations satisfying `predicate` if it can
+        be run on the store, otherwise the filtered, materialized `Historic`
+        """
+        condition = self._party_condition(predicate)
+        if condition is None:
+            return self.historic().filter(predicate)
+        return self._restrict(condition[0], *condition[1])
+
+    def losses(self):
+        return self._restrict("o.value <= 0")
+
+    # --------------------------------------------------------- Aggregates #
+    def __len__(self):
+        return self._execute("SELECT COUNT(*) FROM operations o").fetchone()[0]
+
+    def period_covered(self, on="op_date"):
+        column = _DATE_COLUMNS[on]
+        oldest, latest = self._execute(
+            "SELECT MIN({0}), MAX({0}) FROM operations o"
+            "".format(column)).fetchone()
+        if oldest is None:
+            return None, None
+        return _from_microseconds(oldest), _from_microseconds(latest)
+
+    def accounts(self):
+        rows = self._execute("SELECT DISTINCT o.account_id FROM operations o")
+        return [ACCOUNT_CODES.decode(self.store.account_code(store_id))
+                for store_id, in rows.fetchall()]
+
+    def in_out(self):
+        """As `Historic.in_out`"""
+        money_in, n_in, money_out, n = self._execute(
+            "SELECT TOTAL(CASE WHEN o.value > 0 THEN o.value END), "
+            "TOTAL(o.value > 0), "
+            "TOTAL(CASE WHEN o.value > 0 THEN 0 ELSE o.value END), "
+            "COUNT(*) FROM operations o").fetchone()
+        return money_in, int(n_in), money_out, n - int(n_in)
+
+    def spending(self, predicates):
+        """
+        Return `(totals, accounts)` or None if some predicates cannot run on
+        the store. `totals` lists `(position, total, n_operations)` for the
+        losses falling first under the predicate at `position`, in order of
+        first occurrence, and `accounts` are the accounts with losses.
+        """
+        conditions = [self._party_condition(p) for p in predicates]
+        if any(condition is None for condition in conditions):
+            return None
+        position = "-1"
+        if len(conditions) > 0:
+            position = "CASE {} ELSE -1 END".format(" ".join(
+                "WHEN {} THEN {}".format(condition, i)
+                for i, (condition, _) in enumerate(conditions)))
+        parameters = [p for _, params in conditions for p in params]
+        losses = self.losses()
+        rows = self.store.connection.execute(
+            "SELECT {} AS position, o.account_id, TOTAL(o.value), COUNT(*), "
+            "MIN(o.id) FROM operations o{} GROUP BY position, o.account_id"
+            "".format(position, losses._where()),
+            tuple(parameters) + losses.parameters)
+        groups = {}
+        account_ids = set()
+        for position, account_id, total, n_ops, first in rows.fetchall():
+            account_ids.add(account_id)
+            if position < 0:
+                continue
+            group = groups.setdefault(position, [first, 0., 0])
+            group[0] = min(group[0], first)
+            group[1] += total
+            group[2] += n_ops
+        totals = [(position, total, n_ops) for position, (_, total, n_ops)
+                  in sorted(groups.items(), key=lambda item: item[1][0])]
+        accounts = [ACCOUNT_CODES.decode(self.store.account_code(store_id))
+                    for store_id in account_ids]
+        return totals, accounts
+
+    # ------------------------------------------------------ Materializing #
+    def historic(self):
+        """The selected operations as an `Historic`, in ingestion order"""
+        rows = self._execute(
+            "SELECT o.account_id, o.op_date, o.effective_date, o.value, "
+            "o.party_id, o.type_id, o.line_number, o.record "
+            "FROM operations o", " ORDER BY o.id").fetchall()
+        if len(rows) == 0:
+            return Historic()
+        store = self.store
+        parser = store.parser
+        (account_ids, op_dates, effective_dates, values, party_ids, type_ids,
+         line_numbers, records) = zip(*rows)
+        account_codes = [store.account_code(i) for i in account_ids]
+        operations = [Deferred(parser.parse_record, record, line_number,
+                               ACCOUNT_CODES.decode(code))
+                      for record, line_number, code
+                      in zip(records, line_numbers, account_codes)]
+        return Historic.from_columns(
+            operations,
+            np.array(op_dates, dtype=np.int64).astype("datetime64[us]"),
+            np.array(effective_dates, dtype=np.int64)
+            .astype("datetime64[us]"),
+            values, account_codes,
+            [store.party_code(i) for i in party_ids],
+            [store.type_code(i) for i in type_ids])
+
+    def __iter__(self):
+        return iter(self.historic())
@@ -0,0 +1,169 @@
+"""
+Deterministic generation of synthetic AXA exports.
+
+The files follow the layout read by `axa.AxaParser` (general header, csv
+header, one record per operation with possibly multi-line messages) and
+cover every operation type it knows about. The same parameters always give
+the same file, which makes them suitable for benchmarks and regression
+checks. Lines are streamed to the file, so that exports of millions of
+operations do not need to fit in memory.
+"""
+import random
+from datetime import date, timedelta
+
+# (type string, kind of other party, relative frequency)
+OPERATION_TYPES = (
+    ("Achat - Bancontact", "merchant", 30),
+    ("Achat - Maestro", "merchant", 10),
+    ("Vente glob. - Bancontact", "merchant", 2),
+    ("Retrait Bancontact", "merchant", 6),
+    ("Retrait Maestro", "merchant", 2),
+    ("Virement européen", "account", 15),
+    ("Virement en euros", "account", 5),
+    ("Ordre permanent", "account", 6),
+    ("Domiciliation européenne", "account", 8),
+    ("Domiciliation Visa", "account", 2),
+    ("Encaissement interne", "account", 2),
+    ("Contribution compte", "bank", 1),
+    ("Capitalisation", "bank", 1),
+)
+
+MERCHANTS = ("DELHAIZE", "COLRUYT", "CARREFOUR", "ALDI", "LIDL", "SHELL",
+             "TOTAL", "Q8", "FNAC", "MEDIA MARKT", "IKEA", "PHARMACIE",
+             "BOULANGERIE", "SNCB", "STIB", "BANCONTACT ATM")
+PLACES = ("BRUXELLES", "LIEGE", "NAMUR", "GENT", "ANTWERPEN", "MONS")
+PEOPLE = ("JOHN DOE", "JANE DOE", "ACME SA", "PROXIMUS", "ENGIE",
+          "VIVAQUA", "SPF FINANCES", "LANDLORD SPRL", "MUTUALITE")
+HEADER = ("Numéro;Date opération;Date valeur;Date écriture;Montant;"
+          "Solde;Type;Compte contrepartie;Nom contrepartie;Commerçant;Lieu;"
+          "Carte;Communication 1;Communication 2;Détails")
+
+
+def _amount(value):
+    return "{:.2f}".format(value).replace(".", ",")
+
+
+class AxaExportGenerator(object):
+    """
+    Parameters
+    ----------
+    n_operations: int
+        Number of operations (records)
+    seed: int
+        Seed of the generator
+    start: datetime.date
+        Date of the first operation
+    n_days: int
+        Number of days covered by the operations
+    multiline_rate: float
+        Proportion of operations with a multi-line message
+    unknown_rate: float
+        Proportion of operations of a type the parser does not know
+    iban: str
+        IBAN of the account
+    account_type: str
+        Type of the account (first line of the export)
+    initial_balance: float
+        Balance before the first operation
+    """
+    def __init__(self, n_operations, seed=0, start=date(2015, 1, 1),
+                 n_days=3 * 365, multiline_rate=.05, unknown_rate=0.,
+                 iban="BE68 5390 0754 7034", account_type="Compte à vue",
+                 initial_balance=2500.):
+        self.n_operations = n_operations
+        self.seed = seed
+        self.start = start
+        self.n_days = n_days
+        self.multiline_rate = multiline_rate
+        self.unknown_rate = unknown_rate
+        self.iban = iban
+        self.account_type = account_type
+        self.initial_balance = initial_balance
+
+    def header_lines(self):
+        return [self.account_type,
+                "IBAN {}".format(self.iban),
+                "BIC AXABBE22",
+                "Historique des opérations",
+                "Devise: EUR",
+                "",
+                "",
+                "",
+                HEADER]
+
+    def _other_party(self, rng, kind):
+        """(other account, other name, merchant, place, card)"""
+        if kind == "merchant":
+            return "", "", rng.choice(MERCHANTS), rng.choice(PLACES), \
+                "6703 XXXX XXXX {:04d}".format(rng.randrange(10000))
+        if kind == "account":
+            person = rng.randrange(len(PEOPLE))
+            return "BE{:02d} {:04d} {:04d} {:04d}".format(
+                10 + person, 1000 + person, 2000 + person, 3000 + person), \
+                PEOPLE[person], "", "", ""
+        return "", "", "", "", ""
+
+    def _value(self, rng, kind, type_str):
+        if kind == "merchant":
+            return -round(rng.lognormvariate(3, 1), 2)
+        if kind == "bank":
+            return round(rng.uniform(-15, 5), 2)
+        if type_str.startswith("Virement") and rng.random() < .4:
+            return round(rng.lognormvariate(6.5, .8), 2)
+        return -round(rng.lognormvariate(4.5, 1), 2)
+
+    def _message(self, rng, i):
+        if rng.random() < self.multiline_rate:
+            # Continuation lines never look like the start of a record
+            return "Communication {}\nsuite de la communication".format(i), \
+                "ref. {:08d}".format(rng.randrange(10 ** 8))
+        return "Communication {}".format(i), ""
+
+    def iter_lines(self):
+        """Yield the lines of the export (without line ends)"""
+        rng = random.Random(self.seed)
+        types = [type_str for type_str, _, _ in OPERATION_TYPES]
+        kinds = dict((type_str, kind) for type_str, kind, _ in OPERATION_TYPES)
+        weights = [weight for _, _, weight in OPERATION_TYPES]
+        for line in self.header_lines():
+            yield line
+        balance = self.initial_balance
+        rate = max(self.n_operations, 1) / float(self.n_days)
+        day = 0.
+        for i in range(self.n_operations):
+            day = min(day + rng.expovariate(rate), self.n_days - 1)
+            op_date = self.start + timedelta(days=int(day))
+            effective_date = op_date + timedelta(days=rng.choice((0, 0, 0, 1,
+                                                                  2)))
+            if rng.random() < self.unknown_rate:
+                type_str, kind = "Opération diverse", "bank"
+            else:
+                type_str = rng.choices(types, weights)[0]
+                kind = kinds[type_str]
+            value = self._value(rng, kind, type_str)
+            balance = round(balance + value, 2)
+            other_account, other_name, merchant, place, card = \
+                self._other_party(rng, kind)
+            msg1, msg2 = self._message(rng, i)
+            fields = ["{} / {:06d}".format(op_date.year, i),
+                      op_date.strftime("%d/%m/%Y"),
+                      effective_date.strftime("%d/%m/%Y"),
+                      effective_date.strftime("%d/%m/%Y"),
+                      _amount(value), _amount(balance), type_str,
+                      other_account, other_name, merchant, place, card,
+                      msg1, msg2, "{} {}".format(type_str, merchant or
+                                                 other_name).strip()]
+            yield ";".join(fields)
+
+    def write(self, fpath, encoding="latin"):
+        """Write the export to `fpath` and return `fpath`"""
+        with open(fpath, "w", encoding=encoding, newline="\n") as hdl:
+            chunk = []
+            for line in self.iter_lines():
+                chunk.append(line)
+                if len(chunk) >= 10000:
+                    hdl.write("\n".join(chunk) + "\n")
+                    chunk = []
+            if len(chunk) > 0:
+                hdl.write("\n".join(chunk) + "\n")
+        return fpath
@@ -0,0 +1,311 @@
+"""
+Balance curves and time-window analytics.
+
+The balances stated by the exports (`amount_remaining`) are parsed in one
+batch, and the balance of each account is reconstructed with a cumulative
+sum of the values of its operations, sorted by date. Where the two
+disagree, an operation is missing (or duplicated) in the historic: those
+gaps are reported at the operation where the difference appears.
+
+Time-window metrics (burn rate, rolling maximum outflow, ...) are computed
+on a daily grid per account with vectorized kernels (`rolling_sum`,
+`rolling_max`) rather than by going through the operations.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from . import instrumentation
+from .base import ACCOUNT_CODES
+
+
+class BalanceGap(namedtuple("BalanceGap", ["account", "date", "operation",
+                                          "expected", "stated"])):
+    __slots__ = ()
+
+    @property
+    def difference(self):
+        return self.stated - self.expected
+
+
+def parse_amounts(strings):
+    """
+    Parse amounts such as "1.234,56", "1.234" or "-12,30" into a float array
+    (NaN for missing or empty ones). The comma is the decimal separator and
+    the dot (or a space) the thousands separator, whether or not there are
+    decimals.
+    """
+    strings = ["" if string is None else str(string) for string in strings]
+    if len(strings) == 0:
+        return np.zeros(0, dtype=np.float64)
+    amounts = np.char.strip(np.array(strings, dtype=str))
+    for separator in (" ", "\xa0", "."):
+        amounts = np.char.replace(amounts, separator, "")
+    amounts = np.char.replace(amounts, ",", ".")
+    amounts = np.where(amounts == "", "nan", amounts)
+    return amounts.astype(np.float64)
+
+
+def stated_balances(historic):
+    """The balances stated by the operations of `historic` (NaN if none)"""
+    with instrumentation.stage("timeseries.parse_balances", len(historic)):
+        return parse_amounts([getattr(operation, "amount_remaining", None)
+                              for operation in historic])
+
+
+def rolling_sum(values, window):
+    """Sum of each `window` consecutive values ending at each position"""
+    cumsum = np.concatenate(([0.], np.cumsum(values, dtype=np.float64)))
+    starts = np.maximum(np.arange(1, len(cumsum)) - window, 0)
+    return cumsum[1:] - cumsum[starts]
+
+
+def rolling_max(values, window):
+    """
+    Maximum of each `window` consecutive values ending at each position,
+    in linear time (van Herk/Gil-Werman: per-block prefix and suffix
+    maxima)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    if n == 0 or window <= 1:
+        return values.copy()
+    n_blocks = -(-n // window)
+    padded = np.full(n_blocks * window, -np.inf)
+    padded[:n] = values
+    blocks = padded.reshape(n_blocks, window)
+    prefix = np.maximum.accumulate(blocks, axis=1).ravel()
+    suffix = np.maximum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    result = np.maximum.accumulate(values)  # Incomplete first windows
+    ends = np.arange(window - 1, n)
+    result[window - 1:] = np.maximum(suffix[ends - window + 1], prefix[ends])
+    return result
+
+
+class DailySeries(object):
+    """
+    Daily flows and closing balance over consecutive days (days without
+    operations included).
+
+    Attributes
+    ----------
+    days: array of datetime64[D]
+    money_in, money_out: arrays of float
+        Sums of the strictly positive and of the other values of each day
+    max_outflow: array of float
+        Largest single outflow (as a positive amount) of each day
+    n_operations: array of int
+    closing: array of float
+        Balance at the end of each day
+    """
+    def __init__(self, days, money_in, money_out, max_outflow, n_operations,
+                 closing):
+        self.days = days
+        self.money_in = money_in
+        self.money_out = money_out
+        self.max_outflow = max_outflow
+        self.n_operations = n_operations
+        self.closing = closing
+
+    @classmethod
+    def of_operations(cls, dates, values, balances):
+        """From the (date-sorted) dates, values and balances after each"""
+        days = np.asarray(dates).astype("datetime64[D]")
+        if len(days) == 0:
+            empty = np.zeros(0)
+            return cls(days, empty, empty, empty, np.zeros(0, dtype=np.int64),
+                       empty)
+        first = days[0]
+        offsets = (days - first).astype(np.int64)
+        n_days = int(offsets[-1]) + 1
+        gains = values > 0
+        money_in = np.bincount(offsets, np.where(gains, values, 0.), n_days)
+        money_out = np.bincount(offsets, np.where(gains, 0., values), n_days)
+        n_operations = np.bincount(offsets, minlength=n_days)
+        max_outflow = np.zeros(n_days)
+        np.maximum.at(max_outflow, offsets, np.where(gains, 0., -values))
+        # Closing balance: last balance of the day, carried over empty days
+        last = np.full(n_days, -1, dtype=np.int64)
+        last[offsets] = np.arange(len(offsets))
+        last = np.maximum.accumulate(last)
+        return cls(first + np.arange(n_days), money_in, money_out,
+                   max_outflow, n_operations, np.asarray(balances)[last])
+
+    def __len__(self):
+        return len(self.days)
+
+    def net_flow(self, window=30):
+        """Money in + money out over the last `window` days"""
+        return rolling_sum(self.money_in + self.money_out, window)
+
+    def burn_rate(self, window=30):
+        """Average daily outflow (positive) over the last `window` days"""
+        return -rolling_sum(self.money_out, window) / window
+
+    def rolling_max_outflow(self, window=30):
+        """Largest single outflow (positive) of the last `window` days"""
+        return rolling_max(self.max_outflow, window)
+
+    def rolling_min_balance(self, window=30):
+        return -rolling_max(-self.closing, window)
+
+
+class BalanceCurves(object):
+    """
+    Per-account balances of the operations of an historic.
+
+    Operations are sorted per account by date; operations of a same day
+    keep the order of the export (reversed for exports listing the latest
+    operations first). The balance of each account is reconstructed from
+    its first stated balance (or from zero if no balance is stated).
+
+    Parameters
+    ----------
+    historic: Historic
+    on: str
+        The date the operations are sorted on ("op_date" or
+        "effective_date")
+    tolerance: float
+        Largest difference between reconstructed and stated balances
+        which is not a gap (rounding)
+
+    Attributes (sorted operations)
+    ------------------------------
+    order: array of int
+        Positions of the sorted operations in `historic`
+    account_ids, dates, values, stated, reconstructed: arrays
+    """
+    def __init__(self, historic, on="op_date", tolerance=.005):
+        self.historic = historic
+        self.tolerance = tolerance
+        dates = historic.op_dates if on == "op_date" \
+            else historic.effective_dates
+        account_ids = historic.account_ids
+        positions = np.arange(len(historic))
+        with instrumentation.stage("timeseries.sort", len(historic)):
+            # Exports listing the latest operations first are read backwards
+            codes, first, inverse = np.unique(account_ids, return_index=True,
+                                              return_inverse=True)
+            last = np.zeros(len(codes), dtype=np.int64)
+            np.maximum.at(last, inverse, positions)
+            latest_first = dates[first] > dates[last]
+            ties = np.where(latest_first[inverse], -positions, positions)
+            self.order = np.lexsort((ties, dates, account_ids))
+        self.account_ids = account_ids[self.order]
+        self.dates = dates[self.order]
+        self.values = historic.values[self.order]
+        self.stated = stated_balances(historic)[self.order]
+
+        with instrumentation.stage("timeseries.reconstruct", len(historic)):
+            # Boundaries of the accounts in the sorted operations
+            self._starts = np.flatnonzero(np.concatenate(
+                ([True], self.account_ids[1:] != self.account_ids[:-1])))
+            self._stops = np.append(self._starts[1:], len(self.order))
+            cumsum = np.cumsum(self.values)
+            reconstructed = np.empty(len(self.order))
+            for start, stop in zip(self._starts.tolist(),
+                                   self._stops.tolist()):
+                segment = cumsum[start:stop] - cumsum[start] \
+                    + self.values[start]
+                stated = self.stated[start:stop]
+                known = np.flatnonzero(~np.isnan(stated))
+                opening = 0.
+                if len(known) > 0:
+                    # Balance before the first operation of the account
+                    opening = stated[known[0]] - segment[known[0]]
+                reconstructed[start:stop] = opening + segment
+            self.reconstructed = reconstructed
+
+    def __len__(self):
+        return len(self.order)
+
+    def accounts(self):
+        return [ACCOUNT_CODES.decode(code)
+                for code in self.account_ids[self._starts].tolist()]
+
+    def _segment(self, account):
+        code = ACCOUNT_CODES.encode(account)
+        for start, stop in zip(self._starts.tolist(), self._stops.tolist()):
+            if self.account_ids[start] == code:
+                return start, stop
+        raise KeyError("No operation of account {}".format(account))
+
+    def curve(self, account):
+        """`(dates, balances)` after each operation of `account`"""
+        start, stop = self._segment(account)
+        return self.dates[start:stop], self.reconstructed[start:stop]
+
+    def daily(self, account=None):
+        """
+        The `DailySeries` of `account` or, if None, of all the accounts
+        together (summed balances)
+        """
+        if account is not None:
+            start, stop = self._segment(account)
+            return DailySeries.of_operations(self.dates[start:stop],
+                                             self.values[start:stop],
+                                             self.reconstructed[start:stop])
+        series = [self.daily(account) for account in self.accounts()]
+        if len(series) <= 1:
+            return series[0] if len(series) == 1 \
+                else DailySeries.of_operations([], np.zeros(0), np.zeros(0))
+        first = min(s.days[0] for s in series)
+        n_days = int((max(s.days[-1] for s in series) - first)
+                     .astype(np.int64)) + 1
+        totals = {name: np.zeros(n_days) for name in
+                  ("money_in", "money_out", "max_outflow", "n_operations",
+                   "closing")}
+        for s in series:
+            offset = int((s.days[0] - first).astype(np.int64))
+            window = slice(offset, offset + len(s))
+            totals["money_in"][window] += s.money_in
+            totals["money_out"][window] += s.money_out
+            totals["n_operations"][window] += s.n_operations
+            totals["max_outflow"][window] = np.maximum(
+                totals["max_outflow"][window], s.max_outflow)
+            # Before its first day, an account holds its opening balance;
+            # after its last, its last balance
+            opening = s.closing[0] - s.money_in[0] - s.money_out[0]
+            totals["closing"][:offset] += opening
+            totals["closing"][window] += s.closing
+            totals["closing"][offset + len(s):] += s.closing[-1]
+        return DailySeries(first + np.arange(n_days), totals["money_in"],
+                           totals["money_out"], totals["max_outflow"],
+                           totals["n_operations"].astype(np.int64),
+                           totals["closing"])
+
+    def mismatches(self):
+        """
+        Mask (on the sorted operations) of the reconstructed balances which
+        differ from the stated ones
+        """
+        return np.abs(self.reconstructed - self.stated) > self.tolerance
+
+    def gaps(self):
+        """
+        The `BalanceGap`s: operations where the difference between stated
+        and reconstructed balances changes, i.e. the operations following
+        missing ones (`difference` is then the missing amount) or
+        duplicated operations.
+        """
+        drift = self.stated - self.reconstructed
+        known = np.flatnonzero(~np.isnan(drift))
+        if len(known) == 0:
+            return []
+        previous = np.concatenate(([0.], drift[known[:-1]]))
+        # The first known balance of each account anchors its curve
+        first_known = np.concatenate(
+            ([True], self.account_ids[known[1:]] !=
+             self.account_ids[known[:-1]]))
+        previous[first_known] = 0.
+        changed = np.abs(drift[known] - previous) > self.tolerance
+        rows = known[changed]
+        expected = self.reconstructed[rows] + previous[changed]
+        return [BalanceGap(ACCOUNT_CODES.decode(code), date,
+                           self.historic[position], expected_balance,
+                           stated)
+                for code, date, position, expected_balance, stated
+                in zip(self.account_ids[rows].tolist(),
+                       self.dates[rows].tolist(),
+                       self.order[rows].tolist(), expected.tolist(),
+                       self.stated[rows].tolist())]
@@ -34,6 +34,6 @@ if __name__ == '__main__':
           license='BSD3',
           classifiers=CLASSIFIERS,
           platforms='any',
-          install_requires=[],
+          install_requires=['numpy'],
           packages=['bank_analysis'])
 
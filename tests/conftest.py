@@ -0,0 +1,20 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def run_with_hash_seed():
+    """
+    Run `code` in another interpreter with the given PYTHONHASHSEED, `FPATH`
+    standing for `repr(fpath)`
+    """
+    def run(seed, code, fpath):
+        code = code.replace("FPATH", repr(fpath))
+        env = dict(os.environ, PYTHONHASHSEED=str(seed), PYTHONPATH=ROOT)
+        subprocess.run([sys.executable, "-c", code], env=env, check=True)
+    return run
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from bank_analysis.axa import AxaParser
+from bank_analysis.cache import ParseCache
+from bank_analysis.synthetic import AxaExportGenerator
+
+
+@pytest.fixture
+def export(tmp_path):
+    fpath = str(tmp_path / "export.csv")
+    AxaExportGenerator(300).write(fpath)
+    return fpath
+
+
+def test_cached_historic_is_the_parsed_one(tmp_path, export):
+    parser = AxaParser()
+    cache = ParseCache(str(tmp_path / "cache"))
+    parsed = cache.load(parser, export, "mine")
+    assert "meta.json" in os.listdir(
+        os.path.join(cache.directory, cache.key(parser, export, "mine")))
+    assert cache.get(cache.key(parser, export, "mine")) is not None
+    cached = ParseCache(cache.directory).load(parser, export, "mine")
+    assert len(cached) == len(parsed)
+    assert [repr(op) for op in cached] == [repr(op) for op in parsed]
+    assert cached.accounts() == parsed.accounts()
+    assert (cached.party_ids == parsed.party_ids).all()
+    assert (cached.type_codes == parsed.type_codes).all()
+    assert not any(name.endswith(".pkl") for _, _, names
+                   in os.walk(cache.directory) for name in names)
+
+
+def test_keys_follow_the_content(tmp_path, export):
+    parser = AxaParser()
+    cache = ParseCache(str(tmp_path / "cache"))
+    key = cache.key(parser, export)
+    stat = os.stat(export)
+    os.utime(export, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert ParseCache(cache.directory).key(parser, export) == key
+    with open(export, "a") as hdl:
+        hdl.write("\n")
+    assert cache.key(parser, export) != key
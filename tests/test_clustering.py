@@ -0,0 +1,21 @@
+from bank_analysis.clustering import CounterpartyClusterer
+
+
+def test_prefix_matches_do_not_chain():
+    clusterer = CounterpartyClusterer()
+    alias_map = clusterer.cluster(["PAYPAL EBAY", "PAYPAL", "PAYPAL SPOTIFY"],
+                                  [10, 3, 5])
+    # Both are similar to "PAYPAL", not to each other
+    assert clusterer.similar("PAYPAL", "PAYPAL EBAY", set(), set())
+    assert clusterer.similar("PAYPAL", "PAYPAL SPOTIFY", set(), set())
+    assert alias_map.canonical("PAYPAL") == "PAYPAL EBAY"
+    assert alias_map.canonical("PAYPAL SPOTIFY") == "PAYPAL SPOTIFY"
+
+
+def test_places_join_their_merchant():
+    alias_map = CounterpartyClusterer().cluster(
+        ["DELHAIZE", "DELHAIZE 1234 BRUXELLES", "Delhaize Gent",
+         "COLRUYT", "COLRUYT NAMUR"], [20, 3, 2, 8, 1])
+    assert sorted(alias_map.aliases("Delhaize Gent")) == \
+        ["DELHAIZE", "DELHAIZE 1234 BRUXELLES", "Delhaize Gent"]
+    assert alias_map.canonical("COLRUYT NAMUR") == "COLRUYT"
@@ -0,0 +1,27 @@
+from datetime import datetime
+
+from bank_analysis.dates import DateParser
+
+
+def test_layout_and_fallback():
+    parser = DateParser("%d/%m/%Y")
+    assert parser("24/12/2016") == datetime(2016, 12, 24)
+    assert parser(" 24/12/2016 ") == datetime(2016, 12, 24)
+    # Not the layout: day-first unless year-first
+    assert parser("24-12-2016") == datetime(2016, 12, 24)
+    assert parser("2016-03-04") == datetime(2016, 3, 4)
+
+
+def test_two_digit_years_pivot_as_strptime():
+    parser = DateParser("%d/%m/%y")
+    for date_str in ("01/01/00", "31/12/68", "01/01/69", "31/12/99"):
+        assert parser(date_str) == datetime.strptime(date_str, "%d/%m/%y")
+
+
+def test_cache_is_bounded():
+    parser = DateParser("%d/%m/%Y", cache_size=10)
+    for day in range(1, 29):
+        parser("{:02d}/02/2015".format(day))
+    assert parser.parse.cache_info().currsize == 10
+    parser.clear_cache()
+    assert parser.parse.cache_info().currsize == 0
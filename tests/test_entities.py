@@ -0,0 +1,37 @@
+import pickle
+
+from bank_analysis.axa import AxaBank
+from bank_analysis.base import Account, Bank, Entity
+
+
+def test_pickled_entities_are_interned():
+    account = Account.interned("BE68 5390 0754 7034", AxaBank.interned(),
+                               "mine")
+    entities = [Entity.interned("DELHAIZE"), Bank.interned("ING", "BBRUBEBB"),
+                AxaBank.interned(), account]
+    for entity in entities:
+        assert pickle.loads(pickle.dumps(entity)) is entity
+    assert pickle.loads(pickle.dumps(account)).bank is account.bank
+
+
+def test_entities_survive_another_hash_seed(tmp_path, run_with_hash_seed):
+    fpath = str(tmp_path / "entities.pkl")
+    run_with_hash_seed(1, """
+import pickle
+from bank_analysis.axa import AxaBank
+from bank_analysis.base import Account, Entity
+parties = {Entity.interned("DELHAIZE"): 1,
+           Account.interned("BE68539007547034", AxaBank.interned()): 2}
+with open(FPATH, "wb") as hdl:
+    pickle.dump(parties, hdl)
+""", fpath)
+    run_with_hash_seed(2, """
+import pickle
+from bank_analysis.axa import AxaBank
+from bank_analysis.base import Account, Entity
+with open(FPATH, "rb") as hdl:
+    parties = pickle.load(hdl)
+assert parties[Entity.interned("DELHAIZE")] == 1
+assert parties[Account.interned("BE68539007547034", AxaBank.interned())] == 2
+assert list(parties)[0] is Entity.interned("DELHAIZE")
+""", fpath)
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from bank_analysis.axa import AxaParser
+from bank_analysis.base import DuplicatePolicy, Historic
+from bank_analysis.synthetic import AxaExportGenerator
+
+
+@pytest.fixture(scope="module")
+def historic(tmp_path_factory):
+    fpath = str(tmp_path_factory.mktemp("exports") / "export.csv")
+    AxaExportGenerator(1000).write(fpath)
+    return AxaParser().parse_csv(fpath, "mine")
+
+
+def rows(historic):
+    return [repr(operation) for operation in historic]
+
+
+def test_merge_drops_the_overlap_of_exports(historic):
+    older, newer = historic[:600], historic[400:]
+    merged = older.merge(newer)
+    assert rows(merged) == rows(historic)
+    assert len(merged.merge(historic[100:300])) == len(historic)
+    assert len(historic[:0].merge(newer)) == len(newer)
+
+
+def test_merge_keeps_repeated_operations(historic):
+    repeated = Historic.concatenate([historic[5:10], historic[5:10]])
+    merged = historic[:10].merge(repeated)
+    # Only one occurrence of each was already there
+    assert rows(merged) == rows(historic[:10]) + rows(historic[5:10])
+
+
+def test_merge_with_date_tolerance(historic):
+    first = historic[:50]
+    shifted = Historic.from_columns(
+        list(first), first.op_dates + np.timedelta64(1, "D"),
+        first.effective_dates, first.values, first.account_ids,
+        first.party_ids, first.type_codes)
+    policy = DuplicatePolicy(date_tolerance=1, ignore_effective_date=True)
+    assert len(historic[:50].merge(shifted, policy)) == 50
+    assert len(historic[:50].merge(shifted)) == 100
+
+
+
+def same_columns(historic, other):
+    return all(np.array_equal(getattr(historic, name), getattr(other, name))
+               for name in ("op_dates", "effective_dates", "values",
+                            "party_ids"))
+
+
+def linear_clip(historic, oldest, latest, on):
+    dates = historic.op_dates if on == "op_date" else historic.effective_dates
+    mask = np.ones(len(historic), dtype=bool)
+    if oldest is not None:
+        mask &= dates >= np.datetime64(oldest, "us")
+    if latest is not None:
+        mask &= dates <= np.datetime64(latest, "us")
+    return historic[mask]
+
+
+def linear_period(historic, on):
+    if len(historic) == 0:
+        return None, None
+    dates = historic.op_dates if on == "op_date" else historic.effective_dates
+    return dates.min().item(), dates.max().item()
+
+
+@pytest.mark.parametrize("on", ["op_date", "effective_date"])
+def test_date_index_matches_a_linear_scan(historic, on):
+    rng = np.random.RandomState(0)
+    shuffled = historic[rng.permutation(len(historic))]
+    derived = [historic, shuffled, shuffled[100:900],
+               shuffled.filter(lambda op: op.value < 0),
+               shuffled[:500].merge(historic[300:]),
+               Historic.concatenate([shuffled[600:], historic[:700]])]
+    days = historic.op_dates.astype("datetime64[D]")
+    for candidate in derived:
+        assert candidate.period_covered(on) == linear_period(candidate, on)
+        for _ in range(10):
+            oldest, latest = sorted(rng.choice(days, 2).tolist())
+            for bounds in ((oldest, latest), (oldest, None), (None, latest)):
+                clipped = candidate.clip(*bounds, on=on)
+                expected = linear_clip(candidate, *bounds, on=on)
+                assert same_columns(clipped, expected)
+                assert clipped.period_covered(on) == \
+                    linear_period(expected, on)
+                # The index carried over to the result still answers
+                assert same_columns(clipped.clip(*bounds, on=on), expected)
+    assert historic[:0].period_covered(on) == (None, None)
@@ -0,0 +1,64 @@
+import pytest
+
+from bank_analysis.axa import AxaParser
+from bank_analysis.predicate import KnownOtherParty
+from bank_analysis.query import IncrementalAnalysis, InOutQuery, \
+    SpendingAnalysis
+from bank_analysis.rollup import RollupQuery
+from bank_analysis.synthetic import AxaExportGenerator
+
+# Statements of an export, as (start, stop) of its operations sorted by date
+FIRST, SECOND = (0, 700), (500, 1200)
+
+
+def analysis():
+    return IncrementalAnalysis(
+        InOutQuery(), SpendingAnalysis(KnownOtherParty("DELHAIZE", "food"),
+                                       KnownOtherParty("SHELL", "fuel")),
+        RollupQuery())
+
+
+@pytest.fixture(scope="module")
+def export(tmp_path_factory):
+    fpath = str(tmp_path_factory.mktemp("exports") / "export.csv")
+    AxaExportGenerator(1200).write(fpath)
+    return fpath
+
+
+def statement(fpath, bounds):
+    return AxaParser().parse_csv(fpath, "mine").sort()[slice(*bounds)]
+
+
+def test_overlapping_statements_are_accounted_once(export):
+    incremental = analysis()
+    assert incremental.update(statement(export, FIRST)) == 700
+    assert incremental.update(statement(export, SECOND)) == 500
+    assert incremental.update(statement(export, SECOND)) == 0
+    whole = analysis()
+    whole.update(statement(export, (0, 1200)))
+    assert incremental.reports() == whole.reports()
+
+
+def test_saved_analysis_resumes_under_another_hash_seed(tmp_path, export,
+                                                        run_with_hash_seed):
+    incremental = analysis()
+    incremental.update(statement(export, FIRST))
+    fpath = str(tmp_path / "analysis.pkl")
+    incremental.save(fpath)
+
+    whole = analysis()
+    whole.update(statement(export, (0, 1200)))
+    expected = str(tmp_path / "expected.txt")
+    with open(expected, "w") as hdl:
+        hdl.write("\n".join(whole.reports()))
+
+    run_with_hash_seed(7, """
+from bank_analysis.axa import AxaParser
+from bank_analysis.query import IncrementalAnalysis
+incremental = IncrementalAnalysis.load(FPATH)
+historic = AxaParser().parse_csv(EXPORT, "mine").sort()
+assert incremental.update(historic[{}:{}]) == 500
+with open(EXPECTED) as hdl:
+    assert "\\n".join(incremental.reports()) == hdl.read()
+""".format(*SECOND).replace("EXPORT", repr(export))
+                       .replace("EXPECTED", repr(expected)), fpath)
@@ -0,0 +1,34 @@
+import pickle
+
+import pytest
+
+from bank_analysis.axa import AxaParser
+from bank_analysis.predicate import KnownOtherParty
+from bank_analysis.query import SpendingAnalysis
+from bank_analysis.synthetic import AxaExportGenerator
+
+
+@pytest.fixture(scope="module")
+def historic(tmp_path_factory):
+    fpath = str(tmp_path_factory.mktemp("exports") / "export.csv")
+    AxaExportGenerator(500).write(fpath)
+    return AxaParser().parse_csv(fpath, "mine")
+
+
+def test_spending_analysis_keeps_its_index_in_the_state(historic):
+    query = SpendingAnalysis(KnownOtherParty("DELHAIZE", "food"),
+                             KnownOtherParty("SHELL", "fuel"))
+    attributes = dict(vars(query))
+    state = query.start()
+    assert vars(query) == attributes
+    for operation in historic:
+        query.update(state, operation)
+    columns = query.accumulate_columns(historic)
+    assert dict(state["total"]) == pytest.approx(dict(columns["total"]))
+    assert dict(state["n_ops"]) == dict(columns["n_ops"])
+
+    # Portable states resume their updates
+    state = pickle.loads(pickle.dumps(query.portable(query.start())))
+    for operation in historic:
+        query.update(state, operation)
+    assert dict(state["n_ops"]) == dict(columns["n_ops"])
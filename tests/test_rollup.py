@@ -0,0 +1,64 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from bank_analysis.axa import AxaParser
+from bank_analysis.base import Entity
+from bank_analysis.query import QueryBatch
+from bank_analysis.rollup import RollupCube, RollupQuery
+from bank_analysis.synthetic import AxaExportGenerator
+
+
+@pytest.fixture(scope="module")
+def export(tmp_path_factory):
+    fpath = str(tmp_path_factory.mktemp("exports") / "export.csv")
+    AxaExportGenerator(1000).write(fpath)
+    return fpath
+
+
+@pytest.fixture(scope="module")
+def historic(export):
+    return AxaParser().parse_csv(export, "mine")
+
+
+def test_totals_match_the_historic(historic):
+    cube = RollupCube.of_historic(historic)
+    oldest, latest = datetime(2016, 1, 1), datetime(2016, 6, 30)
+    assert cube.totals(oldest, latest) == pytest.approx(
+        historic.clip(oldest, latest).in_out())
+    delhaize = Entity.interned("DELHAIZE")
+    selected = np.array([op.get_other_party() == delhaize
+                         for op in historic])
+    assert cube.totals(parties=[delhaize]) == pytest.approx(
+        historic[selected].in_out())
+
+
+def test_updates_and_merges_match_one_pass(historic):
+    whole = RollupCube.of_historic(historic, "week")
+    added = RollupCube(bucket="week").add(historic[:400]).add(historic[400:])
+    merged = RollupCube.of_historic(historic[:300], "week").merge(
+        RollupCube.of_historic(historic[300:], "week"))
+    streamed = RollupQuery(bucket="week", batch_size=64)
+    states, _ = QueryBatch(streamed).accumulate(list(historic))
+    for cube in (added, merged, streamed.portable(states[0])[0]):
+        assert cube.group_by("bucket") == pytest.approx(
+            whole.group_by("bucket"))
+        assert len(cube) == len(whole)
+
+
+def test_saved_cube_loads_under_another_hash_seed(tmp_path, historic,
+                                                  run_with_hash_seed):
+    cube = RollupCube.of_historic(historic)
+    fpath = str(tmp_path / "cube.pkl")
+    cube.save(fpath)
+    expected = cube.totals(parties=[Entity.interned("DELHAIZE")])
+    n_in = int(np.count_nonzero(historic.values > 0))
+    run_with_hash_seed(3, """
+from bank_analysis.base import Entity
+from bank_analysis.rollup import RollupCube
+cube = RollupCube.load(FPATH)
+assert cube.totals(parties=[Entity.interned("DELHAIZE")]) == {!r}
+assert cube.totals()[1] == {}
+assert Entity.interned("DELHAIZE") in cube.group_by("party")
+""".format(expected, n_in), fpath)
@@ -0,0 +1,37 @@
+import asyncio
+import warnings
+
+import pytest
+
+from bank_analysis.server import AnalysisServer
+from bank_analysis.synthetic import AxaExportGenerator
+
+
+def test_serve_does_not_replace_other_files(tmp_path):
+    socket_path = tmp_path / "notes.txt"
+    socket_path.write_text("keep me")
+    server = AnalysisServer([], str(socket_path))
+    try:
+        with pytest.raises(FileExistsError):
+            asyncio.run(server.serve())
+    finally:
+        server._executor.shutdown()
+    assert socket_path.read_text() == "keep me"
+
+
+def test_load_failures_are_in_the_status(tmp_path):
+    AxaExportGenerator(50).write(str(tmp_path / "good.csv"))
+    (tmp_path / "bad.csv").write_text("not an export\n")
+    server = AnalysisServer([str(tmp_path / "*.csv")],
+                            str(tmp_path / "s.sock"))
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            asyncio.run(server.reload())
+    finally:
+        server._executor.shutdown()
+    status = server.status()
+    assert status["n_operations"] == 50
+    assert [failure["file"] for failure in status["failures"]] == \
+        [str(tmp_path / "bad.csv")]
+    assert status["failures"][0]["error"]
@@ -0,0 +1,45 @@
+from collections import Counter
+
+import pytest
+
+from bank_analysis.axa import AxaParser
+from bank_analysis.sketches import TopCounterparties
+from bank_analysis.synthetic import AxaExportGenerator
+
+
+@pytest.fixture(scope="module")
+def historic(tmp_path_factory):
+    fpath = str(tmp_path_factory.mktemp("exports") / "export.csv")
+    AxaExportGenerator(2000).write(fpath)
+    return AxaParser().parse_csv(fpath)
+
+
+def exact_outflows(historic):
+    outflows = Counter()
+    for operation in historic:
+        party = operation.get_other_party()
+        if party is not None and operation.value <= 0:
+            outflows[party.name] -= operation.value
+    return outflows
+
+
+def test_top_counterparties_columns_are_exact(historic):
+    query = TopCounterparties(k=5, capacity=8)
+    top = query.top(query.accumulate_columns(historic))
+    expected = exact_outflows(historic).most_common(5)
+    assert [party.name for party, _, _ in top] == \
+        [name for name, _ in expected]
+    for (_, outflow, error), (_, total) in zip(top, expected):
+        assert outflow == pytest.approx(total)
+        assert error == 0.
+
+
+def test_top_counterparties_stream_bounds_exact_totals(historic):
+    query = TopCounterparties(k=5, capacity=8)
+    state = query.start()
+    for operation in historic:
+        if operation.value <= 0:
+            query.update(state, operation)
+    exact = exact_outflows(historic)
+    for party, outflow, error in query.top(state):
+        assert outflow - error - 1e-6 <= exact[party.name] <= outflow + 1e-6
@@ -0,0 +1,12 @@
+import numpy as np
+
+from bank_analysis.timeseries import parse_amounts
+
+
+def test_parse_amounts():
+    amounts = parse_amounts(["1.234,56", "1.234", "-12,30", "12", " 1 234,5 ",
+                             "1\xa0000", "", None, "-1.000.000"])
+    assert np.array_equal(amounts, [1234.56, 1234., -12.3, 12., 1234.5,
+                                    1000., np.nan, np.nan, -1e6],
+                          equal_nan=True)
+    assert parse_amounts([]).shape == (0,)